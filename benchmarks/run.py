@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""Offline microbenchmarks for the tile transforms, style builder and sprite builder.
+
+Usage:
+    python benchmarks/run.py --output before.json
+    # ...change something...
+    python benchmarks/run.py --output after.json --compare before.json
+    python benchmarks/run.py -k 'transform.*' -k style.build.noir
+
+Everything runs from checked-in fixtures -- sample raster tiles and a
+Liberty style snapshot in benchmarks/fixtures/, the icon sources in
+assets/sprites/ -- so no network, cache directory or server is needed.
+
+Each benchmark is timed over --rounds rounds of enough calls to last
+--min-time seconds, then run once more under tracemalloc for its Python
+allocation peak and retained size, counting the Pillow images it
+allocated. Results go to --output as JSON, keyed by benchmark name.
+"""
+
+import argparse
+import fnmatch
+import gc
+import importlib.util
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+FIXTURES  = Path(__file__).resolve().parent / 'fixtures'
+
+# Source icons are 1024px, so sprite benchmarks strip one icon per vibe and
+# pack a single sheet (from scratch, serially).
+_SAMPLE_ICON  = 'bus'
+_SAMPLE_SHEET = 'mario'
+
+# Keep imports of the app from touching a real cache or metrics directory.
+os.environ['TILE_CACHE_DIR'] = tempfile.mkdtemp(prefix='tile-bench-')
+os.environ.pop('PROMETHEUS_MULTIPROC_DIR', None)
+sys.path.insert(0, str(REPO_ROOT))
+
+import PIL  # noqa: E402
+from PIL import Image  # noqa: E402
+
+from src.backend import style_builder, transforms  # noqa: E402
+
+
+class Bench(NamedTuple):
+    name: str
+    fn: Callable[[], object]
+    items: int = 1       # units of work per call; timings are reported per item
+    unit: str = 'call'
+    heavy: bool = False  # seconds per call: time one call, skip warm-up and tracemalloc
+
+
+def _load_script(name: str):
+    spec = importlib.util.spec_from_file_location(name, REPO_ROOT / 'scripts' / f'{name}.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def transform_benches() -> list[Bench]:
+    fixtures = [p.read_bytes() for p in sorted((FIXTURES / 'tiles').glob('*.png'))]
+    vibes = list(transforms._PIPELINES)
+    # Single-colour fixtures (ocean.png) are answered from the flat-tile
+    # table without running a pipeline, so they are timed on their own.
+    flat = [t for t in fixtures if transforms.transform_flat(['default'], t) is not None]
+    tiles = [t for t in fixtures if t not in flat]
+    benches = [Bench('tile.decode', lambda: [transforms._decode(t) for t in fixtures], len(fixtures), 'tile')]
+    for vibe in vibes:
+        benches.append(Bench(f'transform.{vibe}',
+                             lambda vibe=vibe: [transforms.transform_pil([vibe], t) for t in tiles],
+                             len(tiles), 'tile'))
+    benches.append(Bench('transform.all_vibes',
+                         lambda: [transforms.transform_pil(vibes, t) for t in tiles],
+                         len(tiles) * len(vibes), 'tile'))
+    benches.append(Bench('transform.flat.all_vibes',
+                         lambda: [transforms.transform_pil(vibes, t) for t in flat],
+                         len(flat) * len(vibes), 'tile'))
+    return benches
+
+
+def style_benches() -> list[Bench]:
+    style_builder._install((FIXTURES / 'liberty.json').read_bytes(), time.time() + 365 * 86400)
+    vibes = ['default', *style_builder._VIBE_COLORS]
+
+    def document(vibe: str) -> style_builder.StyleDocument:
+        style_builder._documents = {}
+        return style_builder.style_document(vibe)
+
+    return ([Bench(f'style.build.{vibe}', lambda vibe=vibe: style_builder.build_style(vibe))
+             for vibe in vibes] +
+            [Bench(f'style.document.{vibe}', lambda vibe=vibe: document(vibe)) for vibe in vibes])
+
+
+def sprite_benches() -> list[Bench]:
+    build_sprites = _load_script('build_sprites')
+    sprite_dir = REPO_ROOT / 'assets' / 'sprites'
+    benches = []
+    for vibe in sorted(p.name for p in sprite_dir.iterdir() if p.is_dir()):
+        icon = Image.open(sprite_dir / vibe / f'{_SAMPLE_ICON}.png').convert('RGBA')
+        benches.append(Bench(f'sprites.strip_background.{vibe}',
+                             lambda icon=icon: build_sprites.strip_background(icon.copy()), 1, 'icon'))
+    benches.append(Bench(f'sprites.pack.{_SAMPLE_SHEET}',
+                         lambda: build_sprites.pack_sprites(sprite_dir / _SAMPLE_SHEET), 1, 'sheet',
+                         heavy=True))
+    return benches
+
+
+def measure(bench: Bench, rounds: int, min_time: float) -> dict:
+    if bench.heavy:
+        elapsed = _clock(bench.fn, 1) / bench.items
+        return {'unit': bench.unit, 'calls_per_round': 1, 'items_per_call': bench.items, 'rounds': 1,
+                'min_s': elapsed, 'median_s': elapsed, 'mean_s': elapsed, 'stdev_s': 0.0,
+                'per_sec': 1.0 / elapsed, 'alloc_peak_bytes': None, 'alloc_retained_bytes': None,
+                'pil_images': None}
+
+    bench.fn()   # warm-up: lazy imports, caches, first-touch allocations
+    number = 1
+    while True:
+        elapsed = _clock(bench.fn, number)
+        if elapsed >= min_time:
+            break
+        number = max(number * 2, int(number * min_time / max(elapsed, 1e-9)))
+    samples = [elapsed] + [_clock(bench.fn, number) for _ in range(rounds - 1)]
+    per_item = sorted(t / number / bench.items for t in samples)
+
+    gc.collect()
+    images_before = Image.core.get_stats()['new_count']
+    tracemalloc.start()
+    result = bench.fn()
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+
+    median = statistics.median(per_item)
+    return {
+        'unit': bench.unit,
+        'calls_per_round': number,
+        'items_per_call': bench.items,
+        'rounds': rounds,
+        'min_s': per_item[0],
+        'median_s': median,
+        'mean_s': statistics.fmean(per_item),
+        'stdev_s': statistics.stdev(per_item) if rounds > 1 else 0.0,
+        'per_sec': 1.0 / median if median else None,
+        'alloc_peak_bytes': peak // bench.items,
+        'alloc_retained_bytes': retained // bench.items,
+        'pil_images': (Image.core.get_stats()['new_count'] - images_before) / bench.items,
+    }
+
+
+def _clock(fn: Callable[[], object], number: int) -> float:
+    start = time.perf_counter()
+    for _ in range(number):
+        fn()
+    return time.perf_counter() - start
+
+
+def _git(*args: str) -> str | None:
+    try:
+        return subprocess.run(['git', *args], cwd=REPO_ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(rounds: int, min_time: float) -> dict:
+    status = _git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': _git('rev-parse', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'rounds': rounds,
+        'min_time_s': min_time,
+    }
+
+
+def compare(baseline: dict, results: dict, threshold: float) -> list[str]:
+    """Print median changes against baseline; return the names slower than threshold."""
+    regressions = []
+    print(f'\n{"benchmark":<40} {"before":>10} {"after":>10} {"change":>8}', file=sys.stderr)
+    for name, after in results.items():
+        before = baseline.get('benchmarks', {}).get(name)
+        if before is None:
+            continue
+        change = after['median_s'] / before['median_s'] - 1.0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  slower'
+        elif change < -threshold:
+            flag = '  faster'
+        print(f'{name:<40} {_ms(before["median_s"]):>10} {_ms(after["median_s"]):>10} '
+              f'{change:>+7.1%}{flag}', file=sys.stderr)
+    return regressions
+
+
+def _ms(seconds: float) -> str:
+    return f'{seconds * 1000:.3f}ms'
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Run the offline microbenchmarks')
+    parser.add_argument('-k', dest='patterns', action='append',
+                        help='Only run benchmarks matching this glob; repeatable')
+    parser.add_argument('--rounds', type=int, default=5, help='Timed rounds per benchmark (default: 5)')
+    parser.add_argument('--min-time', type=float, default=0.1,
+                        help='Minimum seconds per round (default: 0.1)')
+    parser.add_argument('--output', type=Path, help='Write results as JSON here (default: stdout)')
+    parser.add_argument('--compare', type=Path, help='Earlier results to compare medians against')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Relative slowdown reported as a regression (default: 0.10)')
+    parser.add_argument('--list', action='store_true', help='List benchmark names and exit')
+    args = parser.parse_args()
+
+    benches = transform_benches() + style_benches() + sprite_benches()
+    if args.patterns:
+        benches = [b for b in benches if any(fnmatch.fnmatchcase(b.name, p) for p in args.patterns)]
+    if args.list:
+        print('\n'.join(b.name for b in benches))
+        return
+    baseline = json.loads(args.compare.read_text()) if args.compare else None
+
+    results = {}
+    print(f'{"benchmark":<40} {"median":>10} {"per sec":>10} {"peak KiB":>9} {"images":>7}', file=sys.stderr)
+    for bench in benches:
+        r = results[bench.name] = measure(bench, args.rounds, args.min_time)
+        peak = '-' if r['alloc_peak_bytes'] is None else f'{r["alloc_peak_bytes"] / 1024:.1f}'
+        images = '-' if r['pil_images'] is None else f'{r["pil_images"]:.1f}'
+        print(f'{bench.name:<40} {_ms(r["median_s"]):>10} {r["per_sec"]:>10.1f} {peak:>9} {images:>7}',
+              file=sys.stderr)
+
+    report = json.dumps({'meta': metadata(args.rounds, args.min_time), 'benchmarks': results}, indent=2)
+    if args.output:
+        args.output.write_text(report + '\n')
+    else:
+        print(report)
+
+    if baseline is not None and compare(baseline, results, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
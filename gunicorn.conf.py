@@ -0,0 +1,55 @@
+"""Gunicorn settings: build shared state once in the master, then fork.
+
+gunicorn reads ./gunicorn.conf.py by default, so running
+`gunicorn -w 4 src.backend.wsgi:app` from the repo root picks this up.
+For the ASGI app add `-k uvicorn.workers.UvicornWorker` and name
+src.backend.asgi:app instead.
+
+preload_app imports the app in the master, so sprites, glyphs and the
+frontend are read and compressed once. when_ready then loads the Liberty
+base style and builds every vibe's style document. Workers forked
+afterwards inherit all of it copy-on-write, so adding a worker adds
+neither startup work nor another copy. gc.freeze() keeps the collector
+from writing to, and so copying, those inherited objects. Anything that
+can't cross a fork (upstream sessions, SQLite connections, background
+threads, the transform pool) is already created per process on first
+use.
+
+The hot-tile cache stays a per-worker LRU. If TILE_HOT_CACHE_SHM names a
+shared slab (see hotcache.py), the slab is removed here, so each server
+start begins empty and no tile from an older deploy is served. The slab
+is direct-mapped with one slot per key, so it is opt-in: at the default
+sizes it holds a few hundred tiles where the LRU holds thousands.
+
+Each worker renders at most --threads - 1 misses at once unless
+TILE_RENDER_SLOTS says otherwise. With as many slots as threads no miss
+would ever wait, so none would be reordered (see scheduler.py).
+"""
+
+import gc
+import os
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+load_dotenv()   # before reading TILE_HOT_CACHE_SHM below
+
+preload_app = True
+
+
+if os.environ.get('TILE_HOT_CACHE_SHM'):
+    Path(os.environ['TILE_HOT_CACHE_SHM']).parent.mkdir(parents=True, exist_ok=True)
+    Path(os.environ['TILE_HOT_CACHE_SHM']).unlink(missing_ok=True)
+
+
+def when_ready(server) -> None:
+    from src.backend import style_builder
+    style_builder.warm()
+    gc.freeze()
+
+
+def post_fork(server, worker) -> None:
+    threads = server.cfg.threads
+    if 'TILE_RENDER_SLOTS' not in os.environ and threads > 1:
+        from src.backend import tiles
+        tiles.set_render_slots(threads - 1)
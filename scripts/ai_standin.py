@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""A local stand-in for AI_SERVICE_URL, for trying the AI queue without a real model.
+
+Usage:
+    python scripts/ai_standin.py --port 8790 --delay 2
+    AI_SERVICE_URL=http://127.0.0.1:8790/ AI_VIBES=watercolor flask --app src.backend.app run
+
+Accepts both request formats the AI queue sends (one tile, or a batch
+under "tiles"), waits --delay seconds per request to stand in for model
+latency, and answers each tile with an obviously different rendering
+(PIL's contour filter) so upgraded tiles are easy to spot.
+"""
+
+import argparse
+import base64
+import io
+import json
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image, ImageFilter
+
+
+def stylize(b64: str) -> str:
+    img = Image.open(io.BytesIO(base64.b64decode(b64))).convert('RGB').filter(ImageFilter.CONTOUR)
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return base64.b64encode(buf.getvalue()).decode()
+
+
+class Handler(BaseHTTPRequestHandler):
+    delay = 0.0
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        time.sleep(self.delay)
+        if 'tiles' in body:
+            reply = {'tiles': [{'image_b64': stylize(tile['image_b64'])} for tile in body['tiles']]}
+        else:
+            reply = {'image_b64': stylize(body['image_b64'])}
+        data = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.log_message('%d tile(s)', len(reply.get('tiles', [reply])))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Serve a stand-in AI tile transform')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8790)
+    parser.add_argument('--delay', type=float, default=1.0, help='Seconds per request (default: 1)')
+    args = parser.parse_args()
+
+    Handler.delay = args.delay
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f'stand-in AI service on http://{args.host}:{args.port}/', flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,33 +1,50 @@
 #!/usr/bin/env python3
 """
-Build a MapLibre sprite sheet from individual source icon PNGs.
+Build MapLibre sprite sheets (1x and @2x) from individual source icon PNGs.
 
 Usage:
-    python scripts/build_sprites.py <vibe>
+    python scripts/build_sprites.py              # every vibe in assets/sprites/
+    python scripts/build_sprites.py mario --jobs 4
+    python scripts/build_sprites.py --force      # ignore the build record
 
-Reads from:  assets/sprites/<vibe>/<icon_name>.png  (63×63px each)
-Outputs:     src/static/sprites/<vibe>.png
-             src/static/sprites/<vibe>.json
+Reads from:  assets/sprites/<vibe>/<icon_name>.png
+Outputs:     src/static/sprites/<vibe>.png     src/static/sprites/<vibe>@2x.png
+             src/static/sprites/<vibe>.json    src/static/sprites/<vibe>@2x.json
 
-Icons are resized to their target sizes using nearest-neighbor interpolation
-(preserves hard pixel-art edges) and packed into a sprite sheet.
+Icons are stripped of baked-in backgrounds, resized to their target sizes
+(and twice that for @2x) using nearest-neighbor interpolation, which
+preserves hard pixel-art edges, and shelf-packed into a tight sheet.
+
+Icons are prepared in a process pool across all vibes. assets/sprites/.build.json
+records a hash of each icon's source as last built; an icon whose source
+is unchanged is copied from the existing sheets instead of rebuilt.
 """
 
+import argparse
+import hashlib
+import io
 import json
-import sys
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from functools import reduce
 from pathlib import Path
 
-from PIL import Image, ImageDraw
-
-# Layout — order determines position in the sprite sheet.
-# Each sublist is a row of regular 21×21 icons.
-ICON_ROWS = [
-    ['bus', 'railway', 'airport', 'ferry', 'car', 'fuel', 'parking'],
-    ['restaurant', 'cafe', 'fast_food', 'bar', 'bakery'],
-    ['park', 'mountain', 'campsite'],
-    ['hospital', 'pharmacy', 'police', 'school', 'bank', 'post', 'information'],
-    ['museum', 'cinema', 'lodging', 'place_of_worship'],
-    ['marker', 'circle', 'star', 'dot_9', 'dot_10', 'dot_11'],
+from PIL import Image, ImageChops
+
+REPO_ROOT   = Path(__file__).parent.parent
+SOURCE_ROOT = REPO_ROOT / 'assets' / 'sprites'
+OUTPUT_DIR  = REPO_ROOT / 'src' / 'static' / 'sprites'
+BUILD_RECORD = SOURCE_ROOT / '.build.json'
+
+# Regular icons, all ICON_SIZE square.
+ICONS = [
+    'bus', 'railway', 'airport', 'ferry', 'car', 'fuel', 'parking',
+    'restaurant', 'cafe', 'fast_food', 'bar', 'bakery',
+    'park', 'mountain', 'campsite',
+    'hospital', 'pharmacy', 'police', 'school', 'bank', 'post', 'information',
+    'museum', 'cinema', 'lodging', 'place_of_worship',
+    'marker', 'circle', 'star', 'dot_9', 'dot_10', 'dot_11',
 ]
 
 # Road shields: (name, final_width, final_height)
@@ -42,44 +59,60 @@ ROAD_SHIELDS = [
 
 ICON_SIZE = 21  # final size for regular icons
 BG_TOLERANCE = 30  # max channel delta to consider a pixel "background"
+SCALES = (1, 2)
+# Part of every icon's hash: bump it when the way icons are prepared changes.
+_BUILD_VERSION = 2
+
+_RUNS = re.compile(b'\xff+')
+
+
+def icon_sizes() -> dict[str, tuple[int, int]]:
+    """Every expected icon's 1x (width, height)."""
+    sizes = {name: (ICON_SIZE, ICON_SIZE) for name in ICONS}
+    sizes.update((name, (w, h)) for name, w, h in ROAD_SHIELDS)
+    return sizes
 
 
 def strip_background(img: Image.Image) -> Image.Image:
     """Flood-fill from all four corners to remove solid backgrounds.
 
     Handles white, grey, or any uniform color that nano banana bakes in
-    instead of producing true transparency.
+    instead of producing true transparency. Pixels within BG_TOLERANCE of
+    the top-left colour that connect (4-way) to an opaque corner become
+    transparent. The colour test runs as Pillow lookup tables and the fill
+    claims whole row spans at a time, so no Python runs per pixel.
     """
     img = img.convert('RGBA')
     w, h = img.size
-    pixels = img.load()
+    bands = img.split()
+    bg_color = img.getpixel((0, 0))
 
-    def similar(a, b):
-        return all(abs(int(a[i]) - int(b[i])) <= BG_TOLERANCE for i in range(3))
+    # 255 where a pixel is opaque and close to the background colour.
+    tests = [band.point([255 if abs(v - bg_color[i]) <= BG_TOLERANCE else 0 for v in range(256)])
+             for i, band in enumerate(bands[:3])]
+    tests.append(bands[3].point([0] + [255] * 255))
+    fillable = bytearray(reduce(ImageChops.darker, tests).tobytes())
 
-    visited = [[False] * h for _ in range(w)]
-    queue = []
-    for corner in [(0, 0), (w - 1, 0), (0, h - 1), (w - 1, h - 1)]:
-        cx, cy = corner
-        if pixels[cx, cy][3] > 0:  # only flood opaque corners
-            queue.append(corner)
-
-    bg_color = pixels[0, 0]
-
-    while queue:
-        x, y = queue.pop()
-        if x < 0 or x >= w or y < 0 or y >= h:
-            continue
-        if visited[x][y]:
-            continue
-        if pixels[x, y][3] == 0:
-            continue
-        if not similar(pixels[x, y], bg_color):
+    filled = bytearray(w * h)
+    seeds = [y * w + x for x, y in ((0, 0), (w - 1, 0), (0, h - 1), (w - 1, h - 1))
+             if bands[3].getpixel((x, y)) > 0]  # only flood opaque corners
+    while seeds:
+        i = seeds.pop()
+        if not fillable[i]:
             continue
-        visited[x][y] = True
-        pixels[x, y] = (0, 0, 0, 0)
-        queue.extend([(x+1, y), (x-1, y), (x, y+1), (x, y-1)])
+        row = i - i % w
+        left = fillable.rfind(0, row, i)
+        left = row if left < 0 else left + 1
+        right = fillable.find(0, i, row + w)
+        right = row + w if right < 0 else right
+        fillable[left:right] = bytes(right - left)
+        filled[left:right] = b'\xff' * (right - left)
+        for other in (row - w, row + w):
+            if 0 <= other < w * h:
+                seeds.extend(m.start() for m in _RUNS.finditer(fillable, left - row + other,
+                                                              right - row + other))
 
+    img.paste((0, 0, 0, 0), mask=Image.frombytes('L', (w, h), bytes(filled)))
     return img
 
 
@@ -94,67 +127,186 @@ def load_icon(path: Path) -> Image.Image:
     return img
 
 
-def build_sprites(vibe: str) -> None:
-    repo_root = Path(__file__).parent.parent
-    src_dir   = repo_root / 'assets' / 'sprites' / vibe
-    out_dir   = repo_root / 'src' / 'static' / 'sprites'
-    out_dir.mkdir(parents=True, exist_ok=True)
+def prepare_icon(path: Path, size: tuple[int, int]) -> list[Image.Image]:
+    """The icon at size times each of SCALES."""
+    img = load_icon(path)
+    return [img.resize((size[0] * scale, size[1] * scale), Image.NEAREST) for scale in SCALES]
+
+
+def pack(sizes: dict[str, tuple[int, int]]) -> tuple[int, int, dict[str, tuple[int, int]]]:
+    """Shelf-pack boxes tallest first, at whichever sheet width gives the least area.
+
+    Returns the sheet width and height and each box's top-left corner.
+    Ties go to the squarer sheet.
+    """
+    if not sizes:
+        return 1, 1, {}
+    order = sorted(sizes, key=lambda name: (-sizes[name][1], -sizes[name][0], name))
+    widest = max(w for w, _ in sizes.values())
+    best = None
+    for width in range(widest, sum(w for w, _ in sizes.values()) + 1):
+        x = y = shelf = 0
+        positions = {}
+        for name in order:
+            w, h = sizes[name]
+            if x + w > width:
+                x, y, shelf = 0, y + shelf, 0
+            positions[name] = (x, y)
+            x, shelf = x + w, max(shelf, h)
+        used = max(px + sizes[name][0] for name, (px, _) in positions.items())
+        height = y + shelf
+        key = (used * height, max(used, height))
+        if best is None or key < best[0]:
+            best = (key, used, height, positions)
+    _, width, height, positions = best
+    return width, height, positions
 
-    max_icon_width  = max(len(row) for row in ICON_ROWS) * ICON_SIZE
-    road_total_width = sum(w for _, w, _ in ROAD_SHIELDS)
-    canvas_w = max(max_icon_width, road_total_width)
-    canvas_h = len(ICON_ROWS) * ICON_SIZE + ROAD_SHIELDS[0][2]
 
-    canvas   = Image.new('RGBA', (canvas_w, canvas_h), (0, 0, 0, 0))
+def render_sheet(icons: dict[str, Image.Image], layout: tuple[int, int, dict[str, tuple[int, int]]],
+                 scale: int) -> tuple[Image.Image, dict]:
+    """Paste each icon (already at scale) at its packed position; returns the sheet and manifest."""
+    width, height, positions = layout
+    canvas = Image.new('RGBA', (width * scale, height * scale), (0, 0, 0, 0))
     manifest = {}
-    missing  = []
+    for name in sorted(icons):
+        img = icons[name]
+        x, y = positions[name][0] * scale, positions[name][1] * scale
+        canvas.paste(img, (x, y))   # boxes never overlap, so copy alpha as is
+        manifest[name] = {
+            'x': x, 'y': y,
+            'width': img.width, 'height': img.height,
+            'pixelRatio': scale,
+        }
+    return canvas, manifest
+
+
+def pack_sprites(src_dir: Path) -> tuple[Image.Image, dict, list[str]]:
+    """Build and pack the icons in src_dir into one 1x sheet, from scratch.
+
+    Returns the sheet, its MapLibre manifest and the names of missing icons.
+    """
+    sizes = icon_sizes()
+    missing = [name for name in sizes if not (src_dir / f'{name}.png').exists()]
+    icons = {name: prepare_icon(src_dir / f'{name}.png', size)[0]
+             for name, size in sizes.items() if name not in missing}
+    layout = pack({name: sizes[name] for name in icons})
+    canvas, manifest = render_sheet(icons, layout, 1)
+    return canvas, manifest, missing
 
-    # Regular icons
-    for row_idx, row in enumerate(ICON_ROWS):
-        y = row_idx * ICON_SIZE
-        for col_idx, name in enumerate(row):
-            x = col_idx * ICON_SIZE
+
+def source_hash(path: Path, size: tuple[int, int]) -> str:
+    digest = hashlib.blake2b(digest_size=12)
+    digest.update(f'{_BUILD_VERSION}:{size[0]}x{size[1]}:{BG_TOLERANCE}:{SCALES}:'.encode())
+    digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def _sheet_name(vibe: str, scale: int) -> str:
+    return vibe if scale == 1 else f'{vibe}@{scale}x'
+
+
+def _previous_icons(vibe: str, scale: int) -> dict[str, Image.Image]:
+    """Each icon as cut from the vibe's existing sheet at scale; {} if there isn't one."""
+    name = _sheet_name(vibe, scale)
+    try:
+        sheet = Image.open(OUTPUT_DIR / f'{name}.png').convert('RGBA')
+        manifest = json.loads((OUTPUT_DIR / f'{name}.json').read_text())
+    except (OSError, ValueError):
+        return {}
+    return {icon: sheet.crop((e['x'], e['y'], e['x'] + e['width'], e['y'] + e['height']))
+            for icon, e in manifest.items()}
+
+
+def _png_bytes(img: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format='PNG')
+    return buf.getvalue()
+
+
+def _write_if_changed(path: Path, data: bytes) -> bool:
+    if path.exists() and path.read_bytes() == data:
+        return False
+    path.write_bytes(data)
+    return True
+
+
+def build(vibes: list[str], jobs: int | None = None, force: bool = False) -> None:
+    """Build the 1x and @2x sheets for vibes, preparing only icons whose source changed."""
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        record = json.loads(BUILD_RECORD.read_text())
+    except (OSError, ValueError):
+        record = {}
+    sizes = icon_sizes()
+
+    hashes: dict[str, dict[str, str]] = {}
+    missing: dict[str, list[str]] = {}
+    icons: dict[str, dict[str, list[Image.Image]]] = {}
+    todo: list[tuple[str, str]] = []
+    for vibe in vibes:
+        src_dir = SOURCE_ROOT / vibe
+        hashes[vibe], missing[vibe], icons[vibe] = {}, [], {}
+        previous = [{} if force else _previous_icons(vibe, scale) for scale in SCALES]
+        for name, size in sizes.items():
             path = src_dir / f'{name}.png'
             if not path.exists():
-                missing.append(name)
+                missing[vibe].append(name)
                 continue
-            img = load_icon(path).resize((ICON_SIZE, ICON_SIZE), Image.NEAREST)
-            canvas.paste(img, (x, y), img)
-            manifest[name] = {
-                'x': x, 'y': y,
-                'width': ICON_SIZE, 'height': ICON_SIZE,
-                'pixelRatio': 1,
-            }
-
-    # Road shields
-    road_y = len(ICON_ROWS) * ICON_SIZE
-    road_x = 0
-    for name, w, h in ROAD_SHIELDS:
-        path = src_dir / f'{name}.png'
-        if not path.exists():
-            missing.append(name)
-            road_x += w
-            continue
-        img = load_icon(path).resize((w, h), Image.NEAREST)
-        canvas.paste(img, (road_x, road_y), img)
-        manifest[name] = {
-            'x': road_x, 'y': road_y,
-            'width': w, 'height': h,
-            'pixelRatio': 1,
-        }
-        road_x += w
+            hashes[vibe][name] = source_hash(path, size)
+            cut = [prev.get(name) for prev in previous]
+            if (record.get(vibe, {}).get(name) == hashes[vibe][name]
+                    and all(img is not None and img.size == (size[0] * s, size[1] * s)
+                            for img, s in zip(cut, SCALES))):
+                icons[vibe][name] = cut
+            else:
+                todo.append((vibe, name))
+
+    args = ([SOURCE_ROOT / vibe / f'{name}.png' for vibe, name in todo],
+            [sizes[name] for _, name in todo])
+    if len(todo) > 1 and (jobs or os.cpu_count() or 1) > 1:
+        with ProcessPoolExecutor(jobs) as pool:
+            prepared = list(pool.map(prepare_icon, *args))
+    else:
+        prepared = list(map(prepare_icon, *args))
+    for (vibe, name), images in zip(todo, prepared):
+        icons[vibe][name] = images
+
+    for vibe in vibes:
+        rebuilt = sum(1 for v, _ in todo if v == vibe)
+        layout = pack({name: sizes[name] for name in icons[vibe]})
+        for i, scale in enumerate(SCALES):
+            canvas, manifest = render_sheet({name: imgs[i] for name, imgs in icons[vibe].items()},
+                                            layout, scale)
+            png_path = OUTPUT_DIR / f'{_sheet_name(vibe, scale)}.png'
+            changed = _write_if_changed(png_path, _png_bytes(canvas))
+            changed |= _write_if_changed(png_path.with_suffix('.json'),
+                                         json.dumps(manifest, indent=2).encode())
+            print(f'{"OK " if changed else "-- "} {png_path}  ({canvas.width}×{canvas.height}px, '
+                  f'{len(manifest)} icons, {rebuilt} rebuilt{"" if changed else ", unchanged"})')
+        if missing[vibe]:
+            print(f'MISSING {vibe} ({len(missing[vibe])}): {", ".join(missing[vibe])}')
+        record[vibe] = hashes[vibe]
+
+    BUILD_RECORD.write_text(json.dumps(record, indent=2, sort_keys=True) + '\n')
+
+
+def build_sprites(vibe: str) -> None:
+    build([vibe])
+
 
-    canvas.save(out_dir / f'{vibe}.png')
-    (out_dir / f'{vibe}.json').write_text(json.dumps(manifest, indent=2))
+def main() -> None:
+    vibes_available = sorted(p.name for p in SOURCE_ROOT.iterdir() if p.is_dir())
+    parser = argparse.ArgumentParser(description='Build MapLibre sprite sheets from source icons')
+    parser.add_argument('vibes', nargs='*', help=f'Vibes to build (default: all of {", ".join(vibes_available)})')
+    parser.add_argument('--jobs', type=int, help='Icon-preparing processes (default: one per CPU)')
+    parser.add_argument('--force', action='store_true', help='Rebuild every icon from its source')
+    args = parser.parse_args()
 
-    print(f'OK  {out_dir}/{vibe}.png  ({canvas_w}×{canvas_h}px, {len(manifest)} icons)')
-    print(f'OK  {out_dir}/{vibe}.json')
-    if missing:
-        print(f'MISSING ({len(missing)}): {", ".join(missing)}')
+    unknown = set(args.vibes) - set(vibes_available)
+    if unknown:
+        parser.error(f'no sources in {SOURCE_ROOT} for: {", ".join(sorted(unknown))}')
+    build(args.vibes or vibes_available, jobs=args.jobs, force=args.force)
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        print('Usage: python scripts/build_sprites.py <vibe>')
-        sys.exit(1)
-    build_sprites(sys.argv[1])
+    main()
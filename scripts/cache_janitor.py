@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""Trim the disk tile cache to its size budgets, least recently read tiles first.
+
+Usage:
+    python scripts/cache_janitor.py --max-mb 20000 --vibe-max-mb 2000,noir=5000 --dry-run
+
+Runs the same sweep as the app's background janitor, from the same
+environment (TILE_CACHE_DIR, TILE_CACHE_BACKEND, TILE_CACHE_MAX_MB,
+TILE_CACHE_VIBE_MAX_MB, TILE_CACHE_PIN_ZOOM); flags override it. Tiles at
+the pin zoom and shallower are never evicted. Safe to run while the app is
+serving.
+"""
+
+import argparse
+import logging
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src.backend import janitor, tilestore  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Evict tiles until the disk cache fits its budgets')
+    parser.add_argument('--cache-dir', type=Path,
+                        default=Path(os.environ.get('TILE_CACHE_DIR', '/tmp/tile_cache')),
+                        help='Tile cache root (default: TILE_CACHE_DIR)')
+    parser.add_argument('--backend', default=os.environ.get('TILE_CACHE_BACKEND', 'dir'),
+                        help='dir or mbtiles (default: TILE_CACHE_BACKEND)')
+    parser.add_argument('--max-mb', type=float, help='Budget for the whole cache (default: TILE_CACHE_MAX_MB)')
+    parser.add_argument('--vibe-max-mb',
+                        help='Budget per vibe, e.g. 2000 or 2000,noir=5000 (default: TILE_CACHE_VIBE_MAX_MB)')
+    parser.add_argument('--pin-zoom', type=int, default=janitor._PIN_ZOOM,
+                        help=f'Never evict this zoom or shallower (default: {janitor._PIN_ZOOM})')
+    parser.add_argument('--dry-run', action='store_true', help='Report what would be evicted')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(message)s')
+    max_bytes = janitor._MAX_BYTES if args.max_mb is None else int(args.max_mb * 1024 * 1024)
+    budgets = janitor._VIBE_BUDGETS if args.vibe_max_mb is None else janitor.parse_budgets(args.vibe_max_mb)
+    sweeper = janitor.Janitor(tilestore.create(args.cache_dir, args.backend), max_bytes, budgets,
+                              args.pin_zoom, interval=0)
+    if not sweeper.enabled:
+        parser.error('no budget set: pass --max-mb or --vibe-max-mb')
+
+    stats = sweeper.sweep(dry_run=args.dry_run)
+    verb = 'would free' if args.dry_run else 'freed'
+    for layer, size in stats.usage.items():
+        freed = stats.freed.get(layer, 0)
+        print(f'{layer:<24} {size / 2**20:10.1f} MB' + (f'  {verb} {freed / 2**20:.1f} MB' if freed else ''))
+    total = sum(stats.usage.values())
+    freed = sum(stats.freed.values())
+    print(f'{"total":<24} {total / 2**20:10.1f} MB  {verb} {freed / 2**20:.1f} MB'
+          + ('' if args.dry_run else f' ({stats.evicted} tiles)'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""Import a directory-per-tile cache into MBTiles files.
+
+Usage:
+    python scripts/import_tile_cache.py --cache-dir /tmp/tile_cache
+
+Reads every layer under <cache-dir> (upstream/ and raster/<vibe>/) and writes
+<cache-dir>/upstream.mbtiles and <cache-dir>/raster/<vibe>.mbtiles, which is
+the layout the app uses with TILE_CACHE_BACKEND=mbtiles. Identical tiles
+in a layer are stored once (the MBTiles map/images tables, keyed by the
+same content hash as the directory cache's blobs/). Tiles already in the
+target are overwritten, and images no tile uses any more are deleted; the
+source files are left in place.
+"""
+
+import argparse
+import itertools
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src.backend.tilestore import DirectoryStore, MBTilesStore  # noqa: E402
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Import a directory tile cache into MBTiles')
+    parser.add_argument('--cache-dir', type=Path, required=True,
+                        help='TILE_CACHE_DIR holding the directory cache')
+    parser.add_argument('--out-dir', type=Path,
+                        help='Where to write .mbtiles files (default: --cache-dir)')
+    parser.add_argument('--batch', type=int, default=500,
+                        help='Tiles per SQLite transaction (default: 500)')
+    args = parser.parse_args()
+
+    source = DirectoryStore(args.cache_dir)
+    target = MBTilesStore(args.out_dir or args.cache_dir)
+
+    layers = source.layers()
+    if not layers:
+        print(f'No tile layers found under {args.cache_dir}')
+        sys.exit(1)
+
+    for layer in layers:
+        tiles = source.iter_tiles(layer)
+        count = 0
+        while batch := list(itertools.islice(tiles, args.batch)):
+            target.put_many(layer, batch)
+            count += len(batch)
+        stored, _ = target.usage(layer, 0, 1)
+        print(f'OK  {layer}: {count} tiles in {stored / 2**20:.1f} MB', flush=True)
+
+    images, freed = target.prune()
+    if images:
+        print(f'Deleted {images} replaced images ({freed / 2**20:.1f} MB)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""Seed the raster tile cache for regions and zoom ranges, without a running server.
+
+Usage:
+    python scripts/seed_tiles.py --bbox=-0.51,51.28,0.33,51.69 --max-zoom 6 \
+        --vibes noir,vintage --checkpoint /tmp/london.ckpt
+
+Uses the app's own fetch, transform and cache code and its environment
+(TILE_CACHE_DIR, TILE_CACHE_BACKEND, UPSTREAM_*, ...). Tiles already cached
+for a vibe are skipped. Re-running with the same arguments and
+--checkpoint resumes an interrupted run.
+"""
+
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from src.backend.seed import WORLD, SeedStats, seed  # noqa: E402
+from src.backend.tiles import MAX_NATIVE_ZOOM  # noqa: E402
+
+
+def parse_bbox(value: str) -> tuple[float, float, float, float]:
+    try:
+        min_lon, min_lat, max_lon, max_lat = (float(v) for v in value.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected min_lon,min_lat,max_lon,max_lat') from None
+    if min_lat > max_lat:
+        raise argparse.ArgumentTypeError('min_lat is greater than max_lat')
+    return min_lon, min_lat, max_lon, max_lat
+
+
+def report(stats: SeedStats) -> None:
+    print(f'{stats.tiles} tiles: {stats.written} written, {stats.skipped} already cached, '
+          f'{stats.failed} failed', flush=True)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Seed the raster tile cache in-process')
+    parser.add_argument('--bbox', type=parse_bbox, action='append',
+                        help='min_lon,min_lat,max_lon,max_lat (write --bbox=-10,... for negative values);'
+                             ' repeatable (default: whole world)')
+    parser.add_argument('--min-zoom', type=int, default=0, help='First zoom level (default: 0)')
+    parser.add_argument('--max-zoom', type=int, required=True,
+                        help=f'Last zoom level, at most {MAX_NATIVE_ZOOM} (deeper tiles are never cached)')
+    parser.add_argument('--vibes', help='Comma-separated vibes (default: all but default)')
+    parser.add_argument('--format', default='png', help='Tile encoding to seed (default: png)')
+    parser.add_argument('--workers', type=int, default=4, help='Parallel tiles (default: 4)')
+    parser.add_argument('--rate', type=float, default=10.0,
+                        help='Max upstream fetches per second, 0 for no limit (default: 10)')
+    parser.add_argument('--checkpoint', type=Path, help='Progress file for resuming')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+    vibes = [v.strip() for v in args.vibes.split(',') if v.strip()] if args.vibes else None
+    try:
+        stats = seed(args.bbox or [WORLD], args.min_zoom, args.max_zoom, vibes, args.format,
+                     workers=args.workers, rate=args.rate, checkpoint=args.checkpoint,
+                     progress=report)
+    except KeyboardInterrupt:
+        print('Interrupted; re-run with the same arguments to resume.')
+        sys.exit(130)
+    except ValueError as exc:
+        parser.error(str(exc))
+
+    report(stats)
+    if stats.failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,247 @@
+"""Background AI transforms for the vibes in AI_VIBES.
+
+A request for an AI vibe is answered at once with the PIL rendering; the
+tile is queued here and a small pool of worker threads sends queued tiles
+to AI_SERVICE_URL in batches of up to AI_BATCH_SIZE per POST, waiting up
+to AI_BATCH_WAIT_MS for a batch to fill. When a result comes back the
+on_result callback upgrades the cached tile in place.
+
+Each vibe has its own cap on batches in flight (AI_VIBE_CONCURRENCY) and
+on batches started per second (AI_VIBE_RATE, 0 for none), either one
+figure for every vibe or per vibe ("2,watercolor=4"). The queue holds at
+most AI_QUEUE_MAX tiles; past that new tiles keep their PIL rendering. A
+tile whose AI call failed isn't queued again for AI_RETRY_AFTER seconds.
+
+A batch of one is sent in the single-tile format
+({"style", "image_b64", "tile_z", "tile_x", "tile_y"}), so AI_BATCH_SIZE=1
+works with services that don't take batches. Larger batches send
+{"style", "tiles": [{"image_b64", "tile_z", "tile_x", "tile_y"}, ...]} and
+expect {"tiles": [{"image_b64"} or null, ...]} back in the same order.
+"""
+
+import base64
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+from . import hotcache, metrics
+from .upstream import RateLimiter
+from .upstream import ai as ai_client
+
+log = logging.getLogger(__name__)
+
+
+def parse_limits(value: str) -> dict[str, float]:
+    """'2,watercolor=4' -> {'': 2.0, 'watercolor': 4.0}; '' is every other vibe."""
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        vibe, _, limit = item.rpartition('=')
+        limits[vibe.strip()] = float(limit)
+    return limits
+
+
+_URL         = os.environ.get('AI_SERVICE_URL', '')
+_KEY         = os.environ.get('AI_SERVICE_KEY', '')
+_VIBES       = frozenset(v.strip() for v in os.environ.get('AI_VIBES', '').split(',') if v.strip())
+_WORKERS     = int(os.environ.get('AI_WORKERS', '2'))
+_BATCH_SIZE  = int(os.environ.get('AI_BATCH_SIZE', '8'))
+_BATCH_WAIT  = float(os.environ.get('AI_BATCH_WAIT_MS', '50')) / 1000
+_QUEUE_MAX   = int(os.environ.get('AI_QUEUE_MAX', '1000'))
+_CONCURRENCY = parse_limits(os.environ.get('AI_VIBE_CONCURRENCY', '2'))
+_RATE        = parse_limits(os.environ.get('AI_VIBE_RATE', '0'))
+_RETRY_AFTER = float(os.environ.get('AI_RETRY_AFTER', '300'))
+_TIMEOUT     = float(os.environ.get('AI_TIMEOUT', '30'))
+
+Key = tuple[int, int, int]   # z, x, y
+# vibe, z, x, y, transformed image bytes, formats to store it as
+ResultCallback = Callable[[str, int, int, int, bytes, set[str]], None]
+
+
+class _Job:
+    __slots__ = ('raw', 'fmts', 'queued_at')
+
+    def __init__(self, raw: bytes, fmt: str) -> None:
+        self.raw = raw
+        self.fmts = {fmt}
+        self.queued_at = time.monotonic()
+
+
+class AIQueue:
+    """Per-process queue of tiles waiting for the AI service, and the threads that send them."""
+
+    def __init__(self, on_result: ResultCallback, *, url: str = _URL, key: str = _KEY,
+                 vibes: frozenset[str] = _VIBES, workers: int = _WORKERS,
+                 batch_size: int = _BATCH_SIZE, batch_wait: float = _BATCH_WAIT,
+                 max_queued: int = _QUEUE_MAX, concurrency: dict[str, float] = _CONCURRENCY,
+                 rate: dict[str, float] = _RATE, retry_after: float = _RETRY_AFTER) -> None:
+        self.on_result = on_result
+        self.url = url
+        self.key = key
+        self.vibes = vibes if url else frozenset()
+        self.workers = workers
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+        self.max_queued = max_queued
+        self.concurrency = concurrency
+        self.rate = rate
+        self.retry_after = retry_after
+        self._queues: dict[str, OrderedDict[Key, _Job]] = {}
+        self._running: dict[tuple[str, int, int, int], _Job] = {}
+        self._in_flight: dict[str, int] = {}
+        self._limiters: dict[str, RateLimiter] = {}
+        self._failed = hotcache.NegativeCache(max_entries=10_000)
+        self._cond = threading.Condition()
+        self._pid = 0
+        self._counts = {'ok': 0, 'fallback': 0, 'dropped': 0, 'batches': 0}
+
+    def handles(self, vibe: str) -> bool:
+        return vibe in self.vibes
+
+    def wants(self, vibe: str, z: int, x: int, y: int) -> bool:
+        """Whether submit() would queue the tile: not queued already, nor failed recently."""
+        with self._cond:
+            return ((z, x, y) not in self._queues.get(vibe, ()) and (vibe, z, x, y) not in self._running
+                    and self._failed.get((vibe, z, x, y)) is None)
+
+    def submit(self, vibe: str, z: int, x: int, y: int, fmt: str, raw: bytes) -> None:
+        """Queue the upstream tile for vibe's AI transform; the result is stored as fmt too."""
+        if vibe not in self.vibes:
+            return
+        if self._pid != os.getpid():
+            self._start()
+        with self._cond:
+            queue = self._queues.setdefault(vibe, OrderedDict())
+            job = queue.get((z, x, y)) or self._running.get((vibe, z, x, y))
+            if job is not None:
+                job.fmts.add(fmt)
+                return
+            if self._failed.get((vibe, z, x, y)) is not None:
+                return
+            if sum(map(len, self._queues.values())) >= self.max_queued:
+                self._counts['dropped'] += 1
+                metrics.AI_TRANSFORMS.labels(vibe, 'dropped').inc()
+                return
+            queue[z, x, y] = _Job(raw, fmt)
+            metrics.AI_QUEUE_DEPTH.inc()
+            self._cond.notify()
+
+    def stats(self) -> dict:
+        with self._cond:
+            queued = {vibe: len(queue) for vibe, queue in self._queues.items() if queue}
+            running = len(self._running)
+            counts = dict(self._counts)
+        return {'vibes': sorted(self.vibes), 'queued': queued, 'running': running,
+                'max_queued': self.max_queued, 'batch_size': self.batch_size, **counts}
+
+    def _limit(self, limits: dict[str, float], vibe: str) -> float:
+        return limits.get(vibe, limits.get('', 0.0))
+
+    def _start(self) -> None:
+        # Threads don't survive a fork, so each worker process starts its own.
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queues, self._running, self._in_flight = {}, {}, {}
+        for i in range(self.workers):
+            threading.Thread(target=self._run, name=f'ai-{i}', daemon=True).start()
+
+    def _run(self) -> None:
+        while True:
+            vibe, batch = self._take()
+            try:
+                self._limiters[vibe].acquire()
+                results = self._call(vibe, batch)
+            except Exception:
+                log.warning('AI batch failed vibe=%s tiles=%d', vibe, len(batch), exc_info=True)
+                results = [None] * len(batch)
+            try:
+                for ((z, x, y), job), result in zip(batch, results):
+                    self._finish(vibe, z, x, y, job, result)
+            finally:
+                with self._cond:
+                    self._in_flight[vibe] -= 1
+                    self._cond.notify_all()
+
+    def _take(self) -> tuple[str, list[tuple[Key, _Job]]]:
+        """Block until some vibe has a batch ready and a free slot; dequeue it."""
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                ready, oldest, wait = None, now, None
+                for vibe, queue in self._queues.items():
+                    if not queue or self._in_flight.get(vibe, 0) >= self._limit(self.concurrency, vibe):
+                        continue
+                    queued_at = next(iter(queue.values())).queued_at
+                    due = queued_at + self.batch_wait
+                    if len(queue) >= self.batch_size or due <= now:
+                        if queued_at <= oldest:
+                            ready, oldest = vibe, queued_at
+                    elif wait is None or due - now < wait:
+                        wait = due - now
+                if ready is not None:
+                    break
+                self._cond.wait(wait)
+
+            queue = self._queues[ready]
+            batch = [queue.popitem(last=False) for _ in range(min(self.batch_size, len(queue)))]
+            for (z, x, y), job in batch:
+                self._running[ready, z, x, y] = job
+            self._in_flight[ready] = self._in_flight.get(ready, 0) + 1
+            if ready not in self._limiters:
+                self._limiters[ready] = RateLimiter(self._limit(self.rate, ready))
+            self._counts['batches'] += 1
+            return ready, batch
+
+    def _call(self, vibe: str, batch: list[tuple[Key, _Job]]) -> list[bytes | None]:
+        headers = {'Content-Type': 'application/json'}
+        if self.key:
+            headers['Authorization'] = f'Bearer {self.key}'
+        tiles = [{'image_b64': base64.b64encode(job.raw).decode(), 'tile_z': z, 'tile_x': x, 'tile_y': y}
+                 for (z, x, y), job in batch]
+        if len(tiles) == 1:
+            resp = ai_client.post(self.url, json={'style': vibe, **tiles[0]}, headers=headers,
+                                  timeout=_TIMEOUT)
+            resp.raise_for_status()
+            return [_image(resp)]
+
+        resp = ai_client.post(self.url, json={'style': vibe, 'tiles': tiles}, headers=headers,
+                              timeout=_TIMEOUT)
+        resp.raise_for_status()
+        results = resp.json()['tiles']
+        if len(results) != len(tiles):
+            raise ValueError(f'AI service returned {len(results)} tiles for {len(tiles)}')
+        return [base64.b64decode(r['image_b64']) if r else None for r in results]
+
+    def _finish(self, vibe: str, z: int, x: int, y: int, job: _Job, result: bytes | None) -> None:
+        if result is None:
+            self._failed.put((vibe, z, x, y), False, self.retry_after)
+        stored: set[str] = set()
+        while True:
+            # Formats asked for while the callback ran are stored on the next pass.
+            with self._cond:
+                fmts = job.fmts - stored
+                if result is None or not fmts:
+                    del self._running[vibe, z, x, y]
+                    break
+            try:
+                self.on_result(vibe, z, x, y, result, fmts)
+            except Exception:
+                log.warning('storing AI tile failed vibe=%s z=%d x=%d y=%d', vibe, z, x, y,
+                            exc_info=True)
+            stored |= fmts
+        outcome = 'ok' if result is not None else 'fallback'
+        with self._cond:
+            self._counts[outcome] += 1
+        metrics.AI_TRANSFORMS.labels(vibe, outcome).inc()
+        metrics.AI_QUEUE_DEPTH.dec()
+
+
+def _image(resp) -> bytes:
+    """Image bytes from a response: the raw image, or JSON with image_b64."""
+    if 'image' in resp.headers.get('Content-Type', ''):
+        return resp.content
+    return base64.b64decode(resp.json()['image_b64'])
@@ -1,23 +1,34 @@
 import os
+from pathlib import Path
 
-from flask import Flask, jsonify, send_from_directory
+from flask import Flask, jsonify
 from dotenv import load_dotenv
 
 load_dotenv()
 
-app = Flask(__name__, static_folder='../frontend', static_url_path='')
+app = Flask(__name__, static_folder=None)
 
 try:
+    from .assets import AssetIndex
     from .tiles import tiles_bp
     from .glyphs import glyphs_bp
     from .sprites import sprites_bp
+    from .metrics import metrics_bp
 except ImportError:
-    from tiles import tiles_bp  # type: ignore[no-redef]  # direct invocation
+    from assets import AssetIndex  # type: ignore[no-redef]  # direct invocation
+    from tiles import tiles_bp  # type: ignore[no-redef]
     from glyphs import glyphs_bp  # type: ignore[no-redef]
     from sprites import sprites_bp  # type: ignore[no-redef]
+    from metrics import metrics_bp  # type: ignore[no-redef]
 app.register_blueprint(tiles_bp)
 app.register_blueprint(glyphs_bp)
 app.register_blueprint(sprites_bp)
+app.register_blueprint(metrics_bp)
+
+# The frontend bundle, served from memory. index.html links its scripts and
+# stylesheets with ?v=<asset version>, so only the page itself is revalidated.
+_frontend = AssetIndex(Path(__file__).parent.parent / 'frontend', 'frontend')
+_frontend.link_versions('index.html')
 
 
 @app.after_request
@@ -29,7 +40,12 @@ def add_cors(response):
 
 @app.route('/')
 def index():
-    return send_from_directory(app.static_folder, 'index.html')
+    return _frontend.response('index.html')
+
+
+@app.route('/<path:filename>')
+def frontend(filename: str):
+    return _frontend.response(filename)
 
 
 @app.route('/api/health')
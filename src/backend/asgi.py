@@ -0,0 +1,96 @@
+"""ASGI entry point: raster tiles on asyncio, every other route through Flask.
+
+    uvicorn src.backend.asgi:app --host 0.0.0.0 --port 5003 --workers 4
+
+Under WSGI each cold tile holds a gunicorn thread for the whole upstream
+round trip, so a slow upstream starves cache hits of threads.
+Here /api/tiles/raster/... is answered on the event loop: hits return
+straight from cache, misses await upstream and run PIL in the transform
+executor. The remaining routes run unchanged in a2wsgi's thread pool.
+
+A raster request whose client disconnects before the response is ready
+is cancelled: a miss still queued in the scheduler gives way to tiles
+somebody is waiting for (see scheduler.py), and nothing is sent.
+"""
+
+import asyncio
+import logging
+import os
+
+from a2wsgi import WSGIMiddleware
+from werkzeug.wrappers import Response
+
+from . import tiles, upstream
+from .app import add_cors, app as flask_app
+
+log = logging.getLogger(__name__)
+
+_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '10'))
+
+_wsgi = WSGIMiddleware(flask_app, workers=_WSGI_THREADS)
+
+
+async def app(scope, receive, send) -> None:
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    match = None
+    if scope['type'] == 'http' and scope['method'] in ('GET', 'HEAD'):
+        match = tiles.RASTER_PATH.fullmatch(scope['path'])
+    if match is None:
+        await _wsgi(scope, receive, send)
+        return
+
+    environ = _environ(scope)
+    vibe, z, x, y = match[1], int(match[2]), int(match[3]), int(match[4])
+    tile = asyncio.ensure_future(tiles.raster_async(vibe, z, x, y, environ))
+    gone = asyncio.ensure_future(_disconnected(receive))
+    await asyncio.wait((tile, gone), return_when=asyncio.FIRST_COMPLETED)
+    gone.cancel()
+    if not tile.done():
+        tile.cancel()
+        return
+    await _send(send, add_cors(tile.result()), environ)
+
+
+async def _disconnected(receive) -> None:
+    """Return once the client has gone away."""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+def _environ(scope: dict) -> dict:
+    """The slice of a WSGI environ that negotiation and conditional responses read."""
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'PATH_INFO': scope['path'],
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+    }
+    for name, value in scope['headers']:
+        key = 'HTTP_' + name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+
+async def _send(send, resp: Response, environ: dict) -> None:
+    # get_app_iter drops the body for HEAD and 304.
+    body = b''.join(resp.get_app_iter(environ))
+    await send({
+        'type': 'http.response.start',
+        'status': resp.status_code,
+        'headers': [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in resp.headers.items()],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await upstream.aclose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
@@ -0,0 +1,114 @@
+"""Small static files served from memory: sprite sheets, glyph ranges, the frontend.
+
+Each directory is read once, at import, into an AssetIndex: every file's
+bytes, content-hash ETag and (for compressible types) gzip/brotli
+variants, keyed by its path relative to the directory. Serving one is a
+dict lookup, and a name that isn't in the index is a 404 without touching
+the filesystem. URLs carrying the directory's asset_version() as ?v= are
+served immutable. Files changed on disk are picked up on restart.
+
+An index given a sendfile location hands the files themselves to the
+front proxy when SENDFILE is set (see httpcache.py); the index is still
+what decides between 200 and 404.
+"""
+
+import logging
+import mimetypes
+from pathlib import Path
+from typing import NamedTuple
+
+from flask import Response, abort, request
+
+from .httpcache import (
+    SENDFILE, asset_version, content_etag, encoded_response, precompress, sendfile_response,
+)
+
+log = logging.getLogger(__name__)
+
+_MIMETYPES = {
+    '.pbf':  'application/x-protobuf',
+    '.json': 'application/json',
+    '.js':   'text/javascript',
+    '.css':  'text/css',
+    '.html': 'text/html',
+    '.png':  'image/png',
+}
+# Already-compressed formats aren't worth a gzip/brotli variant.
+_PRECOMPRESSED = ('image/png', 'image/jpeg', 'image/webp', 'image/avif', 'font/woff2')
+# Every worker compresses every file at startup: brotli 9 is ~6x faster
+# than 11 on the glyph PBFs for ~8% larger output.
+_BROTLI_QUALITY = 9
+
+
+class Asset(NamedTuple):
+    body: bytes
+    mimetype: str
+    etag: str
+    encodings: dict[str, bytes]   # content-coding -> body, only those that shrink it
+
+
+class AssetIndex:
+    """Every file under directory, loaded and compressed up front; endpoint picks the TTL.
+
+    location is directory's URI under SENDFILE_PREFIX (e.g. 'static/sprites'),
+    for indexes whose files may be sent by the front proxy.
+    """
+
+    def __init__(self, directory: Path, endpoint: str, location: str | None = None) -> None:
+        self.directory = directory
+        self.endpoint = endpoint
+        self.location = location if SENDFILE else None
+        self.version = ''
+        self._assets: dict[str, Asset] = {}
+        if not directory.is_dir():
+            log.warning('asset directory %s is missing; serving nothing from it', directory)
+            return
+        self.version = asset_version(directory)
+        for path in sorted(directory.rglob('*')):
+            if path.is_file() and not path.name.startswith('.'):
+                name = path.relative_to(directory).as_posix()
+                self._assets[name] = _asset(path.read_bytes(), _mimetype(path))
+
+    def get(self, name: str) -> Asset | None:
+        return self._assets.get(name)
+
+    def response(self, name: str) -> Response:
+        """The asset as a cacheable response in the best encoding the client takes; 404 if absent."""
+        asset = self._assets.get(name)
+        if asset is None:
+            abort(404)
+        if self.location is not None:
+            return sendfile_response(self.directory / name, f'{self.location}/{name}', asset.mimetype,
+                                     self.endpoint, immutable=bool(self.version)
+                                     and request.args.get('v') == self.version)
+        return encoded_response(asset.body, asset.encodings, asset.mimetype, self.endpoint,
+                                etag=asset.etag, version=self.version)
+
+    def link_versions(self, name: str) -> None:
+        """Point name's quoted references to the other assets at their ?v= URLs.
+
+        For a page like index.html, which is itself served revalidated,
+        so its scripts and stylesheets can be cached immutable.
+        """
+        page = self._assets.get(name)
+        if page is None or not self.version:
+            return
+        text = page.body.decode()
+        for other in self._assets:
+            if other != name:
+                text = text.replace(f'"{other}"', f'"{other}?v={self.version}"')
+        self._assets[name] = _asset(text.encode(), page.mimetype)
+
+    def stats(self) -> dict:
+        return {'files': len(self._assets), 'bytes': sum(len(a.body) for a in self._assets.values()),
+                'version': self.version}
+
+
+def _asset(body: bytes, mimetype: str) -> Asset:
+    encodings = {} if mimetype in _PRECOMPRESSED else precompress(body, _BROTLI_QUALITY)
+    return Asset(body, mimetype, content_etag(body), encodings)
+
+
+def _mimetype(path: Path) -> str:
+    return (_MIMETYPES.get(path.suffix.lower()) or mimetypes.guess_type(path.name)[0]
+            or 'application/octet-stream')
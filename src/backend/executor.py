@@ -0,0 +1,165 @@
+"""Where CPU-bound PIL transforms run: inline, or in a process pool.
+
+With TRANSFORM_EXECUTOR=process each HTTP worker hands transforms to its
+own pool of TRANSFORM_PROCESSES processes, so a worker's threads are no
+longer serialised on the GIL during cold misses. Tile bytes travel through
+shared memory in both directions; only block names and sizes are pickled.
+
+render_async() is the entry point for the ASGI app: it runs render() on a
+thread pool of its own, so transforms never occupy the event loop.
+"""
+
+import asyncio
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context, shared_memory
+from typing import Callable, TypeVar
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+_MODE      = os.environ.get('TRANSFORM_EXECUTOR', 'inline')
+_PROCESSES = int(os.environ.get('TRANSFORM_PROCESSES', '2'))
+
+# In process mode these threads only wait on the pool, so match its size.
+_threads = ThreadPoolExecutor(_PROCESSES if _MODE == 'process' else os.cpu_count() or 1,
+                              thread_name_prefix='transform')
+_pool: ProcessPoolExecutor | None = None
+_pool_pid: int | None = None
+_lock = threading.Lock()
+_stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'queue_depth': 0,
+          'wait_total': 0.0, 'run_total': 0.0}
+
+
+def render(vibes: list[str], img_bytes: bytes, fmt: str) -> dict[str, bytes]:
+    """Run transforms.transform_pil for the vibes, inline or in the pool; returns {vibe: bytes}."""
+    if _MODE != 'process':
+        return _timed_inline(vibes, img_bytes, fmt)
+
+    _count('submitted')
+    start = time.monotonic()
+    src = shared_memory.SharedMemory(create=True, size=max(1, len(img_bytes)))
+    try:
+        src.buf[:len(img_bytes)] = img_bytes
+        with _lock:
+            _stats['queue_depth'] += 1
+        try:
+            out_name, sizes, run_time = _get_pool().submit(
+                _render_shared, vibes, src.name, len(img_bytes), fmt
+            ).result()
+        finally:
+            with _lock:
+                _stats['queue_depth'] -= 1
+    except BrokenProcessPool:
+        log.exception('transform pool died; rendering inline')
+        _reset_pool()
+        _count('failed')
+        return _timed_inline(vibes, img_bytes, fmt)
+    except Exception:
+        _count('failed')
+        raise
+    finally:
+        src.close()
+        src.unlink()
+
+    out = shared_memory.SharedMemory(name=out_name)
+    try:
+        results, offset = {}, 0
+        for vibe, size in zip(vibes, sizes):
+            if size:
+                results[vibe] = bytes(out.buf[offset:offset + size])
+            offset += size
+    finally:
+        out.close()
+        out.unlink()
+
+    with _lock:
+        _stats['completed'] += 1
+        _stats['run_total'] += run_time
+        _stats['wait_total'] += time.monotonic() - start - run_time
+    return results
+
+
+async def render_async(vibes: list[str], img_bytes: bytes, fmt: str) -> dict[str, bytes]:
+    """render() off the event loop."""
+    return await run_async(render, vibes, img_bytes, fmt)
+
+
+async def run_async(fn: Callable[..., T], *args) -> T:
+    """Run other CPU-bound image work on the transform threads."""
+    return await asyncio.get_running_loop().run_in_executor(_threads, fn, *args)
+
+
+def _render_shared(vibes: list[str], src_name: str, size: int, fmt: str) -> tuple[str, list[int], float]:
+    """Pool side: read the input block, transform, return one output block for the parent to free."""
+    from .transforms import transform_pil
+
+    start = time.monotonic()
+    src = shared_memory.SharedMemory(name=src_name)
+    try:
+        rendered = transform_pil(vibes, bytes(src.buf[:size]), fmt)
+    finally:
+        src.close()
+    tiles = [rendered.get(vibe, b'') for vibe in vibes]
+    out = shared_memory.SharedMemory(create=True, size=max(1, sum(map(len, tiles))))
+    offset = 0
+    for tile in tiles:
+        out.buf[offset:offset + len(tile)] = tile
+        offset += len(tile)
+    out.close()
+    return out.name, [len(t) for t in tiles], time.monotonic() - start
+
+
+def _timed_inline(vibes: list[str], img_bytes: bytes, fmt: str) -> dict[str, bytes]:
+    from .transforms import transform_pil
+
+    start = time.monotonic()
+    results = transform_pil(vibes, img_bytes, fmt)
+    with _lock:
+        _stats['completed'] += 1
+        _stats['run_total'] += time.monotonic() - start
+    return results
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        with _lock:
+            if _pool is None or _pool_pid != os.getpid():
+                # spawn, not fork: the HTTP worker is multi-threaded.
+                _pool = ProcessPoolExecutor(_PROCESSES, mp_context=get_context('spawn'))
+                _pool_pid = os.getpid()
+    return _pool
+
+
+def _reset_pool() -> None:
+    global _pool
+    with _lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _count(key: str) -> None:
+    with _lock:
+        _stats[key] += 1
+
+
+def stats() -> dict:
+    with _lock:
+        done = _stats['completed'] or 1
+        return {
+            'mode': _MODE,
+            'processes': _PROCESSES if _MODE == 'process' else 0,
+            'submitted': _stats['submitted'],
+            'completed': _stats['completed'],
+            'failed': _stats['failed'],
+            'queue_depth': _stats['queue_depth'],
+            'avg_wait_ms': round(1000 * _stats['wait_total'] / done, 2),
+            'avg_run_ms': round(1000 * _stats['run_total'] / done, 2),
+        }
@@ -1,21 +1,19 @@
-"""Serve pre-generated SDF glyph PBF files for per-vibe custom fonts."""
+"""Serve pre-generated SDF glyph PBF files for per-vibe custom fonts, from memory."""
 
-import logging
 from pathlib import Path
 
-from flask import Blueprint, abort, send_from_directory
+from flask import Blueprint
 
-log = logging.getLogger(__name__)
+from .assets import AssetIndex
 
 glyphs_bp = Blueprint('glyphs', __name__, url_prefix='/api/glyphs')
 
 _GLYPHS_DIR = Path(__file__).parent.parent / 'static' / 'glyphs'
+# Every range of every fontstack, so a map load's dozens of range requests
+# are dict lookups and unknown fonts or ranges 404 without a filesystem probe.
+_glyphs = AssetIndex(_GLYPHS_DIR, 'glyphs', location='static/glyphs')
 
 
 @glyphs_bp.route('/<fontstack>/<range_str>.pbf')
 def glyphs(fontstack: str, range_str: str) -> object:
-    font_dir = _GLYPHS_DIR / fontstack
-    if not font_dir.is_dir():
-        abort(404)
-    filename = f'{range_str}.pbf'
-    return send_from_directory(font_dir, filename, mimetype='application/x-protobuf')
+    return _glyphs.response(f'{fontstack}/{range_str}.pbf')
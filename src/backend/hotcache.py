@@ -0,0 +1,196 @@
+"""In-memory tier for encoded tiles, in front of the disk cache.
+
+By default each worker keeps its own byte-budgeted LRU. Setting
+TILE_HOT_CACHE_SHM to a path (ideally on tmpfs, e.g. /dev/shm/tile_hot_cache)
+switches to one direct-mapped slab that every gunicorn worker mmaps, so
+the budget is spent once per host instead of once per worker.
+
+NegativeCache remembers, per worker and for a TTL, tiles upstream could
+not serve, so repeated requests for them don't go upstream again.
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Hashable
+
+try:
+    import fcntl
+except ImportError:  # not POSIX -- no shared slab
+    fcntl = None  # type: ignore[assignment]
+
+log = logging.getLogger(__name__)
+
+_MAX_BYTES  = int(float(os.environ.get('TILE_HOT_CACHE_MB', '64')) * 1024 * 1024)
+_SHM_PATH   = os.environ.get('TILE_HOT_CACHE_SHM', '')
+_SLOT_BYTES = int(os.environ.get('TILE_HOT_CACHE_SLOT_KB', '192')) * 1024
+
+
+class LRUCache:
+    """Per-process LRU of tile bytes, bounded by total payload size."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self._items: OrderedDict[str, bytes] = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            data = self._items.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            self._items[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            'kind': 'lru', 'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'entries': len(self._items),
+            'bytes': self._bytes, 'max_bytes': self.max_bytes,
+        }
+
+
+# Slot header: seqlock counter (odd while a write is in progress), key hash, payload length.
+_HEADER = struct.Struct('<QQI4x')
+
+
+class SharedSlabCache:
+    """Direct-mapped tile cache in an mmapped file shared by all workers.
+
+    Each key hashes to one fixed-size slot; a newer tile simply replaces
+    whatever was there. Writers take a thread lock, then an fcntl lock on
+    the slot's byte range (which only keeps out other processes); readers
+    never lock, and a read torn by a concurrent write (seqlock
+    changed) counts as a miss. Counters are per process.
+    """
+
+    def __init__(self, path: str, max_bytes: int, slot_bytes: int) -> None:
+        self.slot_bytes = slot_bytes
+        self._stride = _HEADER.size + slot_bytes
+        self.slots = max(1, max_bytes // self._stride)
+        size = self.slots * self._stride
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self._fd).st_size < size:
+            os.ftruncate(self._fd, size)
+        self._mm = mmap.mmap(self._fd, size)
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    def _slot(self, key: str) -> tuple[int, int]:
+        digest = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+        return (digest % self.slots) * self._stride, digest | 1   # 0 marks an empty slot
+
+    def get(self, key: str) -> bytes | None:
+        off, key_hash = self._slot(key)
+        seq, slot_hash, length = _HEADER.unpack_from(self._mm, off)
+        data = None
+        if not seq & 1 and slot_hash == key_hash and length <= self.slot_bytes:
+            start = off + _HEADER.size
+            data = self._mm[start:start + length]
+            if _HEADER.unpack_from(self._mm, off)[0] != seq:
+                data = None   # overwritten while we were copying
+        if data is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        if len(data) > self.slot_bytes:
+            return
+        off, key_hash = self._slot(key)
+        with self._lock:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, self._stride, off)
+            try:
+                seq, slot_hash, _ = _HEADER.unpack_from(self._mm, off)
+                if slot_hash not in (0, key_hash):
+                    self.evictions += 1
+                _HEADER.pack_into(self._mm, off, seq | 1, 0, 0)
+                start = off + _HEADER.size
+                self._mm[start:start + len(data)] = data
+                _HEADER.pack_into(self._mm, off, (seq | 1) + 1, key_hash, len(data))
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, self._stride, off)
+
+    def stats(self) -> dict:
+        return {
+            'kind': 'shared', 'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'slots': self.slots,
+            'slot_bytes': self.slot_bytes, 'max_bytes': self.slots * self._stride,
+        }
+
+
+class NegativeCache:
+    """Per-process record of tiles upstream couldn't serve, each with its own TTL.
+
+    An entry says whether the tile is missing (upstream 4xx) or failing
+    (5xx, unreachable); the oldest entries go first past max_entries.
+    """
+
+    def __init__(self, max_entries: int = 100_000) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[Hashable, tuple[float, bool]] = OrderedDict()   # expiry, missing
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def get(self, key: Hashable) -> tuple[bool, float] | None:
+        """(missing, seconds left) while the key has a live entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, missing = entry
+            left = expires - time.monotonic()
+            if left <= 0:
+                del self._entries[key]
+                return None
+            self.hits += 1
+            return missing, left
+
+    def put(self, key: Hashable, missing: bool, ttl: float) -> None:
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() + ttl, missing)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'hits': self.hits, 'max_entries': self.max_entries}
+
+
+def create() -> LRUCache | SharedSlabCache:
+    """Build the hot-tile cache configured by the environment."""
+    if _SHM_PATH and _MAX_BYTES > 0:
+        if fcntl is None:
+            log.warning('TILE_HOT_CACHE_SHM needs POSIX file locks; using a per-worker LRU')
+        else:
+            try:
+                return SharedSlabCache(_SHM_PATH, _MAX_BYTES, _SLOT_BYTES)
+            except OSError:
+                log.exception('shared hot cache unavailable at %s; using a per-worker LRU', _SHM_PATH)
+    return LRUCache(_MAX_BYTES)
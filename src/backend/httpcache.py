@@ -0,0 +1,125 @@
+"""HTTP caching policy shared by the tile, sprite and glyph blueprints and the frontend.
+
+Every response carries a content-hash ETag (so If-None-Match gets a 304)
+and a Cache-Control max-age tuned per endpoint. URLs that carry the current
+asset version as ?v=... are served immutable for a year. Bodies that are
+served often can be compressed once with precompress() and sent with
+encoded_response(), which picks a variant from Accept-Encoding.
+
+With SENDFILE set, responses for files on disk can instead be an empty
+sendfile_response() that tells the front proxy to send the file itself:
+'x-accel-redirect' (nginx) names an internal URI under SENDFILE_PREFIX,
+'x-sendfile' (Apache mod_xsendfile, lighttpd) the file's absolute path.
+The proxy then answers conditional requests and compresses on its own.
+"""
+
+import gzip
+import hashlib
+import logging
+import os
+from functools import lru_cache
+from pathlib import Path
+
+from flask import Response, request
+
+try:
+    import brotli
+except ImportError:  # optional -- gzip only
+    brotli = None  # type: ignore[assignment]
+
+_TTLS: dict[str, int] = {
+    'style':   int(os.environ.get('CACHE_TTL_STYLE', '300')),
+    'raster':  int(os.environ.get('CACHE_TTL_RASTER', '86400')),
+    'sprites': int(os.environ.get('CACHE_TTL_SPRITES', '3600')),
+    'glyphs':  int(os.environ.get('CACHE_TTL_GLYPHS', '86400')),
+    'frontend': int(os.environ.get('CACHE_TTL_FRONTEND', '300')),
+}
+_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+log = logging.getLogger(__name__)
+
+SENDFILE = os.environ.get('SENDFILE', '').lower()
+_SENDFILE_PREFIX = os.environ.get('SENDFILE_PREFIX', '/_sendfile/')
+if SENDFILE not in ('', 'x-accel-redirect', 'x-sendfile'):
+    log.warning('unknown SENDFILE=%r; sending files from Python', SENDFILE)
+    SENDFILE = ''
+
+
+def content_etag(body: bytes) -> str:
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def asset_version(directory: Path) -> str:
+    """Short hash over every file under directory, for ?v= cache busting."""
+    digest = hashlib.blake2b(digest_size=6)
+    for path in sorted(p for p in directory.rglob('*') if p.is_file()):
+        digest.update(str(path.relative_to(directory)).encode())
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def precompress(body: bytes, brotli_quality: int = 11) -> dict[str, bytes]:
+    """Compress body once per supported content-coding, keeping only variants that shrink it."""
+    encodings = {'gzip': gzip.compress(body, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        encodings['br'] = brotli.compress(body, quality=brotli_quality)
+    return {coding: data for coding, data in encodings.items() if len(data) < len(body)}
+
+
+def encoded_response(body: bytes, encodings: dict[str, bytes], mimetype: str, endpoint: str, *,
+                     etag: str | None = None, version: str | None = None) -> Response:
+    """cached_response() sending the smallest pre-encoded variant the client accepts."""
+    etag = etag or content_etag(body)
+    accepted = [c for c in encodings if request.accept_encodings[c] > 0]
+    coding = min(accepted, key=lambda c: len(encodings[c]), default=None)
+    if coding is None:
+        resp = cached_response(body, mimetype, endpoint, etag=etag, version=version)
+    else:
+        # Each encoding is its own representation, so it gets its own ETag.
+        resp = cached_response(encodings[coding], mimetype, endpoint,
+                               etag=f'{etag}-{coding}', version=version)
+        resp.content_encoding = coding
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def cached_response(body: bytes, mimetype: str, endpoint: str, *,
+                    etag: str | None = None, version: str | None = None) -> Response:
+    """Build a cacheable response, or a 304 if the client's ETag still matches."""
+    immutable = bool(version) and request.args.get('v') == version
+    return conditional_response(body, mimetype, endpoint, request.environ,
+                                etag=etag, immutable=immutable)
+
+
+def conditional_response(body: bytes, mimetype: str, endpoint: str, environ: dict, *,
+                         etag: str | None = None, immutable: bool = False) -> Response:
+    """cached_response() against a bare WSGI environ, for use outside a Flask request."""
+    resp = Response(body, mimetype=mimetype)
+    resp.set_etag(etag or content_etag(body))
+    _cache_control(resp, endpoint, immutable)
+    return resp.make_conditional(environ)
+
+
+def sendfile_response(path: Path, location: str, mimetype: str, endpoint: str, *,
+                      immutable: bool = False) -> Response:
+    """An empty response handing path to the front proxy (see SENDFILE), with the endpoint's Cache-Control.
+
+    location is the file's URI under SENDFILE_PREFIX, e.g. 'tiles/raster/noir/5/3/4.webp'.
+    """
+    resp = Response(mimetype=mimetype)
+    if SENDFILE == 'x-sendfile':
+        resp.headers['X-Sendfile'] = str(path.absolute())
+    else:
+        resp.headers['X-Accel-Redirect'] = _SENDFILE_PREFIX + location
+    _cache_control(resp, endpoint, immutable)
+    return resp
+
+
+def _cache_control(resp: Response, endpoint: str, immutable: bool) -> None:
+    resp.cache_control.public = True
+    if immutable:
+        resp.cache_control.max_age = _IMMUTABLE_MAX_AGE
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.max_age = _TTLS[endpoint]
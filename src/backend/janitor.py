@@ -0,0 +1,231 @@
+"""Keep the disk tile cache within its size budgets.
+
+TILE_CACHE_MAX_MB caps the whole cache; TILE_CACHE_VIBE_MAX_MB caps each
+vibe's raster layer, either one figure for every vibe or per vibe
+("200,noir=500,mario=50"). Tiles at TILE_CACHE_PIN_ZOOM and shallower
+are never evicted; deeper ones go least recently read first. Upstream
+tiles and stored AI results (ai/<vibe>) count towards TILE_CACHE_MAX_MB
+only. Every read of an AI vibe's tile is also noted as a read of its AI
+result, so the result is not evicted while the tile is still in use.
+
+Reads are only noted in memory. About once a minute each worker writes
+its batch of last-read times to the store (file atime, or the MBTiles
+last_access column), so a hit never costs a disk write. Every
+TILE_CACHE_JANITOR_INTERVAL seconds one worker -- whichever takes the
+lock file first -- sweeps: it sums each layer's bytes by how long ago
+they were read, works out how far back to evict to get under every
+budget, then deletes what is older, along with any deduplicated blob or
+MBTiles image no tile uses any more (see tilestore.py). scripts/cache_janitor.py runs
+the same sweep by hand.
+"""
+
+import logging
+import os
+import threading
+import time
+from typing import NamedTuple
+
+from . import metrics
+
+try:
+    import fcntl
+except ImportError:  # not POSIX -- every worker sweeps on its own schedule
+    fcntl = None  # type: ignore[assignment]
+
+log = logging.getLogger(__name__)
+
+_FLUSH_EVERY = 60.0
+_BUCKET      = 600.0   # last-read resolution when choosing what to evict
+
+
+def parse_budgets(value: str) -> dict[str, int]:
+    """'200,noir=500' -> {'': 200 MB, 'noir': 500 MB}; '' is every other vibe."""
+    budgets = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        vibe, _, mb = item.rpartition('=')
+        budgets[vibe.strip()] = int(float(mb) * 1024 * 1024)
+    return budgets
+
+
+_MAX_BYTES    = int(float(os.environ.get('TILE_CACHE_MAX_MB', '0')) * 1024 * 1024)
+_VIBE_BUDGETS = parse_budgets(os.environ.get('TILE_CACHE_VIBE_MAX_MB', ''))
+_PIN_ZOOM     = int(os.environ.get('TILE_CACHE_PIN_ZOOM', '4'))
+_INTERVAL     = float(os.environ.get('TILE_CACHE_JANITOR_INTERVAL', '300'))
+
+
+class SweepStats(NamedTuple):
+    usage: dict[str, int]   # bytes per layer before the sweep
+    freed: dict[str, int]   # bytes evicted per layer (what would be, on a dry run)
+    evicted: int            # tiles evicted (0 on a dry run)
+
+
+class Janitor:
+    """Notes tile reads and sweeps a tilestore back under its budgets.
+
+    Does nothing unless some budget is set. interval=0 keeps recording
+    reads but leaves sweeping to the CLI.
+    """
+
+    def __init__(self, store, max_bytes: int = _MAX_BYTES,
+                 vibe_budgets: dict[str, int] = _VIBE_BUDGETS, pin_zoom: int = _PIN_ZOOM,
+                 interval: float = _INTERVAL) -> None:
+        self.store = store
+        self.max_bytes = max_bytes
+        self.vibe_budgets = vibe_budgets
+        self.pin_zoom = pin_zoom
+        self.interval = interval
+        self.enabled = bool(max_bytes or any(vibe_budgets.values()))
+        self.last_sweep: SweepStats | None = None
+        self._accessed: dict[tuple[str, str, int, int, int], float] = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._pid = 0
+
+    def record(self, layer: str, z: int, x: int, y: int, fmt: str = 'png') -> None:
+        """Note that a cached tile was read; written to the store on the next flush."""
+        if not self.enabled:
+            return
+        if self._pid != os.getpid():
+            self._start()
+        with self._lock:
+            self._accessed[layer, fmt, z, x, y] = time.time()
+
+    def wake(self) -> None:
+        """Sweep now rather than at the next interval (e.g. after a failed write)."""
+        if self.enabled and self.interval:
+            self._wake.set()
+
+    def flush(self) -> None:
+        with self._lock:
+            accessed, self._accessed = self._accessed, {}
+        batches: dict[tuple[str, str], list] = {}
+        for (layer, fmt, z, x, y), when in accessed.items():
+            batches.setdefault((layer, fmt), []).append((z, x, y, when))
+        for (layer, fmt), accesses in batches.items():
+            try:
+                self.store.touch(layer, fmt, accesses)
+            except Exception:
+                log.warning('recording reads for %s failed', layer, exc_info=True)
+
+    def sweep(self, dry_run: bool = False) -> SweepStats:
+        """Evict the least recently read unpinned tiles until every budget is met."""
+        self.flush()
+        min_zoom = self.pin_zoom + 1
+        usage = {layer: self.store.usage(layer, min_zoom, _BUCKET) for layer in self.store.layers()}
+
+        # Evict buckets older than cutoffs[layer]: first to meet each layer's
+        # own budget, then moved forward together until the total fits too.
+        cutoffs: dict[str, int] = {}
+        for layer, (total, by_age) in usage.items():
+            budget = self._budget(layer)
+            if budget and total > budget:
+                cutoffs[layer] = _cutoff(layer, by_age, total - budget)
+        if self.max_bytes:
+            excess = sum(total for total, _ in usage.values()) - self.max_bytes
+            remaining: dict[int, int] = {}
+            for layer, (_, by_age) in usage.items():
+                for age, size in by_age.items():
+                    if age < cutoffs.get(layer, 0):
+                        excess -= size
+                    else:
+                        remaining[age] = remaining.get(age, 0) + size
+            if excess > 0:
+                overall = _cutoff('cache', remaining, excess)
+                cutoffs = {layer: max(cutoffs.get(layer, 0), overall) for layer in usage}
+
+        freed: dict[str, int] = {}
+        evicted = 0
+        for layer, cutoff in cutoffs.items():
+            if dry_run:
+                freed[layer] = sum(size for age, size in usage[layer][1].items() if age < cutoff)
+                continue
+            tiles, freed[layer] = self.store.evict(layer, min_zoom, cutoff * _BUCKET)
+            evicted += tiles
+            metrics.CACHE_EVICTED.labels(layer).inc(tiles)
+        if not dry_run:
+            self.store.prune()   # blobs/images left without tiles by this sweep or by overwrites
+        for layer, (total, _) in usage.items():
+            metrics.CACHE_BYTES.labels(layer).set(total - freed.get(layer, 0))
+
+        stats = self.last_sweep = SweepStats({layer: total for layer, (total, _) in usage.items()},
+                                             freed, evicted)
+        if evicted:
+            log.info('cache janitor evicted %d tiles (%.1f MB)', evicted, sum(freed.values()) / 2**20)
+        return stats
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._accessed)
+        last = self.last_sweep
+        return {
+            'enabled': self.enabled,
+            'max_bytes': self.max_bytes,
+            'vibe_budgets': self.vibe_budgets,
+            'pin_zoom': self.pin_zoom,
+            'pending_reads': pending,
+            'last_sweep': last and {'bytes': sum(last.usage.values()), 'freed': sum(last.freed.values()),
+                                    'evicted': last.evicted},
+        }
+
+    def _budget(self, layer: str) -> int:
+        if not layer.startswith('raster/'):
+            return 0
+        vibe = layer.removeprefix('raster/')
+        return self.vibe_budgets.get(vibe, self.vibe_budgets.get('', 0))
+
+    def _start(self) -> None:
+        # Threads don't survive a fork, so each worker starts its own.
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._accessed = {}
+        threading.Thread(target=self._run, name='cache-janitor', daemon=True).start()
+
+    def _run(self) -> None:
+        next_sweep = time.monotonic() + (_FLUSH_EVERY if self.interval else float('inf'))
+        while True:
+            woken = self._wake.wait(_FLUSH_EVERY)
+            self._wake.clear()
+            try:
+                self.flush()
+                if woken or time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + self.interval
+                    self._sweep_once_per_interval(force=woken)
+            except Exception:
+                log.warning('cache janitor failed', exc_info=True)
+
+    def _sweep_once_per_interval(self, force: bool) -> None:
+        """Sweep unless another worker holds the lock or swept within the interval."""
+        if fcntl is None:
+            self.sweep()
+            return
+        path = self.store.root / '.janitor.lock'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'a+') as f:   # holds the time of the last sweep by any worker
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            f.seek(0)
+            try:
+                swept_at = float(f.read() or 0)
+            except ValueError:
+                swept_at = 0.0
+            if not force and time.time() - swept_at < self.interval * 0.9:
+                return
+            self.sweep()
+            f.truncate(0)
+            f.write(str(time.time()))
+
+
+def _cutoff(name: str, by_age: dict[int, int], excess: int) -> int:
+    """The oldest bucket to keep so that evicting everything before it frees excess bytes."""
+    freed = 0
+    for age in sorted(by_age):
+        freed += by_age[age]
+        if freed >= excess:
+            return age + 1
+    log.warning('%s is over budget by %.1f MB in pinned tiles alone (z <= pin zoom)',
+                name, (excess - freed) / 2**20)
+    return max(by_age, default=-1) + 1
@@ -0,0 +1,99 @@
+"""Prometheus metrics for the tile pipeline, served at /metrics.
+
+Each stage of a raster request is timed separately (hot and disk cache
+lookup, upstream fetch, decode, per-vibe transform, encode, cache write,
+response), and every request is counted by vibe, zoom and where it was
+answered from.
+
+Metrics are per process unless PROMETHEUS_MULTIPROC_DIR points at an
+empty directory shared by all gunicorn workers (and the transform pool);
+then /metrics aggregates across them. See prometheus_client's
+multiprocess docs for clearing that directory on start.
+"""
+
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from flask import Blueprint, Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest,
+)
+
+metrics_bp = Blueprint('metrics', __name__)
+
+_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR', '')
+
+# Tile stages run from ~100 us (hot lookups) to seconds (upstream, AI).
+_STAGE_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                  0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+STAGE_SECONDS = Histogram(
+    'tile_stage_seconds', 'Time spent in each stage of serving a raster tile',
+    ['stage'], buckets=_STAGE_BUCKETS,
+)
+TRANSFORM_SECONDS = Histogram(
+    'tile_transform_seconds', 'PIL transform time per vibe, excluding decode and encode',
+    ['vibe'], buckets=_STAGE_BUCKETS,
+)
+REQUESTS = Counter(
+    'tile_requests_total',
+    'Raster requests by vibe, zoom and outcome (hot, disk, synthesized, rendered, missing, error)',
+    ['vibe', 'zoom', 'result'],
+)
+FLAT_TILES = Counter(
+    'tile_flat_total', 'Single-colour tiles answered from the flat-tile table instead of a PIL render',
+    ['vibe'],
+)
+UPSTREAM_RESPONSES = Counter(
+    'upstream_responses_total', 'Upstream responses by client and HTTP status (or "error")',
+    ['client', 'status'],
+)
+AI_TRANSFORMS = Counter(
+    'ai_transforms_total',
+    'Queued AI transforms by vibe and outcome (ok; fallback or dropped: the PIL tile was kept)',
+    ['vibe', 'result'],
+)
+AI_QUEUE_DEPTH = Gauge(
+    'ai_queue_depth', 'Tiles queued for or waiting on the AI service',
+    multiprocess_mode='livesum',
+)
+SCHEDULER_EVENTS = Counter(
+    'tile_scheduler_events_total',
+    'Tile misses that queued for a render slot, were abandoned while queued, detached'
+    ' (client left mid-render), or were backgrounded or dropped as background fill',
+    ['event'],
+)
+STYLE_BUILD_SECONDS = Histogram(
+    'style_build_seconds', 'Time to build, serialize and compress a vibe style',
+    ['vibe'], buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 15.0),
+)
+CACHE_BYTES = Gauge(
+    'tile_cache_bytes', 'Disk cache bytes per layer, as of the last janitor sweep',
+    ['layer'], multiprocess_mode='mostrecent',
+)
+CACHE_EVICTED = Counter(
+    'tile_cache_evicted_total', 'Tiles evicted from the disk cache by the janitor',
+    ['layer'],
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Time the enclosed block into tile_stage_seconds{stage=name}."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+@metrics_bp.route('/metrics')
+def metrics():
+    registry = REGISTRY
+    if _MULTIPROC_DIR:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), content_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,217 @@
+"""Order tile misses by how much somebody still wants them.
+
+A worker renders at most TILE_RENDER_SLOTS misses at a time (0: no limit,
+no scheduling). A WSGI worker can only queue misses if it has more request
+threads than slots, so under gunicorn.conf.py the default is one slot
+fewer than --threads, leaving a thread for hits. Waiting misses get a free slot newest burst first --
+requests within TILE_SCHED_BURST_MS of each other count as one viewport's
+worth -- and deepest zoom first within a burst, so when a user pans or
+zooms quickly the tiles on screen now overtake the ones the map has
+already given up on.
+
+On the ASGI app a miss whose client disconnects while it is still waiting
+gives up its place and is queued again as background fill, behind all
+client work (and dropped if TILE_BACKGROUND_MAX fills are already
+waiting). A miss that has started when its client leaves runs to the end,
+so the tile still reaches the cache. Under WSGI a disconnect can't be
+seen, so misses are only ordered.
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from . import metrics
+
+T = TypeVar('T')
+
+_SLOTS          = int(os.environ.get('TILE_RENDER_SLOTS', '8'))
+_BURST          = float(os.environ.get('TILE_SCHED_BURST_MS', '100')) / 1000
+_BACKGROUND_MAX = int(os.environ.get('TILE_BACKGROUND_MAX', '256'))
+
+_CLIENT, _BACKGROUND = 0, 1
+
+
+class _Entry:
+    __slots__ = ('rank', 'key', 'wake', 'fill', 'dead')
+
+    def __init__(self, rank: tuple, key: Hashable = None, wake=None,
+                 fill: Callable[[], Awaitable[None]] | None = None) -> None:
+        self.rank = rank
+        self.key = key
+        self.wake = wake      # threading.Event or asyncio.Future, set when granted a slot
+        self.fill = fill      # background fill: started when granted, nobody waits on it
+        self.dead = False
+
+    def __lt__(self, other: '_Entry') -> bool:
+        return self.rank < other.rank
+
+
+def _rank(kind: int, z: int, seq: int) -> tuple:
+    burst = int(time.monotonic() / _BURST) if _BURST > 0 else 0
+    return kind, -burst, -z, -seq
+
+
+def _count(event: str) -> None:
+    metrics.SCHEDULER_EVENTS.labels(event).inc()
+
+
+class Scheduler:
+    """Render slots for WSGI request threads: ordering only."""
+
+    def __init__(self, slots: int = _SLOTS) -> None:
+        self.slots = slots
+        self._free = slots
+        self._heap: list[_Entry] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def run(self, z: int, fn: Callable[[], T]) -> T:
+        """fn() once a slot is free; newer and deeper misses go first."""
+        if not self.slots:
+            return fn()
+        with self._lock:
+            entry = None
+            if self._free:
+                self._free -= 1
+            else:
+                entry = _Entry(_rank(_CLIENT, z, next(self._seq)), wake=threading.Event())
+                heapq.heappush(self._heap, entry)
+        if entry is not None:
+            _count('queued')
+            entry.wake.wait()
+        try:
+            return fn()
+        finally:
+            self._release()
+
+    def resize(self, slots: int) -> None:
+        """Change the number of slots; only while idle, e.g. in a freshly forked worker."""
+        with self._lock:
+            self._free += slots - self.slots
+            self.slots = slots
+
+    def _release(self) -> None:
+        with self._lock:
+            if self._heap:
+                heapq.heappop(self._heap).wake.set()   # the slot passes straight on
+            else:
+                self._free += 1
+
+    def stats(self) -> dict:
+        return {'slots': self.slots, 'free': self._free, 'queued': len(self._heap)}
+
+
+class AsyncScheduler:
+    """Render slots for the ASGI app's event loop, with cancellation and background fill.
+
+    Not thread-safe: use it from one event loop.
+    """
+
+    def __init__(self, slots: int = _SLOTS, background_max: int = _BACKGROUND_MAX) -> None:
+        self.slots = slots
+        self.background_max = background_max
+        self._free = slots
+        self._heap: list[_Entry] = []
+        self._waiting: dict[Hashable, _Entry] = {}
+        self._background = 0
+        self._seq = itertools.count()
+
+    async def run(self, key: Hashable, z: int, fn: Callable[[], Awaitable[T]],
+                  abandoned: Callable[[], Awaitable[None]] | None = None) -> T:
+        """Await fn() once a slot is free; newer and deeper misses go first.
+
+        If the caller is cancelled while waiting, abandoned (if given) is
+        queued as background fill for key. Once fn has started it is
+        shielded: cancelling the caller leaves it to finish on its own.
+        """
+        if not self.slots:
+            return await fn()
+        if self._free:
+            self._free -= 1
+        else:
+            entry = _Entry(_rank(_CLIENT, z, next(self._seq)), key,
+                           wake=asyncio.get_running_loop().create_future())
+            self._push(entry)
+            _count('queued')
+            try:
+                await entry.wake
+            except asyncio.CancelledError:
+                if entry.wake.done() and not entry.wake.cancelled():
+                    self._release()   # granted just as the client left
+                else:
+                    self._drop(entry)
+                _count('abandoned')
+                if abandoned is not None:
+                    self.background(key, z, abandoned)
+                raise
+
+        task = asyncio.ensure_future(fn())
+        task.add_done_callback(self._finished)
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done():
+                _count('detached')
+            raise
+
+    def background(self, key: Hashable, z: int, fill: Callable[[], Awaitable[None]]) -> None:
+        """Run fill() when no client work is waiting for a slot."""
+        if key in self._waiting:
+            return
+        entry = _Entry(_rank(_BACKGROUND, z, next(self._seq)), key, fill=fill)
+        if self._free:
+            self._free -= 1
+            _count('backgrounded')
+            self._grant(entry)
+            return
+        if self._background >= self.background_max:
+            _count('background_dropped')
+            return
+        self._background += 1   # counts queued fills only; _drop() takes them off again
+        _count('backgrounded')
+        self._push(entry)
+
+    def stats(self) -> dict:
+        return {'slots': self.slots, 'free': self._free, 'queued': len(self._waiting) - self._background,
+                'background_queued': self._background}
+
+    def _push(self, entry: _Entry) -> None:
+        old = self._waiting.get(entry.key)
+        if old is not None and old.fill is not None:
+            self._drop(old)   # a client wants it now: overtake the background fill
+        self._waiting[entry.key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def _drop(self, entry: _Entry) -> None:
+        entry.dead = True
+        if self._waiting.get(entry.key) is entry:
+            del self._waiting[entry.key]
+            if entry.fill is not None:
+                self._background -= 1
+
+    def _grant(self, entry: _Entry) -> None:
+        if entry.fill is None:
+            entry.wake.set_result(None)
+            return
+        task = asyncio.ensure_future(entry.fill())
+        task.add_done_callback(self._finished)
+
+    def _release(self) -> None:
+        while self._heap:
+            entry = heapq.heappop(self._heap)
+            if entry.dead or (entry.wake is not None and entry.wake.cancelled()):
+                continue
+            self._drop(entry)
+            self._grant(entry)   # the slot passes straight on
+            return
+        self._free += 1
+
+    def _finished(self, task: asyncio.Future) -> None:
+        if not task.cancelled():
+            task.exception()   # retrieved: a detached render's error was logged where it happened
+        self._release()
@@ -0,0 +1,195 @@
+"""Seed the tile cache for bounding boxes and zoom ranges, in-process.
+
+Tiles go through tiles.seed_tile(), the same fetch/transform/store path a
+client miss takes, so nothing is sent over HTTP. Tile coordinates are
+generated lazily, zoom by zoom, and only a bounded number are in flight, so
+a region at z14 costs no more memory than one at z2. Cached vibes are
+skipped, upstream requests are rate-limited, and progress is checkpointed
+to a file so a killed run resumes where it stopped.
+"""
+
+import hashlib
+import json
+import logging
+import math
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, Iterator, NamedTuple
+
+from .tiles import MAX_NATIVE_ZOOM, seed_tile, seed_vibes
+from .upstream import RateLimiter
+
+log = logging.getLogger(__name__)
+
+_MAX_LAT = 85.0511287798   # Web Mercator's limit
+_CHECKPOINT_EVERY = 5.0    # seconds
+
+WORLD = (-180.0, -_MAX_LAT, 180.0, _MAX_LAT)
+
+BBox = tuple[float, float, float, float]   # min lon, min lat, max lon, max lat
+
+
+class SeedStats(NamedTuple):
+    tiles: int      # z/x/y positions visited this run
+    written: int    # vibe tiles rendered and cached
+    skipped: int    # positions where every vibe was already cached
+    failed: int
+
+
+def tile_bounds(bbox: BBox, z: int) -> tuple[int, int, int, int]:
+    """Inclusive x0, y0, x1, y1 of the zoom-z tiles covering bbox."""
+    min_lon, min_lat, max_lon, max_lat = bbox
+    n = 1 << z
+
+    def tx(lon: float) -> int:
+        return min(n - 1, max(0, int((lon + 180.0) / 360.0 * n)))
+
+    def ty(lat: float) -> int:
+        lat = math.radians(max(-_MAX_LAT, min(_MAX_LAT, lat)))
+        return min(n - 1, max(0, int((1.0 - math.asinh(math.tan(lat)) / math.pi) / 2.0 * n)))
+
+    return tx(min_lon), ty(max_lat), tx(max_lon), ty(min_lat)
+
+
+def iter_tiles(bboxes: list[BBox], min_zoom: int, max_zoom: int) -> Iterator[tuple[int, int, int]]:
+    """Yield every z/x/y covering the boxes once, in a fixed order.
+
+    A box with min lon > max lon crosses the antimeridian and is split.
+    Tiles in the overlap of several boxes are yielded only for the first.
+    """
+    boxes: list[BBox] = []
+    for min_lon, min_lat, max_lon, max_lat in bboxes:
+        if min_lon > max_lon:
+            boxes += [(min_lon, min_lat, 180.0, max_lat), (-180.0, min_lat, max_lon, max_lat)]
+        else:
+            boxes.append((min_lon, min_lat, max_lon, max_lat))
+
+    for z in range(min_zoom, max_zoom + 1):
+        ranges = [tile_bounds(box, z) for box in boxes]
+        for i, (x0, y0, x1, y1) in enumerate(ranges):
+            earlier = ranges[:i]
+            for x in range(x0, x1 + 1):
+                for y in range(y0, y1 + 1):
+                    if not any(ex0 <= x <= ex1 and ey0 <= y <= ey1 for ex0, ey0, ex1, ey1 in earlier):
+                        yield z, x, y
+
+
+class _Checkpoint:
+    """Index of the first tile not yet finished, saved atomically as JSON.
+
+    Tiles finish out of order, so finished indices above the mark are held
+    until the gap below them closes. The job key ties the file to one set
+    of arguments; a file for a different job is ignored.
+    """
+
+    def __init__(self, path: Path | None, job: dict) -> None:
+        self.path = path
+        self.job = hashlib.blake2b(json.dumps(job, sort_keys=True).encode(), digest_size=8).hexdigest()
+        self.mark = 0
+        self._ahead: set[int] = set()
+        self._saved_at = time.monotonic()
+        if path is None:
+            return
+        try:
+            saved = json.loads(path.read_text())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            log.warning('checkpoint %s unreadable; starting over', path)
+            return
+        if saved.get('job') == self.job:
+            self.mark = int(saved['next'])
+        else:
+            log.warning('checkpoint %s is for a different job; starting over', path)
+
+    def done(self, index: int) -> None:
+        self._ahead.add(index)
+        while self.mark in self._ahead:
+            self._ahead.remove(self.mark)
+            self.mark += 1
+        if time.monotonic() - self._saved_at >= _CHECKPOINT_EVERY:
+            self.save()
+
+    def save(self) -> None:
+        self._saved_at = time.monotonic()
+        if self.path is None:
+            return
+        tmp = self.path.with_name(f'.{self.path.name}.{os.getpid()}')
+        tmp.write_text(json.dumps({'job': self.job, 'next': self.mark}))
+        os.replace(tmp, self.path)
+
+
+def seed(bboxes: list[BBox], min_zoom: int, max_zoom: int, vibes: list[str] | None = None,
+         fmt: str = 'png', *, workers: int = 4, rate: float = 10.0,
+         checkpoint: Path | None = None,
+         progress: Callable[[SeedStats], None] | None = None) -> SeedStats:
+    """Fill the cache for every tile covering bboxes at min_zoom..max_zoom.
+
+    vibes defaults to every vibe but 'default'. rate caps upstream
+    fetches per second across all workers (0 for no cap). progress, if
+    given, is called with running totals about once per checkpoint
+    interval. Bad arguments raise ValueError before any tile is seeded,
+    including a max_zoom past tiles.MAX_NATIVE_ZOOM, where tiles are
+    synthesized per request and never cached. A tile that fails (upstream,
+    an undecodable image, a cache write) is logged and counted in
+    SeedStats.failed, and the run goes on.
+    """
+    seed_vibes(vibes, fmt)
+    if not 0 <= min_zoom <= max_zoom:
+        raise ValueError(f'zoom range {min_zoom}..{max_zoom} is empty or negative')
+    if max_zoom > MAX_NATIVE_ZOOM:
+        raise ValueError(f'max zoom {max_zoom} is past z{MAX_NATIVE_ZOOM}: deeper tiles are'
+                         ' synthesized per request and never cached')
+    job = {'bboxes': bboxes, 'zooms': [min_zoom, max_zoom], 'vibes': vibes, 'fmt': fmt}
+    marker = _Checkpoint(checkpoint, job)
+    if marker.mark:
+        log.info('resuming at tile %d', marker.mark)
+    limiter = RateLimiter(rate, burst=workers)
+    counts = {'tiles': 0, 'written': 0, 'skipped': 0, 'failed': 0}
+
+    def run(z: int, x: int, y: int) -> int:
+        try:
+            return len(seed_tile(z, x, y, vibes, fmt, before_fetch=limiter.acquire))
+        except Exception as exc:
+            log.warning('seed failed %d/%d/%d: %s', z, x, y, exc)
+            return -1
+
+    tiles = enumerate(iter_tiles(bboxes, min_zoom, max_zoom))
+    pending: dict = {}
+    reported = time.monotonic()
+    with ThreadPoolExecutor(workers, thread_name_prefix='seed') as pool:
+        try:
+            for index, (z, x, y) in tiles:
+                if index < marker.mark:
+                    continue
+                pending[pool.submit(run, z, x, y)] = index
+                if len(pending) < workers * 4:
+                    continue
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    _tally(counts, fut.result())
+                    marker.done(pending.pop(fut))
+                if progress and time.monotonic() - reported >= _CHECKPOINT_EVERY:
+                    reported = time.monotonic()
+                    progress(SeedStats(**counts))
+            for fut in wait(pending).done:
+                _tally(counts, fut.result())
+                marker.done(pending.pop(fut))
+        finally:
+            for fut in pending:
+                fut.cancel()
+            marker.save()
+
+    return SeedStats(**counts)
+
+
+def _tally(counts: dict, written: int) -> None:
+    counts['tiles'] += 1
+    if written < 0:
+        counts['failed'] += 1
+    elif written == 0:
+        counts['skipped'] += 1
+    else:
+        counts['written'] += written
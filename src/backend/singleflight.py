@@ -0,0 +1,176 @@
+"""Collapse concurrent identical work onto one leader, within and across workers.
+
+Threads in a worker coalesce on an in-memory table keyed by the caller's key;
+the leader then takes an flock on a striped lock file so the other gunicorn
+workers wait for it too, and re-check the cache once they get the lock.
+run_async() is the same for coroutines on the ASGI app's event loop, and
+takes the same lock files, so sync and async workers coalesce together.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+try:
+    import fcntl
+except ImportError:  # not POSIX -- coalesce within the worker only
+    fcntl = None  # type: ignore[assignment]
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+_LOCK_STRIPES = 4096   # lock files are shared by hash so they never need cleaning up
+_POLL_INTERVAL = 0.05
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.ok = False
+        self.result = None
+
+
+_inflight: dict[Hashable, _Call] = {}
+_lock = threading.Lock()
+_ainflight: dict[Hashable, asyncio.Future] = {}   # resolves to (ok, result)
+
+
+def run(key: Hashable, fn: Callable[[], T], recheck: Callable[[], T | None],
+        lock_dir: Path | None, timeout: float) -> T:
+    """Run fn once per key across concurrent callers and return its result.
+
+    Followers wait up to timeout for the leader. If the leader raises, one
+    of them takes over; if the wait times out, the caller runs fn itself.
+    recheck() is tried after the cross-worker lock is acquired and should
+    return the finished result if another worker already produced it.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        with _lock:
+            call = _inflight.get(key)
+            leader = call is None
+            if leader:
+                call = _inflight[key] = _Call()
+
+        if leader:
+            try:
+                call.result = _run_locked(key, fn, recheck, lock_dir, deadline)
+                call.ok = True
+                return call.result  # type: ignore[return-value]
+            finally:
+                with _lock:
+                    del _inflight[key]
+                call.done.set()
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not call.done.wait(remaining):
+            log.warning('single-flight wait timed out key=%r; running unshared', key)
+            return fn()
+        if call.ok:
+            return call.result  # type: ignore[return-value]
+        # Leader failed -- loop so one of the waiters becomes the new leader.
+
+
+async def run_async(key: Hashable, fn: Callable[[], Awaitable[T]],
+                    recheck: Callable[[], Awaitable[T | None]],
+                    lock_dir: Path | None, timeout: float) -> T:
+    """run() for coroutine functions; callers must share one event loop."""
+    deadline = time.monotonic() + timeout
+    while True:
+        call = _ainflight.get(key)
+        if call is None:
+            call = _ainflight[key] = asyncio.get_running_loop().create_future()
+            ok, result = False, None
+            try:
+                result = await _run_locked_async(key, fn, recheck, lock_dir, deadline)
+                ok = True
+                return result
+            finally:
+                del _ainflight[key]
+                call.set_result((ok, result))
+
+        remaining = deadline - time.monotonic()
+        try:
+            if remaining <= 0:
+                raise TimeoutError
+            ok, result = await asyncio.wait_for(asyncio.shield(call), remaining)
+        except TimeoutError:
+            log.warning('single-flight wait timed out key=%r; running unshared', key)
+            return await fn()
+        if ok:
+            return result  # type: ignore[return-value]
+        # Leader failed -- loop so one of the waiters becomes the new leader.
+
+
+def pending(key: Hashable) -> bool:
+    """Whether a caller in this worker is running key right now."""
+    return key in _ainflight or key in _inflight
+
+
+def _open_stripe(key: Hashable, lock_dir: Path | None):
+    """Open the lock file for key's stripe, or None if locking isn't possible."""
+    if fcntl is None or lock_dir is None:
+        return None
+    stripe = zlib.crc32(repr(key).encode()) % _LOCK_STRIPES
+    try:
+        lock_dir.mkdir(parents=True, exist_ok=True)
+        return open(lock_dir / f'{stripe}.lock', 'a+b')
+    except OSError:
+        log.warning('single-flight lock unavailable in %s', lock_dir)
+        return None
+
+
+def _try_lock(fh) -> bool:
+    try:
+        fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except BlockingIOError:
+        return False
+
+
+def _run_locked(key: Hashable, fn: Callable[[], T], recheck: Callable[[], T | None],
+                lock_dir: Path | None, deadline: float) -> T:
+    fh = _open_stripe(key, lock_dir)
+    if fh is None:
+        return fn()
+
+    with fh:
+        while not _try_lock(fh):
+            if time.monotonic() >= deadline:
+                log.warning('single-flight lock timed out key=%r; running unshared', key)
+                return fn()
+            time.sleep(_POLL_INTERVAL)
+        try:
+            cached = recheck()
+            if cached is not None:
+                return cached
+            return fn()
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+async def _run_locked_async(key: Hashable, fn: Callable[[], Awaitable[T]],
+                            recheck: Callable[[], Awaitable[T | None]],
+                            lock_dir: Path | None, deadline: float) -> T:
+    fh = _open_stripe(key, lock_dir)
+    if fh is None:
+        return await fn()
+
+    with fh:
+        while not _try_lock(fh):
+            if time.monotonic() >= deadline:
+                log.warning('single-flight lock timed out key=%r; running unshared', key)
+                return await fn()
+            await asyncio.sleep(_POLL_INTERVAL)
+        try:
+            cached = await recheck()
+            if cached is not None:
+                return cached
+            return await fn()
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
@@ -1,17 +1,20 @@
-"""Serve per-vibe sprite sheets (PNG + JSON manifest)."""
+"""Serve per-vibe sprite sheets (PNG + JSON manifest) from memory."""
 from pathlib import Path
 
-from flask import Blueprint, send_from_directory
+from flask import Blueprint
+
+from .assets import AssetIndex
 
 sprites_bp = Blueprint('sprites', __name__, url_prefix='/api/sprites')
 _SPRITES_DIR = Path(__file__).parent.parent / 'static' / 'sprites'
+_sprites = AssetIndex(_SPRITES_DIR, 'sprites', location='static/sprites')
 
 
 @sprites_bp.route('/<vibe>.png')
 def sprite_png(vibe: str) -> object:
-    return send_from_directory(_SPRITES_DIR, f'{vibe}.png', mimetype='image/png')
+    return _sprites.response(f'{vibe}.png')
 
 
 @sprites_bp.route('/<vibe>.json')
 def sprite_json(vibe: str) -> object:
-    return send_from_directory(_SPRITES_DIR, f'{vibe}.json', mimetype='application/json')
+    return _sprites.response(f'{vibe}.json')
@@ -1,14 +1,35 @@
-"""Fetch the Liberty base style once; build per-vibe derivatives lazily."""
+"""Keep the Liberty base style fresh; build per-vibe derivatives lazily.
 
-import copy
+The base is saved under TILE_CACHE_DIR and loaded at import, so a restart
+never waits on OpenFreeMap. Once it is older than STYLE_BASE_TTL, the next
+request triggers a background refresh and keeps getting the saved copy
+meanwhile (stale-while-revalidate). A refresh that fails is retried a
+minute later; one that returns identical content just renews the TTL.
+
+Each vibe is a shallow overlay on the base style -- it shares every layer
+it doesn't change -- and is serialized, hashed and compressed once, so
+the style route only ever copies bytes. warm() does all of that up front,
+in the gunicorn master before it forks (see gunicorn.conf.py).
+"""
+
+import json
 import logging
+import os
 import threading
+import time
+from pathlib import Path
+from typing import NamedTuple
 
-import requests
+from . import metrics
+from .httpcache import asset_version, content_etag, precompress
+from .upstream import openfreemap
 
 log = logging.getLogger(__name__)
 
 _LIBERTY_URL = 'https://tiles.openfreemap.org/styles/liberty'
+_BASE_PATH   = Path(os.environ.get('TILE_CACHE_DIR', '/tmp/tile_cache')) / 'styles' / 'liberty.json'
+_BASE_TTL    = float(os.environ.get('STYLE_BASE_TTL', '86400'))
+_RETRY_AFTER = 60.0
 
 # (background, land, water, roads, labels)
 _VIBE_COLORS: dict[str, tuple[str, str, str, str, str]] = {
@@ -69,132 +90,264 @@ _VIBE_SPRITES: dict[str, str] = {
     # mockva, deco, metro added as their sprites are built
 }
 
+_STATIC_DIR = Path(__file__).parent.parent / 'static'
+
+
+class StyleDocument(NamedTuple):
+    body: bytes                  # compact JSON
+    etag: str
+    encodings: dict[str, bytes]  # content-coding -> pre-encoded body
+
+
 _base_style: dict | None = None
+_base_hash: str | None = None
+_base_checked = 0.0   # wall-clock time the base was last confirmed current
+_refreshing = False
 _lock = threading.Lock()
-_style_cache: dict[str, dict] = {}
+_documents: dict[str, StyleDocument] = {}
 
 
-def _fetch_base() -> None:
-    global _base_style
-    resp = requests.get(_LIBERTY_URL, timeout=15)
+def _fetch_base() -> bytes:
+    resp = openfreemap.get(_LIBERTY_URL, timeout=15)
     resp.raise_for_status()
-    _base_style = resp.json()
-    log.info('Liberty style fetched (%d layers)', len(_base_style.get('layers', [])))
+    return resp.content
+
+
+def _install(body: bytes, checked_at: float) -> None:
+    """Make body the base style; derived documents are dropped only if it changed."""
+    global _base_style, _base_hash, _base_checked, _documents
+    digest = content_etag(body)
+    if digest != _base_hash:
+        style = json.loads(body)
+        _base_style, _base_hash = style, digest
+        _documents = {}
+        log.info('Liberty style loaded (%d layers, %s)', len(style.get('layers', [])), digest[:12])
+    _base_checked = checked_at
+
+
+def _load_saved() -> bool:
+    try:
+        body = _BASE_PATH.read_bytes()
+        _install(body, _BASE_PATH.stat().st_mtime)
+        return True
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError):
+        log.warning('saved Liberty style %s unreadable', _BASE_PATH, exc_info=True)
+        return False
+
+
+def _save(body: bytes) -> None:
+    try:
+        _BASE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        if body == (_BASE_PATH.read_bytes() if _BASE_PATH.exists() else None):
+            os.utime(_BASE_PATH)   # unchanged: just renew the TTL for every worker
+            return
+        tmp = _BASE_PATH.with_name(f'.{_BASE_PATH.name}.{os.getpid()}')
+        tmp.write_bytes(body)
+        os.replace(tmp, _BASE_PATH)
+    except OSError:
+        log.warning('could not save Liberty style to %s', _BASE_PATH, exc_info=True)
+
+
+def _refresh() -> None:
+    # Another worker may already have refreshed the saved copy.
+    try:
+        saved_at = _BASE_PATH.stat().st_mtime
+    except OSError:
+        saved_at = 0.0
+    if saved_at > _base_checked and time.time() - saved_at < _BASE_TTL and _load_saved():
+        return
+    body = _fetch_base()
+    _save(body)
+    _install(body, time.time())
+
+
+def _refresh_in_background() -> None:
+    global _refreshing, _base_checked
+    try:
+        _refresh()
+    except Exception:
+        log.warning('Liberty style refresh failed; serving the saved copy', exc_info=True)
+        _base_checked = time.time() - _BASE_TTL + _RETRY_AFTER
+    finally:
+        _refreshing = False
 
 
 def _get_base() -> dict:
-    global _base_style
+    global _refreshing
     if _base_style is None:
         with _lock:
             if _base_style is None:
-                _fetch_base()
+                _refresh()   # nothing to serve yet, so this one has to block
+    elif time.time() - _base_checked >= _BASE_TTL:
+        with _lock:
+            start, _refreshing = not _refreshing, True
+        if start:
+            threading.Thread(target=_refresh_in_background, name='liberty-refresh', daemon=True).start()
     return _base_style  # type: ignore[return-value]
 
 
+_load_saved()
+
+
 def build_style(vibe: str) -> dict:
     """Return a MapLibre style dict for the given vibe.
 
     For 'default' the base style is returned as-is.
     For all other vibes: raster source tiles URL is rewritten to our proxy,
-    and vector layer paint colours are overridden per vibe.
-    Built styles are cached — the layer walk only runs once per vibe.
+    and vector layer paint colours are overridden per vibe. Only the
+    containers that change are copied -- every untouched source and layer
+    is the base style's own object, so the result must be treated as
+    read-only.
     """
-    if vibe in _style_cache:
-        return _style_cache[vibe]
-
     base = _get_base()
 
     if vibe == 'default':
-        _style_cache[vibe] = base
         return base
 
-    style = copy.deepcopy(base)
+    style = dict(base)
     bg_col, land_col, water_col, road_col, label_col = _VIBE_COLORS[vibe]
     halo = _VIBE_HALOS.get(vibe)
     font = _VIBE_FONTS.get(vibe)
 
     # Rewrite raster underlay source → our proxy
-    for src in style.get('sources', {}).values():
+    sources = style.get('sources', {})
+    for name, src in sources.items():
         if src.get('type') == 'raster':
             tiles = src.get('tiles', [])
             if tiles and 'ne2sr' in tiles[0]:
-                src['tiles'] = [f'/api/tiles/raster/{vibe}/{{z}}/{{x}}/{{y}}.png']
+                style['sources'] = {
+                    **sources,
+                    name: {**src, 'tiles': [f'/api/tiles/raster/{vibe}/{{z}}/{{x}}/{{y}}.png']},
+                }
                 break
 
     # Override glyphs endpoint for vibes with custom fonts
     if font:
-        style['glyphs'] = '/api/glyphs/{fontstack}/{range}.pbf'
+        version = asset_version(_STATIC_DIR / 'glyphs')
+        style['glyphs'] = f'/api/glyphs/{{fontstack}}/{{range}}.pbf?v={version}'
 
     # Override sprite sheet for vibes with custom sprites
     sprite = _VIBE_SPRITES.get(vibe)
     if sprite:
-        style['sprite'] = sprite
-        # Fix icon names in Liberty that don't match our sprite names
-        for layer in style.get('layers', []):
-            lid    = layer.get('id', '')
-            layout = layer.get('layout', {})
-            if lid == 'airport' and layout.get('icon-image') == 'airport_11':
-                layout['icon-image'] = 'airport'
-            # US shield layers generate 'us-interstate_N' etc — remap to our road_N sprites
-            elif lid in ('highway-shield-us-interstate', 'road_shield_us'):
-                layout['icon-image'] = ['concat', 'road_', ['get', 'ref_length']]
-
-    # Override vector layer colours and raster layer behaviour
-    for layer in style.get('layers', []):
-        ltype = layer.get('type', '')
-        lid   = layer.get('id', '').lower()
-        paint = layer.setdefault('paint', {})
-
-        if ltype == 'raster':
-            # Liberty fades the raster out by z6 and kills it at z7 — keep it
-            # visible at all zoom levels for custom vibes.
-            layer.pop('maxzoom', None)
-            paint['raster-opacity'] = 0.85
-
-        elif ltype == 'background':
-            paint['background-color'] = bg_col
-
-        elif ltype == 'fill':
-            if any(k in lid for k in _WATER_KEYWORDS):
-                paint['fill-color'] = water_col
-            elif any(k in lid for k in _LAND_KEYWORDS):
-                paint['fill-color'] = land_col
-
-        elif ltype == 'line':
-            if any(k in lid for k in _ROAD_KEYWORDS):
-                paint['line-color'] = road_col
-
-        elif ltype == 'symbol':
-            # Shields: skip colour overrides (sprite background provides context)
-            # but still override text-font — we've redirected the glyphs URL to
-            # our server, so any layer left on Noto Sans will 404 and stall rendering.
-            if 'shield' not in lid:
-                paint['text-color'] = label_col
-                if halo:
-                    paint['text-halo-color'] = halo[0]
-                    paint['text-halo-width'] = halo[1]
-            layout = layer.setdefault('layout', {})
-            if font:
-                if 'text-font' in layout:
-                    layout['text-font'] = [font]
-                # Shield badges: scale up the sprite, centre the text on it.
-                if 'shield' in lid:
-                    if 'text-size' in layout:
-                        layout['text-size'] = 9
-                    if 'icon-size' in layout:
-                        layout['icon-size'] = 2
-                    layout['text-anchor'] = 'center'
-                    layout['text-offset'] = [0, 0.25]
-            # POI layers: our icons are 21×21px — the Liberty default text-offset
-            # of 0.6em was sized for smaller sprites and puts text inside our icons.
-            # Push text clear of the icon bottom/right edge.
-            if lid in ('poi_r1', 'poi_r7', 'poi_r20'):
-                layout['text-offset'] = [0, 1.2]
-            elif lid == 'poi_transit':
-                layout['text-offset'] = [1.1, 0]
-            # Road name labels: ensure centre justification.
-            if lid.startswith('highway-name'):
-                layout['text-justify'] = 'center'
-
-    _style_cache[vibe] = style
+        style['sprite'] = f"{sprite}?v={asset_version(_STATIC_DIR / 'sprites')}"
+
+    if 'layers' in base:
+        style['layers'] = [
+            _vibe_layer(layer, bool(sprite), font, halo, bg_col, land_col, water_col, road_col, label_col)
+            for layer in base['layers']
+        ]
     return style
+
+
+def style_document(vibe: str) -> StyleDocument:
+    """Return the vibe's style serialized once: compact JSON, ETag and pre-encoded variants."""
+    _get_base()
+    documents = _documents   # replaced, not cleared, when the base changes
+    doc = documents.get(vibe)
+    if doc is None:
+        with metrics.STYLE_BUILD_SECONDS.labels(vibe).time():
+            body = json.dumps(build_style(vibe), separators=(',', ':')).encode()
+            doc = documents[vibe] = StyleDocument(body, content_etag(body), precompress(body))
+        log.info('style serialized vibe=%s (%d bytes, %s)', vibe, len(body),
+                 ', '.join(f'{coding} {len(data)}' for coding, data in doc.encodings.items()) or 'uncompressed')
+    return doc
+
+
+def warm() -> None:
+    """Load the base style, fetching it if the saved copy is missing or stale, and build every vibe.
+
+    Never raises: with no base at all, workers fetch it on first use as usual.
+    """
+    global _base_checked
+    if _base_style is None or time.time() - _base_checked >= _BASE_TTL:
+        try:
+            _refresh()
+        except Exception:
+            log.warning('Liberty style fetch failed during warm-up', exc_info=True)
+            if _base_style is None:
+                return
+            _base_checked = time.time() - _BASE_TTL + _RETRY_AFTER
+    for vibe in ('default', *_VIBE_COLORS):
+        try:
+            style_document(vibe)
+        except Exception:
+            log.exception('style build failed vibe=%s', vibe)
+
+
+def _vibe_layer(layer: dict, custom_sprite: bool, font: str | None, halo: tuple[str, float] | None,
+                bg_col: str, land_col: str, water_col: str, road_col: str, label_col: str) -> dict:
+    """Return layer with the vibe's overrides, or layer itself if none apply."""
+    ltype  = layer.get('type', '')
+    lid    = layer.get('id', '').lower()
+    base_layout = layer.get('layout', {})
+    paint: dict = {}
+    layout: dict = {}
+
+    if custom_sprite:
+        # Fix icon names in Liberty that don't match our sprite names
+        raw_id = layer.get('id', '')
+        if raw_id == 'airport' and base_layout.get('icon-image') == 'airport_11':
+            layout['icon-image'] = 'airport'
+        # US shield layers generate 'us-interstate_N' etc — remap to our road_N sprites
+        elif raw_id in ('highway-shield-us-interstate', 'road_shield_us'):
+            layout['icon-image'] = ['concat', 'road_', ['get', 'ref_length']]
+
+    if ltype == 'raster':
+        # Liberty fades the raster out by z6 and kills it at z7 — keep it
+        # visible at all zoom levels for custom vibes.
+        paint['raster-opacity'] = 0.85
+
+    elif ltype == 'background':
+        paint['background-color'] = bg_col
+
+    elif ltype == 'fill':
+        if any(k in lid for k in _WATER_KEYWORDS):
+            paint['fill-color'] = water_col
+        elif any(k in lid for k in _LAND_KEYWORDS):
+            paint['fill-color'] = land_col
+
+    elif ltype == 'line':
+        if any(k in lid for k in _ROAD_KEYWORDS):
+            paint['line-color'] = road_col
+
+    elif ltype == 'symbol':
+        # Shields: skip colour overrides (sprite background provides context)
+        # but still override text-font — we've redirected the glyphs URL to
+        # our server, so any layer left on Noto Sans will 404 and stall rendering.
+        if 'shield' not in lid:
+            paint['text-color'] = label_col
+            if halo:
+                paint['text-halo-color'] = halo[0]
+                paint['text-halo-width'] = halo[1]
+        if font:
+            if 'text-font' in base_layout:
+                layout['text-font'] = [font]
+            # Shield badges: scale up the sprite, centre the text on it.
+            if 'shield' in lid:
+                if 'text-size' in base_layout:
+                    layout['text-size'] = 9
+                if 'icon-size' in base_layout:
+                    layout['icon-size'] = 2
+                layout['text-anchor'] = 'center'
+                layout['text-offset'] = [0, 0.25]
+        # POI layers: our icons are 21×21px — the Liberty default text-offset
+        # of 0.6em was sized for smaller sprites and puts text inside our icons.
+        # Push text clear of the icon bottom/right edge.
+        if lid in ('poi_r1', 'poi_r7', 'poi_r20'):
+            layout['text-offset'] = [0, 1.2]
+        elif lid == 'poi_transit':
+            layout['text-offset'] = [1.1, 0]
+        # Road name labels: ensure centre justification.
+        if lid.startswith('highway-name'):
+            layout['text-justify'] = 'center'
+
+    if not paint and not layout:
+        return layer
+    layer = {k: v for k, v in layer.items() if not (ltype == 'raster' and k == 'maxzoom')}
+    if paint:
+        layer['paint'] = {**layer.get('paint', {}), **paint}
+    if layout:
+        layer['layout'] = {**base_layout, **layout}
+    return layer
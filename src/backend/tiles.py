@@ -1,23 +1,92 @@
+import asyncio
 import logging
+import math
 import os
+import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable
 
+import httpx
 import requests
-from flask import Blueprint, Response, abort, jsonify, send_file
+from flask import Blueprint, Response, abort, jsonify, request
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.exceptions import BadGateway, NotFound
+from werkzeug.http import parse_accept_header
 
-from .style_builder import build_style
-from .transforms import transform
+from . import (
+    aiqueue, executor, hotcache, janitor, metrics, scheduler, singleflight, tilestore, upstream,
+)
+from .httpcache import SENDFILE, conditional_response, encoded_response, sendfile_response
+from .style_builder import style_document
+from .transforms import (
+    FORMATS, MIMETYPES, overzoom, reencode, transform, transform_async, transform_many,
+    transform_many_async,
+)
 
 log = logging.getLogger(__name__)
 
 tiles_bp = Blueprint('tiles', __name__, url_prefix='/api/tiles')
 
 _CACHE_DIR = Path(os.environ.get('TILE_CACHE_DIR', '/tmp/tile_cache'))
+RASTER_PATH = re.compile(r'/api/tiles/raster/([^/]+)/(\d+)/(\d+)/(\d+)\.png')
+_HIT_CHECKED = 'tiles.hit_checked'   # environ key: raster_hit() already missed
 _UPSTREAM  = 'https://tiles.openfreemap.org/natural_earth/ne2sr/{z}/{x}/{y}.png'
 _VIBES     = frozenset({
     'default', 'vintage', 'toner', 'blueprint', 'dark', 'watercolor', 'highcontrast', 'noir',
     'mockva', 'mario', 'simcity', 'tomclancy', 'deco', 'metro',
 })
+# Output formats in order of preference; PNG is always the fallback.
+_FORMATS = [
+    fmt for fmt in (f.strip() for f in os.environ.get('TILE_FORMATS', 'webp,png').split(','))
+    if fmt in FORMATS and fmt != 'png'
+]
+# ne2sr has no real detail past this zoom; deeper tiles are resampled from
+# their ancestor at this zoom instead of being fetched and transformed.
+MAX_NATIVE_ZOOM = int(os.environ.get('TILE_MAX_NATIVE_ZOOM', '6'))
+_INFLIGHT_TIMEOUT = float(os.environ.get('TILE_INFLIGHT_TIMEOUT', '30'))
+# How long an upstream 4xx (missing) or 5xx / connection failure (failing)
+# is remembered per tile before upstream is asked again.
+_NEGATIVE_TTL_MISSING = float(os.environ.get('TILE_NEGATIVE_TTL_MISSING', '3600'))
+_NEGATIVE_TTL_FAILING = float(os.environ.get('TILE_NEGATIVE_TTL_FAILING', '15'))
+# Browser max-age for an AI vibe's PIL stand-in, so clients come back for the AI tile.
+_AI_PLACEHOLDER_MAX_AGE = int(os.environ.get('AI_PLACEHOLDER_MAX_AGE', '60'))
+# Opt-in: on a miss, render every vibe from the one upstream decode and
+# cache them together ('1' for all vibes, or a comma-separated subset).
+_FANOUT = os.environ.get('TILE_FANOUT', '')
+_FANOUT_VIBES = sorted(
+    _VIBES if _FANOUT == '1'
+    else _VIBES & {v.strip() for v in _FANOUT.split(',') if v.strip()}
+)
+
+_hot_cache = hotcache.create()
+_negative = hotcache.NegativeCache()
+_store = tilestore.create(_CACHE_DIR)
+_janitor = janitor.Janitor(_store)
+_ai = aiqueue.AIQueue(lambda *result: _ai_upgraded(*result))
+_slots = scheduler.Scheduler()
+_aslots = scheduler.AsyncScheduler()
+
+# Native-zoom disk hits handed to the front proxy (see httpcache.SENDFILE);
+# the hot cache then only holds synthesized tiles and overzoom ancestors.
+_sendfile = bool(SENDFILE) and isinstance(_store, tilestore.DirectoryStore)
+if SENDFILE and not _sendfile:
+    log.warning('SENDFILE needs TILE_CACHE_BACKEND=dir; sending tiles from Python')
+# Disk cache I/O for the ASGI path; kept apart from the transform threads so
+# a hit's read never queues behind a miss's render.
+_io_pool = ThreadPoolExecutor(8, thread_name_prefix='tile-io')
+
+
+class TileUnavailable(Exception):
+    """Upstream has no tile at z/x/y (missing) or couldn't serve it (failing).
+
+    Also raised from the negative cache until retry_after runs out.
+    """
+
+    def __init__(self, z: int, x: int, y: int, missing: bool, retry_after: float) -> None:
+        super().__init__(f'upstream tile {z}/{x}/{y} is {"missing" if missing else "failing"}')
+        self.missing = missing
+        self.retry_after = retry_after
 
 
 @tiles_bp.route('/style/<vibe>')
@@ -25,41 +94,594 @@ def style(vibe: str):
     if vibe not in _VIBES:
         abort(404)
     try:
-        return jsonify(build_style(vibe))
+        doc = style_document(vibe)
     except Exception:
         log.exception('style build failed vibe=%s', vibe)
         abort(502)
+    return encoded_response(doc.body, doc.encodings, 'application/json', 'style', etag=doc.etag)
+
+
+@tiles_bp.route('/stats')
+def stats():
+    return jsonify({
+        'hot_cache': _hot_cache.stats(),
+        'upstream': upstream.stats(),
+        'transform': executor.stats(),
+        'disk_cache': _janitor.stats(),
+        'negative_cache': _negative.stats(),
+        'ai': _ai.stats(),
+        'scheduler': {'wsgi': _slots.stats(), 'asgi': _aslots.stats()},
+    })
 
 
 @tiles_bp.route('/raster/<vibe>/<int:z>/<int:x>/<int:y>.png')
 def raster(vibe: str, z: int, x: int, y: int):
     if vibe not in _VIBES:
         abort(404)
+    if not request.environ.get(_HIT_CHECKED):   # wsgi.py has looked already
+        resp = raster_hit(vibe, z, x, y, request.environ)
+        if resp is not None:
+            return resp
 
-    cache_path = _CACHE_DIR / 'raster' / vibe / str(z) / str(x) / f'{y}.png'
-
-    if cache_path.exists():
-        return send_file(cache_path, mimetype='image/png')
-
-    url = _UPSTREAM.format(z=z, x=x, y=y)
+    fmt = _negotiate(request.accept_mimetypes)
     try:
-        resp = requests.get(url, timeout=10)
-        resp.raise_for_status()
-        upstream = resp.content
+        if z > MAX_NATIVE_ZOOM:
+            data, final = _overzoom(vibe, z, x, y, fmt)
+            result = 'synthesized'
+        else:
+            data, result, final = _cached_or_render(vibe, z, x, y, fmt, read=False)
+    except TileUnavailable as exc:
+        metrics.REQUESTS.labels(vibe, str(z), 'missing' if exc.missing else 'error').inc()
+        return _unavailable_response(exc, request.environ)
     except Exception:
         log.exception('upstream tile fetch failed z=%d x=%d y=%d', z, x, y)
+        metrics.REQUESTS.labels(vibe, str(z), 'error').inc()
         abort(502)
+    if final and _hot_tier(z):
+        _hot_cache.put(f'{vibe}/{z}/{x}/{y}.{fmt}', data)
+
+    metrics.REQUESTS.labels(vibe, str(z), result).inc()
+    with metrics.stage('response'):
+        return _raster_response(data, fmt, request.environ, final)
+
+
+def raster_hit(vibe: str, z: int, x: int, y: int, environ: dict) -> Response | None:
+    """raster()'s response if the tile is in the hot or disk cache, else None.
+
+    Needs no Flask request context: the plain-WSGI app (wsgi.py) answers
+    hits with it before Flask routing. With SENDFILE a native-zoom disk
+    hit is a header for the front proxy instead of the tile's bytes. A miss
+    is marked in environ, so raster() doesn't look a second time.
+    """
+    if vibe not in _VIBES:
+        return None
+    environ[_HIT_CHECKED] = True
+    fmt = _negotiate(parse_accept_header(environ.get('HTTP_ACCEPT'), MIMEAccept))
+    if not _hot_tier(z):
+        return _sendfile_hit(vibe, z, x, y, fmt)
+
+    hot_key = f'{vibe}/{z}/{x}/{y}.{fmt}'
+    with metrics.stage('hot_lookup'):
+        data = _hot_cache.get(hot_key)
+    result, final = 'hot', True
+    if data is not None:
+        if z <= MAX_NATIVE_ZOOM:
+            _record_hot_hit(vibe, z, x, y, fmt)
+    elif z > MAX_NATIVE_ZOOM:
+        return None
+    else:
+        final = _ai_final(vibe, z, x, y)   # before the read: an upgrade writes the tile first
+        data = _read_cache(f'raster/{vibe}', z, x, y, fmt)
+        if data is None:
+            return None
+        result = 'disk'
+        if final:
+            _hot_cache.put(hot_key, data)
+        else:
+            _ai_requeue(vibe, z, x, y, fmt)
+
+    metrics.REQUESTS.labels(vibe, str(z), result).inc()
+    with metrics.stage('response'):
+        return _raster_response(data, fmt, environ, final)
+
+
+async def raster_async(vibe: str, z: int, x: int, y: int, environ: dict) -> Response:
+    """raster() for the ASGI app (see asgi.py).
+
+    Same lookups, cache layout and headers. Hits are answered without
+    touching the transform threads; a miss awaits the upstream call and
+    runs PIL through executor.render_async().
+    """
+    if vibe not in _VIBES:
+        return NotFound().get_response(environ)
+
+    fmt = _negotiate(parse_accept_header(environ.get('HTTP_ACCEPT'), MIMEAccept))
+    hot_key = f'{vibe}/{z}/{x}/{y}.{fmt}'
+    sendfile = not _hot_tier(z)
+    if sendfile:
+        resp = await _in_io(_sendfile_hit, vibe, z, x, y, fmt)
+        if resp is not None:
+            return resp
+        data = None
+    else:
+        with metrics.stage('hot_lookup'):
+            data = _hot_cache.get(hot_key)
+    result, final = 'hot', True
+    if data is None:
+        try:
+            if z > MAX_NATIVE_ZOOM:
+                data, final = await _overzoom_async(vibe, z, x, y, fmt)
+                result = 'synthesized'
+            else:
+                data, result, final = await _cached_or_render_async(vibe, z, x, y, fmt,
+                                                                    read=not sendfile)
+        except TileUnavailable as exc:
+            metrics.REQUESTS.labels(vibe, str(z), 'missing' if exc.missing else 'error').inc()
+            return _unavailable_response(exc, environ)
+        except Exception:
+            log.exception('upstream tile fetch failed z=%d x=%d y=%d', z, x, y)
+            metrics.REQUESTS.labels(vibe, str(z), 'error').inc()
+            return BadGateway().get_response(environ)
+        if final and _hot_tier(z):
+            _hot_cache.put(hot_key, data)
+    elif z <= MAX_NATIVE_ZOOM:
+        _record_hot_hit(vibe, z, x, y, fmt)
+
+    metrics.REQUESTS.labels(vibe, str(z), result).inc()
+    with metrics.stage('response'):
+        return _raster_response(data, fmt, environ, final)
+
+
+def _cached_or_render(vibe: str, z: int, x: int, y: int, fmt: str,
+                      for_z: int | None = None, read: bool = True) -> tuple[bytes, str, bool]:
+    """The disk-cached tile, else fetch and transform it once across callers.
+
+    Also returns where it came from ('disk' or 'rendered') and whether it
+    is final: False for an AI vibe's PIL stand-in, which is served but kept
+    out of the hot cache until the AI result replaces it. A miss waits its
+    turn in the scheduler, ranked by for_z (the zoom the client asked for,
+    if this tile is an overzoom ancestor). read=False skips the disk read
+    for a caller that has just missed it (raster_hit()).
+    """
+    layer = f'raster/{vibe}'
+    final = _ai_final(vibe, z, x, y)   # before the read: an upgrade writes the tile first
+    data = _read_cache(layer, z, x, y, fmt) if read else None
+    if data is not None:
+        if not final:
+            _ai_requeue(vibe, z, x, y, fmt)
+        return data, 'disk', final
+    _check_negative(z, x, y)
+    return singleflight.run(
+        ('raster', vibe, z, x, y, fmt),
+        lambda: _slots.run(for_z or z, lambda: _render_miss(vibe, z, x, y, fmt)),
+        recheck=lambda: _read_cache(layer, z, x, y, fmt),
+        lock_dir=_CACHE_DIR / 'locks' / 'raster',
+        timeout=_INFLIGHT_TIMEOUT,
+    ), 'rendered', final
+
 
+async def _cached_or_render_async(vibe: str, z: int, x: int, y: int, fmt: str,
+                                  for_z: int | None = None, read: bool = True) -> tuple[bytes, str, bool]:
+    """_cached_or_render() for the ASGI app.
+
+    If the client goes away while the miss is still waiting for a slot, the
+    tile is handed to the scheduler's background fill instead.
+    """
+    layer = f'raster/{vibe}'
+    final = await _in_io(_ai_final, vibe, z, x, y) if _ai.handles(vibe) else True
+    data = await _in_io(_read_cache, layer, z, x, y, fmt) if read else None
+    if data is not None:
+        if not final:
+            await _in_io(_ai_requeue, vibe, z, x, y, fmt)
+        return data, 'disk', final
+    _check_negative(z, x, y)
+    key = ('raster', vibe, z, x, y, fmt)
+    return await singleflight.run_async(
+        key,
+        lambda: _aslots.run(key, for_z or z, lambda: _render_miss_async(vibe, z, x, y, fmt),
+                            abandoned=lambda: _fill_async(vibe, z, x, y, fmt)),
+        recheck=lambda: _in_io(_read_cache, layer, z, x, y, fmt),
+        lock_dir=_CACHE_DIR / 'locks' / 'raster',
+        timeout=_INFLIGHT_TIMEOUT,
+    ), 'rendered', final
+
+
+async def _fill_async(vibe: str, z: int, x: int, y: int, fmt: str) -> None:
+    """Background fill for a miss whose client left before it got a slot.
+
+    Skipped if the tile has been cached or another request is rendering it
+    by now; never raises.
+    """
+    key = ('raster', vibe, z, x, y, fmt)
+    layer = f'raster/{vibe}'
     try:
-        png = transform(vibe, upstream, z, x, y)
+        if singleflight.pending(key) or await _in_io(_has_cache, layer, z, x, y, fmt):
+            return
+        _check_negative(z, x, y)
+        await singleflight.run_async(
+            key,
+            lambda: _render_miss_async(vibe, z, x, y, fmt),
+            recheck=lambda: _in_io(_read_cache, layer, z, x, y, fmt),
+            lock_dir=_CACHE_DIR / 'locks' / 'raster',
+            timeout=_INFLIGHT_TIMEOUT,
+        )
+    except TileUnavailable:
+        pass
     except Exception:
-        log.exception('transform failed vibe=%s z=%d x=%d y=%d', vibe, z, x, y)
-        png = upstream
+        log.warning('background fill failed vibe=%s z=%d x=%d y=%d', vibe, z, x, y, exc_info=True)
+
+
+def _overzoom(vibe: str, z: int, x: int, y: int, fmt: str) -> tuple[bytes, bool]:
+    """Resample the tile from its transformed ancestor at MAX_NATIVE_ZOOM.
+
+    Always from that one ancestor, never from a synthesized intermediate, so
+    the result doesn't depend on what happens to be cached and is resampled
+    only once. The ancestor is rendered (and cached) like any other miss if
+    needed; synthesized tiles themselves only go to the hot cache. Also
+    returns whether the ancestor was final (see _cached_or_render).
+    """
+    dz = z - MAX_NATIVE_ZOOM
+    ax, ay = x >> dz, y >> dz
+    hot_key = f'{vibe}/{MAX_NATIVE_ZOOM}/{ax}/{ay}.png'
+    ancestor, final = _hot_cache.get(hot_key), True
+    if ancestor is None:
+        ancestor, _, final = _cached_or_render(vibe, MAX_NATIVE_ZOOM, ax, ay, 'png', for_z=z)
+        if final:
+            _hot_cache.put(hot_key, ancestor)
+    return overzoom(vibe, ancestor, dz, x - (ax << dz), y - (ay << dz), fmt), final
+
+
+async def _overzoom_async(vibe: str, z: int, x: int, y: int, fmt: str) -> tuple[bytes, bool]:
+    dz = z - MAX_NATIVE_ZOOM
+    ax, ay = x >> dz, y >> dz
+    hot_key = f'{vibe}/{MAX_NATIVE_ZOOM}/{ax}/{ay}.png'
+    ancestor, final = _hot_cache.get(hot_key), True
+    if ancestor is None:
+        ancestor, _, final = await _cached_or_render_async(
+            vibe, MAX_NATIVE_ZOOM, ax, ay, 'png', for_z=z)
+        if final:
+            _hot_cache.put(hot_key, ancestor)
+    data = await executor.run_async(overzoom, vibe, ancestor, dz, x - (ax << dz), y - (ay << dz), fmt)
+    return data, final
+
+
+def _sendfile_hit(vibe: str, z: int, x: int, y: int, fmt: str) -> Response | None:
+    """A native-zoom disk hit as a response for the front proxy to fill in; None if not on disk."""
+    layer = f'raster/{vibe}'
+    final = _ai_final(vibe, z, x, y)
+    if not _has_cache(layer, z, x, y, fmt):
+        return None
+    _janitor.record(layer, z, x, y, fmt)
+    if not final:
+        _ai_requeue(vibe, z, x, y, fmt)
+    metrics.REQUESTS.labels(vibe, str(z), 'disk').inc()
+    path = _store.path(layer, z, x, y, fmt)
+    location = f'tiles/{path.relative_to(_CACHE_DIR).as_posix()}'
+    resp = sendfile_response(path, location, MIMETYPES[fmt], 'raster')
+    return _raster_headers(resp, final)
+
+
+def _hot_tier(z: int) -> bool:
+    """Whether tiles at z are served from (and kept in) the hot cache."""
+    return z > MAX_NATIVE_ZOOM or not _sendfile
+
+
+def _raster_response(data: bytes, fmt: str, environ: dict, final: bool = True) -> Response:
+    return _raster_headers(conditional_response(data, MIMETYPES[fmt], 'raster', environ), final)
+
+
+def _raster_headers(resp: Response, final: bool) -> Response:
+    if not final:
+        resp.cache_control.max_age = _AI_PLACEHOLDER_MAX_AGE
+    if _FORMATS:
+        resp.vary.add('Accept')
+    return resp
+
+
+def _unavailable_response(exc: TileUnavailable, environ: dict) -> Response:
+    """404 for a tile upstream doesn't have, cacheable while we remember that; 502 otherwise."""
+    if exc.missing:
+        resp = NotFound().get_response(environ)
+        resp.cache_control.public = True
+        resp.cache_control.max_age = int(exc.retry_after)
+    else:
+        resp = BadGateway().get_response(environ)
+        resp.retry_after = math.ceil(exc.retry_after)
+    return resp
+
+
+def _negotiate(accept: MIMEAccept) -> str:
+    """Pick the first configured format the client names explicitly in Accept."""
+    accepted = {mime for mime, quality in accept if quality > 0}
+    for fmt in _FORMATS:
+        if MIMETYPES[fmt] in accepted:
+            return fmt
+    return 'png'
+
+
+def fetch_upstream(z: int, x: int, y: int) -> bytes:
+    """Return the raw upstream tile, shared by every vibe via its own cache namespace."""
+    cached = _read_cache('upstream', z, x, y)
+    if cached is not None:
+        return cached
+    _check_negative(z, x, y)
+
+    def fetch() -> bytes:
+        try:
+            with metrics.stage('upstream_fetch'):
+                resp = upstream.openfreemap.get(_UPSTREAM.format(z=z, x=x, y=y), timeout=10)
+        except upstream.UpstreamBusyError:
+            raise   # our own concurrency cap, not upstream's fault
+        except requests.RequestException as exc:
+            raise _unavailable(z, x, y, None) from exc
+        if resp.status_code >= 400:
+            raise _unavailable(z, x, y, resp.status_code)
+        _write_cache('upstream', z, x, y, resp.content)
+        return resp.content
+
+    return singleflight.run(
+        ('upstream', z, x, y), fetch,
+        recheck=lambda: _read_cache('upstream', z, x, y),
+        lock_dir=_CACHE_DIR / 'locks' / 'upstream',   # separate stripes: taken while a raster lock is held
+        timeout=_INFLIGHT_TIMEOUT,
+    )
+
 
+async def fetch_upstream_async(z: int, x: int, y: int) -> bytes:
+    """fetch_upstream() for the ASGI app."""
+    cached = await _in_io(_read_cache, 'upstream', z, x, y)
+    if cached is not None:
+        return cached
+    _check_negative(z, x, y)
+
+    async def fetch() -> bytes:
+        try:
+            with metrics.stage('upstream_fetch'):
+                resp = await upstream.openfreemap.aget(_UPSTREAM.format(z=z, x=x, y=y), timeout=10)
+        except upstream.UpstreamBusyError:
+            raise
+        except (requests.RequestException, httpx.HTTPError) as exc:
+            raise _unavailable(z, x, y, None) from exc
+        if resp.status_code >= 400:
+            raise _unavailable(z, x, y, resp.status_code)
+        await _in_io(_write_cache, 'upstream', z, x, y, resp.content)
+        return resp.content
+
+    return await singleflight.run_async(
+        ('upstream', z, x, y), fetch,
+        recheck=lambda: _in_io(_read_cache, 'upstream', z, x, y),
+        lock_dir=_CACHE_DIR / 'locks' / 'upstream',
+        timeout=_INFLIGHT_TIMEOUT,
+    )
+
+
+def _check_negative(z: int, x: int, y: int) -> None:
+    entry = _negative.get((z, x, y))
+    if entry is not None:
+        raise TileUnavailable(z, x, y, *entry)
+
+
+def _unavailable(z: int, x: int, y: int, status: int | None) -> TileUnavailable:
+    """Remember that upstream couldn't serve z/x/y (status None: no response at all)."""
+    missing = status is not None and status < 500 and status not in (408, 429)
+    ttl = _NEGATIVE_TTL_MISSING if missing else _NEGATIVE_TTL_FAILING
+    _negative.put((z, x, y), missing, ttl)
+    log.warning('upstream tile %d/%d/%d %s (%s); not retried for %ds',
+                z, x, y, 'missing' if missing else 'failing', status or 'no response', ttl)
+    return TileUnavailable(z, x, y, missing, ttl)
+
+
+def _render_miss(vibe: str, z: int, x: int, y: int, fmt: str) -> bytes:
+    """Fetch, transform and cache one tile; raises if upstream is unavailable.
+
+    An AI vibe gets its stored AI result if there is one, else the PIL
+    rendering, and is queued for the AI service.
+    """
+    if _ai.handles(vibe):
+        data = _ai_cached(vibe, z, x, y, fmt)
+        if data is not None:
+            return data
+    raw = fetch_upstream(z, x, y)
+
+    data = None
+    if vibe in _FANOUT_VIBES:
+        try:
+            rendered = transform_many(_fanout(vibe), raw, fmt)
+        except Exception:
+            log.exception('fan-out transform failed z=%d x=%d y=%d', z, x, y)
+            rendered = {}
+        for other, tile in rendered.items():
+            if other != vibe:
+                _write_cache(f'raster/{other}', z, x, y, tile, fmt)
+        data = rendered.get(vibe)
+
+    if data is None:
+        try:
+            data = transform(vibe, raw, fmt)
+        except Exception:
+            log.exception('transform failed vibe=%s z=%d x=%d y=%d', vibe, z, x, y)
+            if fmt != 'png':
+                return reencode('default', raw, fmt)   # untransformed; not cached
+            data = raw
+
+    _write_cache(f'raster/{vibe}', z, x, y, data, fmt)
+    _ai.submit(vibe, z, x, y, fmt, raw)   # after the write, so the upgrade lands on top of it
+    return data
+
+
+async def _render_miss_async(vibe: str, z: int, x: int, y: int, fmt: str) -> bytes:
+    """_render_miss() for the ASGI app."""
+    if _ai.handles(vibe):
+        data = await _ai_cached_async(vibe, z, x, y, fmt)
+        if data is not None:
+            return data
+    raw = await fetch_upstream_async(z, x, y)
+
+    data = None
+    if vibe in _FANOUT_VIBES:
+        try:
+            rendered = await transform_many_async(_fanout(vibe), raw, fmt)
+        except Exception:
+            log.exception('fan-out transform failed z=%d x=%d y=%d', z, x, y)
+            rendered = {}
+        others = {other: tile for other, tile in rendered.items() if other != vibe}
+        if others:
+            await _in_io(lambda: [_write_cache(f'raster/{other}', z, x, y, tile, fmt)
+                                  for other, tile in others.items()])
+        data = rendered.get(vibe)
+
+    if data is None:
+        try:
+            data = await transform_async(vibe, raw, fmt)
+        except Exception:
+            log.exception('transform failed vibe=%s z=%d x=%d y=%d', vibe, z, x, y)
+            if fmt != 'png':
+                return await executor.run_async(reencode, 'default', raw, fmt)
+            data = raw
+
+    await _in_io(_write_cache, f'raster/{vibe}', z, x, y, data, fmt)
+    _ai.submit(vibe, z, x, y, fmt, raw)
+    return data
+
+
+def _fanout(vibe: str) -> list[str]:
+    """The fan-out vibes to render alongside vibe; other AI vibes are left to their own requests."""
+    return [v for v in _FANOUT_VIBES if v == vibe or not _ai.handles(v)]
+
+
+def _record_hot_hit(vibe: str, z: int, x: int, y: int, fmt: str) -> None:
+    """Keep a hot tile's disk copies fresh for the janitor, its AI result included."""
+    _janitor.record(f'raster/{vibe}', z, x, y, fmt)
+    if _ai.handles(vibe):
+        _janitor.record(f'ai/{vibe}', z, x, y)
+
+
+def _ai_final(vibe: str, z: int, x: int, y: int) -> bool:
+    """False while vibe's tile at z/x/y is (or would be rendered as) a PIL stand-in for an AI result."""
+    if not _ai.handles(vibe):
+        return True
+    if not _has_cache(f'ai/{vibe}', z, x, y):
+        return False
+    _janitor.record(f'ai/{vibe}', z, x, y)   # evicting it would cost another AI call
+    return True
+
+
+def _ai_cached(vibe: str, z: int, x: int, y: int, fmt: str) -> bytes | None:
+    """The stored AI result for z/x/y as fmt, also written to the raster layer; None if there's none."""
+    png = _read_cache(f'ai/{vibe}', z, x, y)
+    if png is None:
+        return None
+    data = reencode(vibe, png, fmt)
+    _write_cache(f'raster/{vibe}', z, x, y, data, fmt)
+    return data
+
+
+async def _ai_cached_async(vibe: str, z: int, x: int, y: int, fmt: str) -> bytes | None:
+    png = await _in_io(_read_cache, f'ai/{vibe}', z, x, y)
+    if png is None:
+        return None
+    data = png if fmt == 'png' else await executor.run_async(reencode, vibe, png, fmt)
+    await _in_io(_write_cache, f'raster/{vibe}', z, x, y, data, fmt)
+    return data
+
+
+def _ai_requeue(vibe: str, z: int, x: int, y: int, fmt: str) -> None:
+    """Queue a cached PIL stand-in again whose AI job was lost (restart, full queue) or failed a while ago."""
+    if not _ai.wants(vibe, z, x, y):
+        return
+    raw = _read_cache('upstream', z, x, y)
+    if raw is not None:
+        _ai.submit(vibe, z, x, y, fmt, raw)
+
+
+def _ai_upgraded(vibe: str, z: int, x: int, y: int, png: bytes, fmts: set[str]) -> None:
+    """Replace the PIL stand-ins with an AI result (runs on an AI queue thread).
+
+    The raster tiles are written before the ai/ copy that marks them final.
+    """
+    encoded = {fmt: reencode(vibe, png, fmt) for fmt in fmts}
+    for fmt, data in encoded.items():
+        _write_cache(f'raster/{vibe}', z, x, y, data, fmt)
+    _write_cache(f'ai/{vibe}', z, x, y, png)
+    for fmt, data in encoded.items():
+        _hot_cache.put(f'{vibe}/{z}/{x}/{y}.{fmt}', data)
+
+
+async def _in_io(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_io_pool, fn, *args)
+
+
+def set_render_slots(slots: int) -> None:
+    """Resize this worker's WSGI render slots (see gunicorn.conf.py); call before it serves."""
+    _slots.resize(slots)
+
+
+def seed_tile(z: int, x: int, y: int, vibes: list[str] | None = None, fmt: str = 'png',
+              before_fetch: Callable[[], None] | None = None) -> list[str]:
+    """Render and cache whichever of vibes (default: all but 'default') are missing at z/x/y.
+
+    Same fetch, transform and cache path as a client miss, minus the
+    single-flight coordination. before_fetch runs before a real upstream
+    request (not an upstream cache hit), e.g. to rate-limit. Returns the
+    vibes written; raises if the upstream tile can't be had. Tiles above
+    MAX_NATIVE_ZOOM are synthesized per request and never cached, so
+    there is nothing to seed there. AI vibes are cached as their PIL
+    rendering and queued for the AI service, as on a client miss.
+    """
+    vibes = seed_vibes(vibes, fmt)
+    if z > MAX_NATIVE_ZOOM:
+        return []
+    missing = [v for v in vibes if not _has_cache(f'raster/{v}', z, x, y, fmt)]
+    pending = [v for v in missing if not (_ai.handles(v) and _ai_cached(v, z, x, y, fmt))]
+    if not pending:
+        return missing
+
+    if before_fetch is not None and not _has_cache('upstream', z, x, y):
+        before_fetch()
+    raw = fetch_upstream(z, x, y)
+
+    rendered = transform_many(pending, raw, fmt)
+    for vibe in pending:
+        _write_cache(f'raster/{vibe}', z, x, y, rendered[vibe], fmt)
+        _ai.submit(vibe, z, x, y, fmt, raw)
+    return missing
+
+
+def seed_vibes(vibes: list[str] | None, fmt: str = 'png') -> list[str]:
+    """The vibes seed_tile() renders for these arguments; ValueError for an unknown vibe or format."""
+    if fmt not in FORMATS:
+        raise ValueError(f'unsupported format: {fmt}')
+    vibes = sorted(_VIBES - {'default'}) if vibes is None else vibes
+    unknown = set(vibes) - _VIBES
+    if unknown:
+        raise ValueError(f'unknown vibes: {", ".join(sorted(unknown))}')
+    return vibes
+
+
+def _has_cache(layer: str, z: int, x: int, y: int, fmt: str = 'png') -> bool:
     try:
-        cache_path.parent.mkdir(parents=True, exist_ok=True)
-        cache_path.write_bytes(png)
+        return _store.has(layer, z, x, y, fmt)
     except Exception:
-        log.warning('cache write failed %s', cache_path)
+        log.warning('cache lookup failed %s/%d/%d/%d', layer, z, x, y, exc_info=True)
+        return False
+
 
-    return Response(png, mimetype='image/png')
+def _read_cache(layer: str, z: int, x: int, y: int, fmt: str = 'png') -> bytes | None:
+    try:
+        with metrics.stage('cache_lookup'):
+            data = _store.get(layer, z, x, y, fmt)
+    except Exception:
+        log.warning('cache read failed %s/%d/%d/%d', layer, z, x, y, exc_info=True)
+        return None
+    if data is not None:
+        _janitor.record(layer, z, x, y, fmt)
+    return data
+
+
+def _write_cache(layer: str, z: int, x: int, y: int, data: bytes, fmt: str = 'png') -> None:
+    try:
+        with metrics.stage('cache_write'):
+            _store.put(layer, z, x, y, data, fmt)
+    except Exception:
+        log.warning('cache write failed %s/%d/%d/%d', layer, z, x, y)
+        _janitor.wake()   # likely out of space
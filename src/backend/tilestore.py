@@ -0,0 +1,459 @@
+"""Pluggable on-disk tile stores behind the raster cache.
+
+A store holds named layers ('upstream', 'raster/<vibe>', 'ai/<vibe>') of z/x/y tiles,
+with one variant per image format:
+
+- DirectoryStore keeps the original one-file-per-tile layout,
+  <root>/<layer>/<z>/<x>/<y>.<fmt>. Each file is written under a temporary
+  dot-name and renamed into place, so readers never see a partial tile.
+  Tiles up to TILE_CACHE_DEDUP_KB (open ocean, uniform land: thousands of
+  byte-identical copies per vibe) are stored once, content-addressed under
+  <root>/blobs/, and hardlinked into place, so every copy shares one inode
+  and disk block. Since the copies then share one atime too, each keeps
+  its own last-read time in an empty stamp file next to it, .<y>.<fmt>.read.
+- MBTilesStore packs each layer into one SQLite MBTiles file,
+  <root>/<layer>.mbtiles (<layer>.<fmt>.mbtiles for non-PNG), in WAL mode
+  so every worker can read while one writes, with reads served through
+  SQLite's mmap. Tiles are deduplicated within each file with the spec's
+  map/images tables, keyed by the same content hash as the blobs.
+
+Both also keep a last-read time per tile (the file's atime or stamp, or
+a last_access column) for the janitor to evict by; see janitor.py.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, Iterator
+
+log = logging.getLogger(__name__)
+
+_BACKEND   = os.environ.get('TILE_CACHE_BACKEND', 'dir')
+_MMAP_SIZE = int(os.environ.get('TILE_CACHE_MMAP_MB', '256')) * 1024 * 1024
+_DEDUP_MAX = int(float(os.environ.get('TILE_CACHE_DEDUP_KB', '8')) * 1024)
+
+Tile = tuple[int, int, int, bytes]   # z, x, y, data
+Access = tuple[int, int, int, float]  # z, x, y, last read (epoch seconds)
+
+_VIBE_LAYERS = ('ai', 'raster')   # <kind>/<vibe> layers, next to 'upstream'
+
+
+class DirectoryStore:
+    def __init__(self, root: Path, dedup_max: int = _DEDUP_MAX) -> None:
+        self.root = root
+        self.dedup_max = dedup_max
+
+    def path(self, layer: str, z: int, x: int, y: int, fmt: str = 'png') -> Path:
+        return self.root / layer / str(z) / str(x) / f'{y}.{fmt}'
+
+    def get(self, layer: str, z: int, x: int, y: int, fmt: str = 'png') -> bytes | None:
+        try:
+            return self.path(layer, z, x, y, fmt).read_bytes()
+        except OSError:
+            return None
+
+    def has(self, layer: str, z: int, x: int, y: int, fmt: str = 'png') -> bool:
+        return self.path(layer, z, x, y, fmt).is_file()
+
+    def put(self, layer: str, z: int, x: int, y: int, data: bytes, fmt: str = 'png') -> None:
+        path = self.path(layer, z, x, y, fmt)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}.{threading.get_ident()}')
+        try:
+            if len(data) <= self.dedup_max and self._link_blob(data, fmt, tmp):
+                _stamp(path).touch()   # read "now", not whenever the blob was last read
+                os.replace(tmp, path)
+                tmp.unlink(missing_ok=True)   # rename() is a no-op if path was already this blob
+            else:
+                tmp.write_bytes(data)
+                os.replace(tmp, path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+
+    def put_many(self, layer: str, tiles: Iterable[Tile], fmt: str = 'png') -> None:
+        for z, x, y, data in tiles:
+            self.put(layer, z, x, y, data, fmt)
+
+    def prune(self) -> tuple[int, int]:
+        """Delete blobs no tile links to any more (evicted or overwritten); return (blobs, bytes)."""
+        blobs = freed = 0
+        for bucket in _scandir(self.root / 'blobs'):
+            for entry in _scandir(bucket.path):
+                try:
+                    st = entry.stat()
+                    if entry.name.startswith('.') or st.st_nlink > 1:
+                        continue
+                    os.unlink(entry.path)
+                except OSError:
+                    continue
+                blobs += 1
+                freed += st.st_size
+        return blobs, freed
+
+    def _link_blob(self, data: bytes, fmt: str, tmp: Path) -> bool:
+        """Hardlink tmp to data's blob, writing the blob if it is new; False if that can't be done here."""
+        digest = _tile_id(data)
+        blob = self.root / 'blobs' / digest[:2] / f'{digest}.{fmt}'
+        for _ in range(2):
+            try:
+                os.link(blob, tmp)
+                return True
+            except FileNotFoundError:
+                # New content (or pruned a moment ago): write the blob, then link again.
+                blob.parent.mkdir(parents=True, exist_ok=True)
+                blob_tmp = blob.with_name(f'.{blob.name}.{os.getpid()}.{threading.get_ident()}')
+                try:
+                    blob_tmp.write_bytes(data)
+                    os.replace(blob_tmp, blob)
+                except BaseException:
+                    blob_tmp.unlink(missing_ok=True)
+                    raise
+            except OSError:
+                return False   # no hardlinks on this filesystem, or the link limit reached
+        return False
+
+    def iter_tiles(self, layer: str, fmt: str = 'png') -> Iterator[Tile]:
+        for path in sorted((self.root / layer).glob(f'*/*/*.{fmt}')):
+            try:
+                z, x, y = int(path.parent.parent.name), int(path.parent.name), int(path.stem)
+            except ValueError:
+                continue
+            yield z, x, y, path.read_bytes()
+
+    def layers(self) -> list[str]:
+        """Layers present on disk: 'upstream', plus 'raster/<vibe>' and 'ai/<vibe>' per vibe dir."""
+        found = ['upstream'] if (self.root / 'upstream').is_dir() else []
+        for kind in _VIBE_LAYERS:
+            if (self.root / kind).is_dir():
+                found += [f'{kind}/{p.name}' for p in sorted((self.root / kind).iterdir()) if p.is_dir()]
+        return sorted(found)
+
+    def touch(self, layer: str, fmt: str, accesses: Iterable[Access]) -> None:
+        """Record last reads as atime (mtime is kept), whatever the mount's atime
+        policy; a deduplicated tile's go on its stamp instead of the shared blob."""
+        for z, x, y, when in accesses:
+            path = self.path(layer, z, x, y, fmt)
+            try:
+                st = path.stat()
+                if st.st_nlink > 1:
+                    stamp = _stamp(path)
+                    stamp.touch()
+                    os.utime(stamp, (when, when))
+                else:
+                    os.utime(path, (when, st.st_mtime))
+            except OSError:
+                pass   # evicted since it was read
+
+    def usage(self, layer: str, min_zoom: int, bucket: float) -> tuple[int, dict[int, int]]:
+        """Bytes stored for layer in every format, and the bytes of tiles at
+        min_zoom or deeper keyed by last read // bucket. A deduplicated tile
+        counts its share of the blob."""
+        total = 0
+        by_age: dict[int, int] = {}
+        for z, entry in self._entries(layer):
+            st = entry.stat()
+            size = _share(st)
+            total += size
+            if z >= min_zoom:
+                age = int(_last_read(entry, st) // bucket)
+                by_age[age] = by_age.get(age, 0) + size
+        return total, by_age
+
+    def evict(self, layer: str, min_zoom: int, before: float) -> tuple[int, int]:
+        """Delete tiles at min_zoom or deeper last read before `before`; return (tiles, bytes)."""
+        tiles = freed = 0
+        links: dict[int, int] = {}   # deduplicated inode -> link count before this sweep
+        for z, entry in self._entries(layer, min_zoom):
+            try:
+                st = entry.stat()
+                if _last_read(entry, st) >= before:
+                    continue
+                os.unlink(entry.path)
+            except OSError:
+                continue
+            _stamp(entry.path).unlink(missing_ok=True)
+            tiles += 1
+            if st.st_nlink > 1:
+                nlink = links.setdefault(st.st_ino, st.st_nlink)
+                freed += st.st_size // (nlink - 1)
+            else:
+                freed += st.st_size
+        return tiles, freed
+
+    def _entries(self, layer: str, min_zoom: int = 0) -> Iterator[tuple[int, os.DirEntry]]:
+        """Every tile file of layer as (z, entry); dot files (writes in progress) are skipped."""
+        for zdir in _scandir(self.root / layer):
+            if not (zdir.is_dir() and zdir.name.isdigit() and int(zdir.name) >= min_zoom):
+                continue
+            for xdir in _scandir(zdir.path):
+                if not xdir.is_dir():
+                    continue
+                for entry in _scandir(xdir.path):
+                    if not entry.name.startswith('.') and entry.is_file():
+                        yield int(zdir.name), entry
+
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS name ON metadata (name)',
+    'CREATE TABLE IF NOT EXISTS map (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER,'
+    '  tile_id TEXT, last_access REAL NOT NULL DEFAULT 0)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS map_index ON map (zoom_level, tile_column, tile_row)',
+    'CREATE INDEX IF NOT EXISTS map_tile_id ON map (tile_id)',
+    'CREATE TABLE IF NOT EXISTS images (tile_data BLOB, tile_id TEXT)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS images_id ON images (tile_id)',
+)
+
+# Every tile with its share of its image's bytes (split between the tiles using it).
+_SHARES = ('(SELECT zoom_level, last_access, length(tile_data) / uses AS share FROM map'
+           ' JOIN images USING (tile_id)'
+           ' JOIN (SELECT tile_id, COUNT(*) AS uses FROM map GROUP BY tile_id) USING (tile_id))')
+
+
+class MBTilesStore:
+    """One MBTiles (SQLite) file per layer; rows use the spec's TMS y (flipped).
+
+    Files use the spec's deduplicated layout: a map table of
+    z/x/y -> tile_id (the content hash), an images table holding each
+    distinct tile once, and a tiles view joining the two for readers.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self.root = root
+        self._local = threading.local()
+        self._schema_lock = threading.Lock()
+
+    def _conn(self, layer: str, fmt: str = 'png') -> sqlite3.Connection:
+        # sqlite3 connections are per thread and must not cross a fork.
+        conns = getattr(self._local, 'conns', None)
+        if conns is None or self._local.pid != os.getpid():
+            conns = self._local.conns = {}
+            self._local.pid = os.getpid()
+        conn = conns.get((layer, fmt))
+        if conn is None:
+            path = self.root / (f'{layer}.mbtiles' if fmt == 'png' else f'{layer}.{fmt}.mbtiles')
+            path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+            conn.create_function('tile_id', 1, _tile_id, deterministic=True)
+            conn.execute('PRAGMA auto_vacuum=INCREMENTAL')   # only takes effect on a new file
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute(f'PRAGMA mmap_size={_MMAP_SIZE}')
+            with self._schema_lock, _transaction(conn):
+                _create_schema(conn, layer, fmt)
+            conns[layer, fmt] = conn
+        return conn
+
+    def get(self, layer: str, z: int, x: int, y: int, fmt: str = 'png') -> bytes | None:
+        row = self._conn(layer, fmt).execute(
+            'SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+            (z, x, (1 << z) - 1 - y),
+        ).fetchone()
+        return row[0] if row else None
+
+    def has(self, layer: str, z: int, x: int, y: int, fmt: str = 'png') -> bool:
+        return self._conn(layer, fmt).execute(
+            'SELECT 1 FROM map WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+            (z, x, (1 << z) - 1 - y),
+        ).fetchone() is not None
+
+    def put(self, layer: str, z: int, x: int, y: int, data: bytes, fmt: str = 'png') -> None:
+        self.put_many(layer, [(z, x, y, data)], fmt)
+
+    def put_many(self, layer: str, tiles: Iterable[Tile], fmt: str = 'png') -> None:
+        """Write tiles in one transaction; content already in the file is not stored again."""
+        now = time.time()
+        rows = [(z, x, (1 << z) - 1 - y, _tile_id(data), data) for z, x, y, data in tiles]
+        self._write(
+            self._conn(layer, fmt),
+            ('INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)',
+             ((tile_id, sqlite3.Binary(data)) for _, _, _, tile_id, data in rows)),
+            ('INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id, last_access)'
+             ' VALUES (?, ?, ?, ?, ?)',
+             ((z, x, row, tile_id, now) for z, x, row, tile_id, _ in rows)),
+        )
+
+    def iter_tiles(self, layer: str, fmt: str = 'png') -> Iterator[Tile]:
+        """Stream every tile of a layer in index order (bulk reads go through mmap)."""
+        cursor = self._conn(layer, fmt).execute(
+            'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles'
+            ' ORDER BY zoom_level, tile_column, tile_row'
+        )
+        for z, x, row, data in cursor:
+            yield z, x, (1 << z) - 1 - row, data
+
+    def layers(self) -> list[str]:
+        """The same layers DirectoryStore.layers() finds, from the .mbtiles files present."""
+        return sorted(layer for layer in self._files()
+                      if layer == 'upstream' or layer.partition('/')[0] in _VIBE_LAYERS)
+
+    def touch(self, layer: str, fmt: str, accesses: Iterable[Access]) -> None:
+        """Record last reads in the map's last_access column, one transaction per batch."""
+        self._write(
+            self._conn(layer, fmt),
+            ('UPDATE map SET last_access=? WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+             ((when, z, x, (1 << z) - 1 - y) for z, x, y, when in accesses)),
+        )
+
+    def usage(self, layer: str, min_zoom: int, bucket: float) -> tuple[int, dict[int, int]]:
+        """Tile bytes stored for layer in every format (not file size, which
+        includes the index and free pages), and the bytes of tiles at
+        min_zoom or deeper keyed by last read // bucket. A tile counts its
+        share of an image stored once for several tiles."""
+        total = 0
+        by_age: dict[int, int] = {}
+        for fmt in self._files().get(layer, ()):
+            for deep, age, size in self._conn(layer, fmt).execute(
+                'SELECT zoom_level >= ?, CAST(last_access / ? AS INTEGER), SUM(share)'
+                ' FROM ' + _SHARES + ' GROUP BY 1, 2', (min_zoom, bucket),
+            ):
+                total += size
+                if deep:
+                    by_age[age] = by_age.get(age, 0) + size
+        return total, by_age
+
+    def evict(self, layer: str, min_zoom: int, before: float) -> tuple[int, int]:
+        """Delete tiles at min_zoom or deeper last read before `before`; return (tiles, bytes).
+
+        Only the map rows go; prune() then deletes the images no tile
+        refers to any more.
+        """
+        tiles = freed = 0
+        for fmt in self._files().get(layer, ()):
+            conn = self._conn(layer, fmt)
+            where = ' WHERE zoom_level >= ? AND last_access < ?'
+            with _transaction(conn):
+                count, size = conn.execute(
+                    'SELECT COUNT(*), COALESCE(SUM(share), 0) FROM ' + _SHARES + where,
+                    (min_zoom, before),
+                ).fetchone()
+                conn.execute('DELETE FROM map' + where, (min_zoom, before))
+            tiles += count
+            freed += size
+        return tiles, freed
+
+    def prune(self) -> tuple[int, int]:
+        """Delete images no tile refers to any more (evicted or overwritten); return (images, bytes).
+
+        Freed pages are reused by later writes, and returned to the
+        filesystem for files created with auto_vacuum (every file since
+        access tracking was added).
+        """
+        images = freed = 0
+        for layer, fmts in self._files().items():
+            for fmt in fmts:
+                conn = self._conn(layer, fmt)
+                where = ' FROM images WHERE tile_id NOT IN (SELECT tile_id FROM map)'
+                with _transaction(conn):
+                    count, size = conn.execute(
+                        'SELECT COUNT(*), COALESCE(SUM(length(tile_data)), 0)' + where,
+                    ).fetchone()
+                    conn.execute('DELETE' + where)
+                if count:
+                    conn.execute('PRAGMA incremental_vacuum').fetchall()
+                images += count
+                freed += size
+        return images, freed
+
+    def _files(self) -> dict[str, list[str]]:
+        """Formats on disk per layer, from <layer>.mbtiles and <layer>.<fmt>.mbtiles."""
+        found: dict[str, list[str]] = {}
+        for path in self.root.glob('**/*.mbtiles'):
+            layer, _, fmt = str(path.relative_to(self.root).with_suffix('')).partition('.')
+            found.setdefault(layer, []).append(fmt or 'png')
+        return found
+
+    @staticmethod
+    def _write(conn: sqlite3.Connection, *statements: tuple[str, Iterable[tuple]]) -> None:
+        """Run each (sql, rows) with executemany, all in one transaction."""
+        with _transaction(conn):
+            for sql, rows in statements:
+                conn.executemany(sql, rows)
+
+
+@contextmanager
+def _transaction(conn: sqlite3.Connection) -> Iterator[None]:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on any exception."""
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        yield
+    except BaseException:
+        conn.execute('ROLLBACK')
+        raise
+    conn.execute('COMMIT')
+
+
+def _create_schema(conn: sqlite3.Connection, layer: str, fmt: str) -> None:
+    """Create the tables, moving a file written before dedup (a plain tiles table) into map/images."""
+    for sql in _SCHEMA:
+        conn.execute(sql)
+    conn.executemany('INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)',
+                     [('name', layer), ('format', fmt), ('type', 'baselayer'), ('version', '1')])
+    kind = conn.execute("SELECT type FROM sqlite_master WHERE name='tiles'").fetchone()
+    if kind == ('view',):
+        return
+    if kind == ('table',):
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(tiles)')}
+        last_access = 'last_access' if 'last_access' in columns else '0'   # before access tracking
+        conn.execute('INSERT OR IGNORE INTO images (tile_id, tile_data)'
+                     ' SELECT tile_id(tile_data), tile_data FROM tiles')
+        conn.execute('INSERT OR REPLACE INTO map'
+                     ' (zoom_level, tile_column, tile_row, tile_id, last_access)'
+                     f' SELECT zoom_level, tile_column, tile_row, tile_id(tile_data), {last_access}'
+                     ' FROM tiles')
+        conn.execute('DROP TABLE tiles')
+        log.info('moved %s (%s) into deduplicated map/images tables', layer, fmt)
+    conn.execute(
+        'CREATE VIEW tiles AS SELECT map.zoom_level AS zoom_level, map.tile_column AS tile_column,'
+        ' map.tile_row AS tile_row, images.tile_data AS tile_data'
+        ' FROM map JOIN images ON images.tile_id = map.tile_id'
+    )
+
+
+def _tile_id(data: bytes) -> str:
+    """Content hash naming a deduplicated tile (blob file name, or MBTiles tile_id)."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _stamp(path) -> Path:
+    """The empty file whose mtime is a deduplicated tile's own last read."""
+    path = Path(path)
+    return path.with_name(f'.{path.name}.read')
+
+
+def _last_read(entry: os.DirEntry, st: os.stat_result) -> float:
+    """A tile's last read: its stamp if deduplicated (the blob's atime is shared), else its atime."""
+    if st.st_nlink > 1:
+        try:
+            return os.stat(_stamp(entry.path)).st_mtime
+        except OSError:
+            pass   # linked before stamps were kept
+    return st.st_atime
+
+
+def _share(st: os.stat_result) -> int:
+    """A tile file's share of its bytes: split between the tiles linked to one blob."""
+    return st.st_size // (st.st_nlink - 1) if st.st_nlink > 1 else st.st_size
+
+
+def _scandir(path) -> Iterator[os.DirEntry]:
+    try:
+        with os.scandir(path) as entries:
+            yield from entries
+    except FileNotFoundError:
+        return
+
+
+def create(root: Path, backend: str = _BACKEND) -> DirectoryStore | MBTilesStore:
+    """Build the tile store selected by TILE_CACHE_BACKEND ('dir' or 'mbtiles')."""
+    if backend == 'mbtiles':
+        return MBTilesStore(root)
+    if backend != 'dir':
+        log.warning('unknown TILE_CACHE_BACKEND=%r; using the directory store', backend)
+    return DirectoryStore(root)
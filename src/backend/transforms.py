@@ -1,146 +1,313 @@
-import base64
 import io
 import logging
 import os
+import time
+from functools import lru_cache
 
-import requests
-from PIL import Image, ImageEnhance, ImageFilter, ImageOps
+from PIL import Image, ImageEnhance, ImageFilter, ImageStat
+
+from . import executor, metrics
 
 log = logging.getLogger(__name__)
 
-_AI_URL = os.environ.get('AI_SERVICE_URL', '')
-_AI_KEY = os.environ.get('AI_SERVICE_KEY', '')
-_AI_VIBES = frozenset(v.strip() for v in os.environ.get('AI_VIBES', '').split(',') if v.strip())
-
-
-def transform(vibe: str, img_bytes: bytes, z: int, x: int, y: int) -> bytes:
-    """Return transformed PNG bytes for the given vibe."""
-    if _AI_URL and vibe in _AI_VIBES:
-        result = _try_ai(vibe, img_bytes, z, x, y)
-        if result:
-            return result
-
-    return _pil_transform(vibe, img_bytes)
-
-
-def _pil_transform(vibe: str, img_bytes: bytes) -> bytes:
-    img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
-
-    if vibe == 'vintage':
-        img = _sepia(img)
-        img = ImageEnhance.Brightness(img).enhance(0.88)
-        img = ImageEnhance.Contrast(img).enhance(0.82)
-    elif vibe == 'toner':
-        img = img.convert('L').convert('RGB')
-        img = ImageEnhance.Contrast(img).enhance(1.8)
-        img = ImageEnhance.Brightness(img).enhance(1.1)
-    elif vibe == 'blueprint':
-        img = _blueprint(img)
-    elif vibe == 'dark':
-        img = ImageOps.invert(img)
-        img = _channel_tint(img, 0.55, 0.60, 0.72)
-        img = ImageEnhance.Brightness(img).enhance(0.75)
-    elif vibe == 'watercolor':
-        img = ImageEnhance.Color(img).enhance(1.35)
-        img = ImageEnhance.Contrast(img).enhance(0.75)
-        img = img.filter(ImageFilter.GaussianBlur(radius=1.2))
-        img = ImageEnhance.Color(img).enhance(1.4)
-    elif vibe == 'highcontrast':
-        img = ImageEnhance.Contrast(img).enhance(2.2)
-        img = ImageEnhance.Color(img).enhance(1.6)
-    elif vibe == 'noir':
-        img = ImageEnhance.Color(img).enhance(0.15)
-        img = _channel_tint(img, 0.55, 0.65, 0.72)
-        img = ImageEnhance.Brightness(img).enhance(0.58)
-        img = ImageEnhance.Contrast(img).enhance(1.15)
-    elif vibe == 'mockva':
-        img = img.convert('L').convert('RGB')
-        r, g, b = img.split()
-        r_lut = [int(42 + 198 * v / 255) for v in range(256)]
-        g_lut = [int(34 + 198 * v / 255) for v in range(256)]
-        b_lut = [int(24 + 192 * v / 255) for v in range(256)]
-        img = Image.merge('RGB', (r.point(r_lut), g.point(g_lut), b.point(b_lut)))
-        img = ImageOps.posterize(img, 3)
-    elif vibe == 'mario':
-        img = ImageEnhance.Color(img).enhance(2.5)
-        img = ImageEnhance.Contrast(img).enhance(1.8)
-        img = ImageOps.posterize(img, 3)
-    elif vibe == 'simcity':
-        img = ImageOps.posterize(img, 4)
-        img = ImageEnhance.Color(img).enhance(0.85)
-        img = ImageEnhance.Contrast(img).enhance(1.1)
-    elif vibe == 'tomclancy':
-        gray = img.convert('L')
-        r_lut = [int(30 * v / 255) for v in range(256)]
-        g_lut = [int(10 + 190 * v / 255) for v in range(256)]
-        b_lut = [int(30 * v / 255) for v in range(256)]
-        img = Image.merge('RGB', (gray.point(r_lut), gray.point(g_lut), gray.point(b_lut)))
-        img = ImageEnhance.Contrast(img).enhance(2.0)
-        img = ImageEnhance.Sharpness(img).enhance(1.8)
-    elif vibe == 'deco':
-        img = _channel_tint(img, 1.05, 1.0, 0.78)
-        img = ImageEnhance.Contrast(img).enhance(1.3)
-        img = ImageEnhance.Sharpness(img).enhance(1.4)
-    elif vibe == 'metro':
-        img = _channel_tint(img, 1.04, 1.0, 0.82)
-        img = ImageEnhance.Color(img).enhance(0.75)
-        img = ImageEnhance.Contrast(img).enhance(0.85)
-
-    buf = io.BytesIO()
-    img.save(buf, format='PNG')
-    return buf.getvalue()
-
-
-def _sepia(img: Image.Image) -> Image.Image:
-    """Full 3x3 sepia matrix via getdata/putdata -- no numpy needed."""
-    r_data, g_data, b_data = [list(ch.getdata()) for ch in img.split()]
-    pixels = [
-        (min(255, int(0.393 * r + 0.769 * g + 0.189 * b)),
-         min(255, int(0.349 * r + 0.686 * g + 0.168 * b)),
-         min(255, int(0.272 * r + 0.534 * g + 0.131 * b)))
-        for r, g, b in zip(r_data, g_data, b_data)
-    ]
-    out = Image.new('RGB', img.size)
-    out.putdata(pixels)
-    return out
-
-
-def _blueprint(img: Image.Image) -> Image.Image:
-    """Grayscale -> remap into blue range #0a1f5c..#dce8ff via per-channel LUT."""
-    gray = img.convert('L')
-    r_lut = [int(10  + 210 * v / 255) for v in range(256)]
-    g_lut = [int(31  + 201 * v / 255) for v in range(256)]
-    b_lut = [int(92  + 163 * v / 255) for v in range(256)]
-    return Image.merge('RGB', (gray.point(r_lut), gray.point(g_lut), gray.point(b_lut)))
-
-
-def _channel_tint(img: Image.Image, rf: float, gf: float, bf: float) -> Image.Image:
-    """Scale each channel by the given factors."""
-    r, g, b = img.split()
-    r_lut = [int(v * rf) for v in range(256)]
-    g_lut = [int(v * gf) for v in range(256)]
-    b_lut = [int(v * bf) for v in range(256)]
-    return Image.merge('RGB', (r.point(r_lut), g.point(g_lut), b.point(b_lut)))
-
-
-def _try_ai(vibe: str, img_bytes: bytes, z: int, x: int, y: int) -> bytes | None:
-    """POST to AI_SERVICE_URL; return transformed PNG bytes, or None on failure."""
-    try:
-        payload = {
-            'style': vibe,
-            'image_b64': base64.b64encode(img_bytes).decode(),
-            'tile_z': z,
-            'tile_x': x,
-            'tile_y': y,
-        }
-        headers = {'Content-Type': 'application/json'}
-        if _AI_KEY:
-            headers['Authorization'] = f'Bearer {_AI_KEY}'
-        resp = requests.post(_AI_URL, json=payload, headers=headers, timeout=30)
-        resp.raise_for_status()
-        if 'image' in resp.headers.get('Content-Type', ''):
-            return resp.content
-        return base64.b64decode(resp.json()['image_b64'])
-    except Exception:
-        log.warning('AI tile transform failed vibe=%s z=%d x=%d y=%d', vibe, z, x, y, exc_info=True)
+_PNG_COMPRESS_LEVEL = int(os.environ.get('TILE_PNG_COMPRESS_LEVEL', '6'))
+_LOSSY_QUALITY      = int(os.environ.get('TILE_LOSSY_QUALITY', '85'))   # WebP / AVIF
+# Vibes whose output usually fits in 256 colours. When a tile really does,
+# it is written as a palette PNG (or lossless WebP) -- never quantized lossily.
+_PALETTE_VIBES = frozenset({'toner', 'blueprint', 'mockva', 'tomclancy', 'mario', 'simcity'})
+# Open ocean and uniform land come as (nearly) single-colour tiles: every
+# channel within TILE_FLAT_TOLERANCE levels (default 1, an invisible
+# dither; -1 turns this off). They are drawn as their most common colour
+# from a per-vibe table. Such tiles compress to well under _FLAT_MAX_BYTES;
+# only tiles that small are checked, on the image decoded for rendering.
+_FLAT_TOLERANCE = int(os.environ.get('TILE_FLAT_TOLERANCE', '1'))
+_FLAT_MAX_BYTES = 16384
+
+MIMETYPES = {'png': 'image/png', 'webp': 'image/webp', 'avif': 'image/avif'}
+
+Image.init()   # plugins only register a save handler if their codec library is present
+FORMATS = frozenset(fmt for fmt in MIMETYPES if fmt.upper() in Image.SAVE)
+
+
+def transform(vibe: str, img_bytes: bytes, fmt: str = 'png') -> bytes:
+    """Return the PIL-transformed tile for the given vibe, encoded as fmt (see FORMATS)."""
+    return transform_many([vibe], img_bytes, fmt)[vibe]
+
+
+def transform_many(vibes: list[str], img_bytes: bytes, fmt: str = 'png') -> dict[str, bytes]:
+    """Return transformed tiles for several vibes from one decode.
+
+    A single-colour tile is answered from a table of flat tiles per vibe,
+    colour and format instead of being rendered (see transform_pil).
+    """
+    return executor.render(vibes, img_bytes, fmt)
+
+
+async def transform_async(vibe: str, img_bytes: bytes, fmt: str = 'png') -> bytes:
+    """transform() for the ASGI app: PIL runs in the executor."""
+    return (await transform_many_async([vibe], img_bytes, fmt))[vibe]
+
+
+async def transform_many_async(vibes: list[str], img_bytes: bytes, fmt: str = 'png') -> dict[str, bytes]:
+    """transform_many() for the ASGI app."""
+    return await executor.render_async(vibes, img_bytes, fmt)
+
+
+def transform_flat(vibes: list[str], img_bytes: bytes, fmt: str = 'png') -> dict[str, bytes] | None:
+    """transform_pil() for a single-colour tile, from the flat-tile table; None for any other tile."""
+    if len(img_bytes) > _FLAT_MAX_BYTES:
         return None
+    return _from_flat_table(vibes, _decode(img_bytes), fmt)
+
+
+def transform_pil(vibes: list[str], img_bytes: bytes, fmt: str = 'png') -> dict[str, bytes]:
+    """PIL-only transforms for several vibes from one decode; what the executor runs."""
+    img = _decode(img_bytes)
+    flat = _from_flat_table(vibes, img, fmt) if len(img_bytes) <= _FLAT_MAX_BYTES else None
+    return flat if flat is not None else {vibe: _render(vibe, img, fmt) for vibe in vibes}
+
+
+def _from_flat_table(vibes: list[str], img: Image.Image, fmt: str) -> dict[str, bytes] | None:
+    flat = _flat_color(img)
+    if flat is None:
+        return None
+    for vibe in vibes:
+        metrics.FLAT_TILES.labels(vibe).inc()
+    return {vibe: _flat_tile(vibe, fmt, *flat, True) for vibe in vibes}
+
+
+def reencode(vibe: str, img_bytes: bytes, fmt: str) -> bytes:
+    """An already transformed PNG tile (e.g. from the AI service) as fmt, encoded like vibe's own."""
+    return img_bytes if fmt == 'png' else _encode(vibe, _decode(img_bytes), fmt)
+
+
+def overzoom(vibe: str, ancestor: bytes, dz: int, dx: int, dy: int, fmt: str = 'png') -> bytes:
+    """Synthesize a tile dz zooms below an already transformed ancestor tile.
+
+    (dx, dy) is its position in the ancestor's 2**dz grid. Palette vibes
+    scale nearest-neighbour to keep their flat colours (and palette PNG);
+    the rest bicubic.
+    """
+    img = _decode(ancestor)
+    flat = _flat_color(img) if len(ancestor) <= _FLAT_MAX_BYTES else None
+    if flat is not None:
+        metrics.FLAT_TILES.labels(vibe).inc()
+        return _flat_tile(vibe, fmt, *flat, False)
+    span = img.width / (1 << dz)
+    box = (dx * span, dy * span, (dx + 1) * span, (dy + 1) * span)
+    resample = Image.Resampling.NEAREST if vibe in _PALETTE_VIBES else Image.Resampling.BICUBIC
+    return _encode(vibe, img.resize(img.size, resample, box=box), fmt)
+
+
+# Each vibe is a chain of colour steps, compiled at import into the fewest
+# image passes: runs of channel-mixing steps fuse into one colour-matrix
+# convert, runs of per-channel steps into one point() curve, and only the
+# spatial steps (blur, sharpness) stay separate. Two exceptions keep posterize
+# from amplifying a level of rounding: each contrast starts a new curve, built
+# on the mean of its real input, and a colour step ahead of a posterize runs as
+# ImageEnhance.Color. tests/test_transforms.py holds all of it to the original chain.
+_VIBE_STEPS: dict[str, list[tuple]] = {
+    'default':      [],
+    'vintage':      [('sepia',), ('brightness', 0.88), ('contrast', 0.82)],
+    'toner':        [('grayscale',), ('contrast', 1.8), ('brightness', 1.1)],
+    # Grayscale -> remap into blue range #0a1f5c..#dce8ff
+    'blueprint':    [('grayscale',), ('remap', (10, 210), (31, 201), (92, 163))],
+    'dark':         [('invert',), ('tint', (0.55, 0.60, 0.72)), ('brightness', 0.75)],
+    'watercolor':   [('color', 1.35), ('contrast', 0.75), ('blur', 1.2), ('color', 1.4)],
+    'highcontrast': [('contrast', 2.2), ('color', 1.6)],
+    'noir':         [('color', 0.15), ('tint', (0.55, 0.65, 0.72)), ('brightness', 0.58),
+                     ('contrast', 1.15)],
+    'mockva':       [('grayscale',), ('remap', (42, 198), (34, 198), (24, 192)), ('posterize', 3)],
+    'mario':        [('color', 2.5), ('contrast', 1.8), ('posterize', 3)],
+    'simcity':      [('posterize', 4), ('color', 0.85), ('contrast', 1.1)],
+    'tomclancy':    [('grayscale',), ('remap', (0, 30), (10, 190), (0, 30)), ('contrast', 2.0),
+                     ('sharpness', 1.8)],
+    'deco':         [('tint', (1.05, 1.0, 0.78)), ('contrast', 1.3), ('sharpness', 1.4)],
+    'metro':        [('tint', (1.04, 1.0, 0.82)), ('color', 0.75), ('contrast', 0.85)],
+}
+
+_LUMA    = (0.299, 0.587, 0.114)
+_SPATIAL = frozenset({'blur', 'sharpness'})
+_MIXING  = frozenset({'grayscale', 'color', 'sepia'})   # each output reads all channels
+
+_Matrix = tuple[tuple[float, float, float, float], ...]   # 3 rows of (r, g, b, offset)
+
+
+def _step_matrix(step: tuple) -> _Matrix:
+    name = step[0]
+    if name == 'grayscale':
+        return (_LUMA + (0.0,),) * 3
+    if name == 'sepia':
+        return ((0.393, 0.769, 0.189, 0.0),
+                (0.349, 0.686, 0.168, 0.0),
+                (0.272, 0.534, 0.131, 0.0))
+    f = step[1]   # color: blend from luma towards the original by f
+    return tuple(
+        tuple((1 - f) * w + (f if i == c else 0.0) for i, w in enumerate(_LUMA)) + (0.0,)
+        for c in range(3)
+    )
+
+
+def _compose(outer: _Matrix, inner: _Matrix) -> _Matrix:
+    return tuple(
+        tuple(sum(row[k] * inner[k][i] for k in range(3)) + (row[3] if i == 3 else 0.0)
+              for i in range(4))
+        for row in outer
+    )
+
+
+def _in_range(m: _Matrix) -> bool:
+    """True if m can never leave 0..255, i.e. clipping after it is a no-op."""
+    corners = [(r, g, b) for r in (0, 255) for g in (0, 255) for b in (0, 255)]
+    return all(
+        -0.5 <= row[0] * r + row[1] * g + row[2] * b + row[3] <= 255.5
+        for row in m for r, g, b in corners
+    )
+
+
+def _curve_step(step: tuple, c: int, v: int, mean: int) -> int:
+    """Apply one per-channel step to value v of channel c, truncating like PIL."""
+    name = step[0]
+    if name == 'contrast':
+        out = mean + step[1] * (v - mean)
+    elif name == 'brightness':
+        out = step[1] * v
+    elif name == 'tint':
+        out = step[1][c] * v
+    elif name == 'remap':
+        lo, span = step[1 + c]
+        out = lo + span * v / 255
+    elif name == 'invert':
+        out = 255 - v
+    else:  # posterize
+        return v & ~(2 ** (8 - step[1]) - 1)
+    return 0 if out <= 0 else 255 if out >= 255 else int(out)
+
+
+def _build_curves(steps: list[tuple], mean: int = 0) -> list[int]:
+    """Fold per-channel steps into one 768-entry point() table.
+
+    mean is the luma a leading contrast step blends towards (see _luma_mean).
+    """
+    lut = list(range(256)) * 3
+    for step in steps:
+        lut = [_curve_step(step, i >> 8, lut[i], mean) for i in range(768)]
+    return lut
+
+
+def _luma_mean(img: Image.Image) -> int:
+    """The mean ImageEnhance.Contrast blends towards: of the rounded 'L' image, rounded.
+
+    Computing it from the RGB histogram instead is off by a level now and
+    then, enough to move whole flat areas across a posterize step.
+    """
+    return int(ImageStat.Stat(img.convert('L')).mean[0] + 0.5)
+
+
+def _compile(steps: list[tuple]) -> list[tuple]:
+    """Group a vibe's steps into (kind, arg) passes for _render."""
+    passes: list[list] = []   # [kind, matrix | steps | filter arg, steps fused so far]
+    for i, step in enumerate(steps):
+        name = step[0]
+        cur = passes[-1] if passes else None
+        if name in _SPATIAL:
+            arg = ImageFilter.GaussianBlur(radius=step[1]) if name == 'blur' else step[1]
+            passes.append([name, arg, [step]])
+        elif name == 'color' and any(s[0] == 'posterize' for s in steps[i + 1:]):
+            # The matrix rounds where ImageEnhance truncates against a rounded
+            # luma; a level off here is a whole posterize step further on.
+            passes.append(['color', step[1], [step]])
+        elif name in _MIXING:
+            # Only fuse if the previous matrix can't clip, so the skipped
+            # intermediate clip would have been a no-op anyway.
+            if cur and cur[0] == 'matrix' and _in_range(cur[1]):
+                cur[1] = _compose(_step_matrix(step), cur[1])
+                cur[2].append(step)
+            else:
+                passes.append(['matrix', _step_matrix(step), [step]])
+        elif name != 'contrast' and cur and cur[0] == 'curves':
+            cur[1].append(step)
+        else:
+            # Contrast needs the mean of the image in front of it, so it
+            # always starts a pass of its own, which is materialized first.
+            passes.append(['curves', [step], None])
+
+    compiled = []
+    for kind, arg, fused in passes:
+        if kind == 'matrix':
+            # PIL rounds the matrix result where sepia/color truncated each
+            # step; bias the offset by the expected half-level per step.
+            bias = 0.5 * sum(s[0] != 'grayscale' for s in fused)
+            arg = tuple(v - bias if i == 3 else v for row in arg for i, v in enumerate(row))
+        elif kind == 'curves' and arg[0][0] != 'contrast':
+            kind, arg = 'lut', _build_curves(arg)
+        compiled.append((kind, arg))
+    return compiled
+
+
+_PIPELINES: dict[str, list[tuple]] = {vibe: _compile(steps) for vibe, steps in _VIBE_STEPS.items()}
+
+
+def _decode(img_bytes: bytes) -> Image.Image:
+    with metrics.stage('decode'):
+        return Image.open(io.BytesIO(img_bytes)).convert('RGB')
+
+
+def _flat_color(img: Image.Image) -> tuple[tuple[int, ...], tuple[int, int]] | None:
+    """(colour, size) of a flat tile (see _FLAT_TOLERANCE); None for any other."""
+    if _FLAT_TOLERANCE < 0:
+        return None
+    if any(hi - lo > _FLAT_TOLERANCE for lo, hi in img.getextrema()):
+        return None
+    _, color = max(img.getcolors((_FLAT_TOLERANCE + 1) ** 3))
+    return color, img.size
+
+
+@lru_cache(maxsize=4096)
+def _flat_tile(vibe: str, fmt: str, color: tuple[int, ...], size: tuple[int, int], transform: bool) -> bytes:
+    """A tile of one colour, encoded for vibe: rendered through its pipeline, or as already transformed.
+
+    For an exactly single-colour tile this is byte-identical to what
+    _render/_encode make of it.
+    """
+    img = Image.new('RGB', size, color)
+    return _render(vibe, img, fmt) if transform else _encode(vibe, img, fmt)
+
+
+def _render(vibe: str, img: Image.Image, fmt: str = 'png') -> bytes:
+    start = time.perf_counter()
+    for kind, arg in _PIPELINES.get(vibe, ()):
+        if kind == 'matrix':
+            img = img.convert('RGB', arg)
+        elif kind == 'lut':
+            img = img.point(arg)
+        elif kind == 'curves':
+            img = img.point(_build_curves(arg, _luma_mean(img)))
+        elif kind == 'blur':
+            img = img.filter(arg)
+        elif kind == 'sharpness':
+            img = ImageEnhance.Sharpness(img).enhance(arg)
+        elif kind == 'color':
+            img = ImageEnhance.Color(img).enhance(arg)
+    metrics.TRANSFORM_SECONDS.labels(vibe).observe(time.perf_counter() - start)
+
+    return _encode(vibe, img, fmt)
+
+
+def _encode(vibe: str, img: Image.Image, fmt: str) -> bytes:
+    with metrics.stage('encode'):
+        palette = vibe in _PALETTE_VIBES and img.getcolors(256) is not None
+        buf = io.BytesIO()
+        if fmt == 'webp':
+            if palette:
+                img.save(buf, format='WEBP', lossless=True)
+            else:
+                img.save(buf, format='WEBP', quality=_LOSSY_QUALITY, method=3)
+        elif fmt == 'avif':
+            img.save(buf, format='AVIF', quality=_LOSSY_QUALITY)
+        else:
+            if palette:
+                # Median cut keeps every colour exactly when there are <= 256 of them.
+                img = img.quantize(256, method=Image.Quantize.MEDIANCUT, dither=Image.Dither.NONE)
+            img.save(buf, format='PNG', compress_level=_PNG_COMPRESS_LEVEL)
+        return buf.getvalue()
@@ -0,0 +1,410 @@
+"""Shared HTTP clients for upstream tile, style and AI calls.
+
+Each client keeps one pooled requests.Session per worker process, caps its
+concurrent requests, retries transient failures with jittered backoff,
+optionally hedges slow GETs with a second request, and trips a circuit
+breaker that fails fast while the upstream is down.
+
+The a*-methods do the same on asyncio for the ASGI app, through one
+httpx.AsyncClient per event loop; they share the breaker and stats.
+RateLimiter paces callers that budget their own request rate (the
+seeder, the AI queue).
+"""
+
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+_RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+
+class CircuitOpenError(requests.RequestException):
+    """Raised without touching the network while a client's breaker is open."""
+
+
+class UpstreamBusyError(requests.RequestException):
+    """Raised when no concurrency slot frees up within the request timeout."""
+
+
+class _Breaker:
+    """Opens after `threshold` consecutive failures; lets one probe through after `reset_after` s."""
+
+    def __init__(self, threshold: int, reset_after: float) -> None:
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        return 'half-open' if self._probing else 'open'
+
+    def allow(self) -> str | None:
+        """'closed' to go ahead, 'probe' for the one half-open probe, None to fail fast.
+
+        A probe must end in record() or release(), or the breaker stays half-open.
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return 'closed'
+            if self._probing or time.monotonic() - self.opened_at < self.reset_after:
+                return None
+            self._probing = True
+            return 'probe'
+
+    def record(self, ok: bool) -> None:
+        with self._lock:
+            self._probing = False
+            if ok:
+                self.failures = 0
+                self.opened_at = None
+                return
+            self.failures += 1
+            if self.threshold and (self.opened_at is not None or self.failures >= self.threshold):
+                self.opened_at = time.monotonic()
+
+    def release(self) -> None:
+        """End a probe that neither succeeded nor failed (an unexpected error, a cancelled caller)."""
+        with self._lock:
+            self._probing = False
+
+
+class RateLimiter:
+    """Token bucket: at most `rate` acquisitions per second, bursting to `burst`."""
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+class UpstreamClient:
+    def __init__(self, name: str, *, max_concurrency: int, retries: int, backoff: float,
+                 hedge_after: float, breaker_threshold: int, breaker_reset: float) -> None:
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.hedge_after = hedge_after
+        self._breaker = _Breaker(breaker_threshold, breaker_reset)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._pid: int | None = None
+        self._session: requests.Session | None = None
+        self._pool: ThreadPoolExecutor | None = None
+        self._aloop: asyncio.AbstractEventLoop | None = None
+        self._aclient: httpx.AsyncClient | None = None
+        self._aslots: asyncio.Semaphore | None = None
+        self._lock = threading.Lock()
+        self._counts: Counter[str] = Counter()
+        self._statuses: Counter[int] = Counter()
+        self._latency_total = 0.0
+        self.in_flight = 0
+
+    def _ensure(self) -> requests.Session:
+        # Sessions and pools don't survive fork; rebuild them in each worker.
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.max_concurrency)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._pool = ThreadPoolExecutor(self.max_concurrency * 2,
+                                                    thread_name_prefix=f'upstream-{self.name}')
+                    self._slots = threading.BoundedSemaphore(self.max_concurrency)
+                    self._pid = os.getpid()
+        return self._session  # type: ignore[return-value]
+
+    def get(self, url: str, *, timeout: float, **kwargs) -> requests.Response:
+        return self.request('GET', url, timeout=timeout, hedge=self.hedge_after > 0, **kwargs)
+
+    def post(self, url: str, *, timeout: float, **kwargs) -> requests.Response:
+        return self.request('POST', url, timeout=timeout, hedge=False, **kwargs)
+
+    def request(self, method: str, url: str, *, timeout: float, hedge: bool = False,
+                **kwargs) -> requests.Response:
+        """Send with retries; returns the final response (4xx included) or raises."""
+        session = self._ensure()
+        admitted = self._breaker.allow()
+        if admitted is None:
+            self._count('circuit_rejected')
+            raise CircuitOpenError(f'{self.name} circuit open')
+        try:
+            return self._attempts(session, method, url, timeout, hedge, kwargs)
+        except BaseException:
+            if admitted == 'probe':
+                self._breaker.release()   # e.g. InvalidURL, SSLError: not a verdict on the upstream
+            raise
+
+    def _attempts(self, session: requests.Session, method: str, url: str, timeout: float,
+                  hedge: bool, kwargs: dict) -> requests.Response:
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count('retries')
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            try:
+                if hedge:
+                    resp = self._send_hedged(session, method, url, timeout, kwargs)
+                else:
+                    resp = self._send(session, method, url, timeout, kwargs)
+            except (requests.ConnectionError, requests.Timeout, UpstreamBusyError) as exc:
+                error: Exception | None = exc
+                resp = None
+            else:
+                error = None
+                if resp.status_code not in _RETRY_STATUSES:
+                    self._breaker.record(True)
+                    return resp
+
+        self._count('failures')
+        self._breaker.record(False)
+        if resp is not None:
+            return resp
+        raise error  # type: ignore[misc]
+
+    def _send(self, session: requests.Session, method: str, url: str, timeout: float,
+              kwargs: dict, wait_for_slot: bool = True) -> requests.Response:
+        if not self._slots.acquire(timeout=timeout if wait_for_slot else 0):
+            raise UpstreamBusyError(f'{self.name}: no free upstream slot')
+        with self._lock:
+            self.in_flight += 1
+        start = time.monotonic()
+        try:
+            resp = session.request(method, url, timeout=timeout, **kwargs)
+        except Exception:
+            metrics.UPSTREAM_RESPONSES.labels(self.name, 'error').inc()
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self._latency_total += time.monotonic() - start
+                self._counts['requests'] += 1
+            self._slots.release()
+        with self._lock:
+            self._statuses[resp.status_code] += 1
+        metrics.UPSTREAM_RESPONSES.labels(self.name, str(resp.status_code)).inc()
+        return resp
+
+    def _send_hedged(self, session: requests.Session, method: str, url: str, timeout: float,
+                     kwargs: dict) -> requests.Response:
+        """Fire a second copy if the first hasn't answered after hedge_after s; first to finish wins."""
+        pool = self._pool
+        primary = pool.submit(self._send, session, method, url, timeout, kwargs)  # type: ignore[union-attr]
+        done, _ = wait([primary], timeout=self.hedge_after)
+        if done:
+            return primary.result()
+
+        self._count('hedges')
+        hedge = pool.submit(self._send, session, method, url, timeout, kwargs, False)  # type: ignore[union-attr]
+        pending = {primary, hedge}
+        error: BaseException | None = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                if fut.exception() is None:
+                    if fut is hedge:
+                        self._count('hedge_wins')
+                    return fut.result()
+                if fut is primary or error is None:
+                    error = fut.exception()
+        raise error  # type: ignore[misc]
+
+    def _ensure_async(self) -> tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        loop = asyncio.get_running_loop()
+        if self._aloop is not loop:
+            self._aclient = httpx.AsyncClient(
+                follow_redirects=True,
+                limits=httpx.Limits(max_connections=self.max_concurrency * 2,
+                                    max_keepalive_connections=self.max_concurrency),
+            )
+            self._aslots = asyncio.Semaphore(self.max_concurrency)
+            self._aloop = loop
+        return self._aclient, self._aslots  # type: ignore[return-value]
+
+    async def aget(self, url: str, *, timeout: float, **kwargs) -> httpx.Response:
+        return await self.arequest('GET', url, timeout=timeout, hedge=self.hedge_after > 0, **kwargs)
+
+    async def apost(self, url: str, *, timeout: float, **kwargs) -> httpx.Response:
+        return await self.arequest('POST', url, timeout=timeout, hedge=False, **kwargs)
+
+    async def arequest(self, method: str, url: str, *, timeout: float, hedge: bool = False,
+                       **kwargs) -> httpx.Response:
+        """request() on asyncio; same retries, hedging and breaker."""
+        client, slots = self._ensure_async()
+        admitted = self._breaker.allow()
+        if admitted is None:
+            self._count('circuit_rejected')
+            raise CircuitOpenError(f'{self.name} circuit open')
+        try:
+            return await self._aattempts(client, slots, method, url, timeout, hedge, kwargs)
+        except BaseException:
+            if admitted == 'probe':
+                self._breaker.release()   # also a client disconnect cancelling the request
+            raise
+
+    async def _aattempts(self, client: httpx.AsyncClient, slots: asyncio.Semaphore, method: str,
+                         url: str, timeout: float, hedge: bool, kwargs: dict) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._count('retries')
+                await asyncio.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+            try:
+                if hedge:
+                    resp = await self._asend_hedged(client, slots, method, url, timeout, kwargs)
+                else:
+                    resp = await self._asend(client, slots, method, url, timeout, kwargs)
+            except (httpx.TransportError, UpstreamBusyError) as exc:
+                error: Exception | None = exc
+                resp = None
+            else:
+                error = None
+                if resp.status_code not in _RETRY_STATUSES:
+                    self._breaker.record(True)
+                    return resp
+
+        self._count('failures')
+        self._breaker.record(False)
+        if resp is not None:
+            return resp
+        raise error  # type: ignore[misc]
+
+    async def _asend(self, client: httpx.AsyncClient, slots: asyncio.Semaphore, method: str,
+                     url: str, timeout: float, kwargs: dict,
+                     wait_for_slot: bool = True) -> httpx.Response:
+        try:
+            if not wait_for_slot and slots.locked():
+                raise TimeoutError
+            await asyncio.wait_for(slots.acquire(), timeout)
+        except TimeoutError:
+            raise UpstreamBusyError(f'{self.name}: no free upstream slot') from None
+        with self._lock:
+            self.in_flight += 1
+        start = time.monotonic()
+        try:
+            resp = await client.request(method, url, timeout=timeout, **kwargs)
+        except Exception:
+            metrics.UPSTREAM_RESPONSES.labels(self.name, 'error').inc()
+            raise
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self._latency_total += time.monotonic() - start
+                self._counts['requests'] += 1
+            slots.release()
+        with self._lock:
+            self._statuses[resp.status_code] += 1
+        metrics.UPSTREAM_RESPONSES.labels(self.name, str(resp.status_code)).inc()
+        return resp
+
+    async def _asend_hedged(self, client: httpx.AsyncClient, slots: asyncio.Semaphore, method: str,
+                            url: str, timeout: float, kwargs: dict) -> httpx.Response:
+        """_send_hedged() on asyncio; the losing request is cancelled rather than left to finish."""
+        primary = asyncio.ensure_future(self._asend(client, slots, method, url, timeout, kwargs))
+        done, _ = await asyncio.wait({primary}, timeout=self.hedge_after)
+        if done:
+            return primary.result()
+
+        self._count('hedges')
+        hedge = asyncio.ensure_future(self._asend(client, slots, method, url, timeout, kwargs, False))
+        pending = {primary, hedge}
+        error: BaseException | None = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for fut in done:
+                    if fut.exception() is None:
+                        if fut is hedge:
+                            self._count('hedge_wins')
+                        return fut.result()
+                    if fut is primary or error is None:
+                        error = fut.exception()
+        finally:
+            for fut in pending:
+                fut.cancel()
+        raise error  # type: ignore[misc]
+
+    async def aclose(self) -> None:
+        if self._aclient is not None:
+            await self._aclient.aclose()
+        self._aloop = self._aclient = self._aslots = None
+
+    def _count(self, key: str) -> None:
+        with self._lock:
+            self._counts[key] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests_sent = self._counts['requests']
+            return {
+                **self._counts,
+                'in_flight': self.in_flight,
+                'statuses': {str(k): v for k, v in self._statuses.items()},
+                'latency_avg_ms': round(1000 * self._latency_total / requests_sent, 1) if requests_sent else None,
+                'circuit': self._breaker.state,
+            }
+
+
+def _client(name: str, prefix: str, **defaults) -> UpstreamClient:
+    def env(key: str, cast: type):
+        return cast(os.environ.get(f'{prefix}_{key.upper()}', defaults[key]))
+    return UpstreamClient(
+        name,
+        max_concurrency=env('max_concurrency', int),
+        retries=env('retries', int),
+        backoff=env('backoff', float),
+        hedge_after=env('hedge_after', float),
+        breaker_threshold=env('breaker_threshold', int),
+        breaker_reset=env('breaker_reset', float),
+    )
+
+
+# OpenFreeMap serves both the ne2sr raster tiles and the Liberty style.
+openfreemap = _client('openfreemap', 'UPSTREAM', max_concurrency=8, retries=2, backoff=0.2,
+                      hedge_after=1.0, breaker_threshold=5, breaker_reset=30.0)
+# AI calls are slow and not idempotent enough to duplicate: no hedging, no retries.
+ai = _client('ai', 'AI_UPSTREAM', max_concurrency=4, retries=0, backoff=0.0,
+             hedge_after=0.0, breaker_threshold=3, breaker_reset=60.0)
+
+
+def stats() -> dict:
+    return {client.name: client.stats() for client in (openfreemap, ai)}
+
+
+async def aclose() -> None:
+    """Close the async clients; called on ASGI lifespan shutdown."""
+    for client in (openfreemap, ai):
+        await client.aclose()
@@ -0,0 +1,23 @@
+"""Plain-WSGI entry point: raster cache hits answered without Flask.
+
+    gunicorn -c gunicorn.conf.py src.backend.wsgi:app
+
+A GET or HEAD for /api/tiles/raster/... that hits the hot or disk cache is
+answered by tiles.raster_hit() straight from the WSGI environ -- no URL
+map, request context or after_request hooks. Misses and every other route
+go to the Flask app unchanged. With SENDFILE set a disk hit is only
+headers, and the front proxy sends the file.
+"""
+
+from . import tiles
+from .app import add_cors, app as flask_app
+
+
+def app(environ, start_response):
+    if environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+        match = tiles.RASTER_PATH.fullmatch(environ.get('PATH_INFO', ''))
+        if match is not None:
+            resp = tiles.raster_hit(match[1], int(match[2]), int(match[3]), int(match[4]), environ)
+            if resp is not None:
+                return add_cors(resp)(environ, start_response)
+    return flask_app(environ, start_response)
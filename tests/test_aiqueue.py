@@ -0,0 +1,167 @@
+"""AIQueue against a local stub AI service: batching, per-vibe limits, retries, formats."""
+
+import base64
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from src.backend import aiqueue
+from src.backend.upstream import UpstreamClient
+
+
+class _Stub(BaseHTTPRequestHandler):
+    # Answers each tile with b'ai:' + its bytes; tiles in `fail` make the whole POST a 500.
+    delay = 0.0
+    fail: set = set()
+    calls: list = []             # (style, [(z, x, y), ...], started at)
+    in_flight: dict = {}
+    peak: dict = {}
+    lock = threading.Lock()
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        tiles = body.get('tiles', [body])
+        keys = [(t['tile_z'], t['tile_x'], t['tile_y']) for t in tiles]
+        style = body['style']
+        with self.lock:
+            self.calls.append((style, keys, time.monotonic()))
+            self.in_flight[style] = self.in_flight.get(style, 0) + 1
+            self.peak[style] = max(self.peak.get(style, 0), self.in_flight[style])
+        time.sleep(self.delay)
+        with self.lock:
+            self.in_flight[style] -= 1
+        if self.fail & set(keys):
+            self.send_response(500)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        images = [{'image_b64': base64.b64encode(b'ai:' + base64.b64decode(t['image_b64'])).decode()}
+                  for t in tiles]
+        data = json.dumps({'tiles': images} if 'tiles' in body else images[0]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    _Stub.delay, _Stub.fail, _Stub.calls, _Stub.in_flight, _Stub.peak = 0.0, set(), [], {}, {}
+    monkeypatch.setattr(aiqueue, 'ai_client', UpstreamClient(
+        'ai-test', max_concurrency=8, retries=0, backoff=0.0, hedge_after=0.0,
+        breaker_threshold=0, breaker_reset=60.0))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Stub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/'
+    server.shutdown()
+    server.server_close()
+
+
+class _Results:
+    """on_result callback recording every call; `gate` (if set) holds calls until opened."""
+
+    def __init__(self) -> None:
+        self.calls: list = []   # (vibe, z, x, y, data, fmts)
+        self.entered = threading.Event()
+        self.gate: threading.Event | None = None
+
+    def __call__(self, vibe, z, x, y, data, fmts) -> None:
+        self.entered.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.calls.append((vibe, z, x, y, data, set(fmts)))
+
+
+def _queue(url: str, results: _Results, **kwargs) -> aiqueue.AIQueue:
+    settings = dict(vibes=frozenset({'watercolor', 'sketch'}), workers=4, batch_size=1,
+                    batch_wait=0.0, concurrency={'': 4}, rate={'': 0}, retry_after=60.0)
+    return aiqueue.AIQueue(results, url=url, **{**settings, **kwargs})
+
+
+def _wait_for(check, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_tiles_are_sent_in_batches(stub):
+    results = _Results()
+    queue = _queue(stub, results, workers=1, batch_size=4, batch_wait=0.3)
+    for y in range(5):
+        queue.submit('watercolor', 3, 1, y, 'png', b'raw%d' % y)
+
+    _wait_for(lambda: len(results.calls) == 5)
+    assert [len(keys) for _, keys, _ in _Stub.calls] == [4, 1]   # a full batch, then one after the wait
+    assert sorted(call[4] for call in results.calls) == [b'ai:raw%d' % y for y in range(5)]
+    assert queue.stats()['batches'] == 2 and queue.stats()['ok'] == 5
+
+
+def test_concurrency_is_capped_per_vibe(stub):
+    _Stub.delay = 0.3
+    results = _Results()
+    queue = _queue(stub, results, concurrency={'': 3, 'sketch': 1})
+    for y in range(3):
+        queue.submit('sketch', 3, 1, y, 'png', b'raw')
+        queue.submit('watercolor', 3, 1, y, 'png', b'raw')
+
+    _wait_for(lambda: len(results.calls) == 6)
+    assert _Stub.peak == {'sketch': 1, 'watercolor': 3}
+
+
+def test_batches_are_rate_limited_per_vibe(stub):
+    results = _Results()
+    queue = _queue(stub, results, rate={'': 0, 'sketch': 5})
+    for y in range(4):
+        queue.submit('sketch', 3, 1, y, 'png', b'raw')
+        queue.submit('watercolor', 3, 1, y, 'png', b'raw')
+
+    _wait_for(lambda: len(results.calls) == 8)
+    starts = {vibe: [at for style, _, at in _Stub.calls if style == vibe] for vibe in ('sketch', 'watercolor')}
+    assert max(starts['sketch']) - min(starts['sketch']) >= 0.5     # 4 batches at 5/s
+    assert max(starts['watercolor']) - min(starts['watercolor']) < 0.3
+
+
+def test_failed_tile_is_not_retried_until_its_ttl_passes(stub):
+    _Stub.fail = {(3, 1, 1)}
+    results = _Results()
+    queue = _queue(stub, results, retry_after=0.5)
+    queue.submit('watercolor', 3, 1, 1, 'png', b'raw')
+
+    _wait_for(lambda: queue.stats()['fallback'] == 1)
+    assert results.calls == []   # the PIL rendering stays
+    assert not queue.wants('watercolor', 3, 1, 1)
+    queue.submit('watercolor', 3, 1, 1, 'png', b'raw')
+    time.sleep(0.1)
+    assert len(_Stub.calls) == 1
+
+    time.sleep(0.5)
+    _Stub.fail = set()
+    assert queue.wants('watercolor', 3, 1, 1)
+    queue.submit('watercolor', 3, 1, 1, 'png', b'raw')
+    _wait_for(lambda: queue.stats()['ok'] == 1)
+    assert len(_Stub.calls) == 2
+
+
+def test_result_is_stored_in_every_format_asked_for(stub):
+    results = _Results()
+    results.gate = threading.Event()
+    queue = _queue(stub, results, workers=1, batch_wait=0.2)
+    queue.submit('watercolor', 3, 1, 1, 'png', b'raw')
+    queue.submit('watercolor', 3, 1, 1, 'webp', b'raw')   # while queued: joins the same job
+
+    assert results.entered.wait(5)
+    queue.submit('watercolor', 3, 1, 1, 'avif', b'raw')   # while the first formats are being stored
+    results.gate.set()
+
+    _wait_for(lambda: queue.stats()['running'] == 0)
+    assert len(_Stub.calls) == 1
+    assert [call[5] for call in results.calls] == [{'png', 'webp'}, {'avif'}]
+    assert all(call[4] == b'ai:raw' for call in results.calls)
@@ -0,0 +1,56 @@
+"""Hot-tile tiers: the shared slab under concurrent writers."""
+
+import struct
+import threading
+
+from src.backend import hotcache
+
+
+class _PausingHeader:
+    """hotcache._HEADER, but the thread named 'paused' stops before publishing its header."""
+
+    def __init__(self) -> None:
+        self._real = struct.Struct(hotcache._HEADER.format)
+        self.size = self._real.size
+        self.reached = threading.Event()
+        self.resume = threading.Event()
+
+    def unpack_from(self, buf, off):
+        return self._real.unpack_from(buf, off)
+
+    def pack_into(self, buf, off, seq, key_hash, length):
+        if threading.current_thread().name == 'paused' and key_hash:
+            self.reached.set()
+            self.resume.wait(5)
+        self._real.pack_into(buf, off, seq, key_hash, length)
+
+
+def test_same_slot_writers_in_one_process_do_not_interleave(tmp_path, monkeypatch):
+    header = _PausingHeader()
+    monkeypatch.setattr(hotcache, '_HEADER', header)
+    cache = hotcache.SharedSlabCache(str(tmp_path / 'slab'), 200_000, 100_000)
+    assert cache.slots == 1   # every key collides
+
+    a, b = b'A' * 90_000, b'BBB'
+    writer_a = threading.Thread(target=cache.put, args=('a', a), name='paused')
+    writer_b = threading.Thread(target=cache.put, args=('b', b))
+    writer_a.start()
+    assert header.reached.wait(5)
+    writer_b.start()
+    writer_b.join(0.2)
+    assert writer_b.is_alive()   # held off until a's write is complete
+    header.resume.set()
+    writer_a.join(5)
+    writer_b.join(5)
+
+    assert cache.get('a') is None   # b replaced it...
+    assert cache.get('b') == b      # ...whole
+
+
+def test_slab_round_trip_and_eviction(tmp_path):
+    cache = hotcache.SharedSlabCache(str(tmp_path / 'slab'), 10 * 1024, 1024)
+    cache.put('x', b'tile')
+    assert cache.get('x') == b'tile'
+    assert cache.get('y') is None
+    cache.put('big', b'z' * 2048)   # over a slot: not cached
+    assert cache.get('big') is None
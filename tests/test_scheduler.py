@@ -0,0 +1,75 @@
+"""Render-slot scheduling: ordering and background-fill accounting."""
+
+import asyncio
+
+from src.backend import scheduler
+
+
+def test_immediate_background_fills_are_not_counted_as_queued():
+    async def main():
+        s = scheduler.AsyncScheduler(slots=1, background_max=3)
+        done = []
+
+        async def fill():
+            done.append(1)
+
+        for i in range(5):
+            s.background(('tile', i), 3, fill)
+            await asyncio.sleep(0.01)
+        return s.stats(), len(done)
+
+    stats, filled = asyncio.run(main())
+    assert filled == 5
+    assert stats['background_queued'] == 0 and stats['queued'] == 0
+
+
+def test_queued_fills_are_capped_and_drained():
+    async def main():
+        s = scheduler.AsyncScheduler(slots=1, background_max=2)
+        release = asyncio.Event()
+        done = []
+
+        async def fill():
+            done.append(1)
+
+        client = asyncio.ensure_future(s.run('client', 3, release.wait))
+        await asyncio.sleep(0)
+        for i in range(4):
+            s.background(('tile', i), 3, fill)
+        queued = s.stats()['background_queued']
+        release.set()
+        await client
+        await asyncio.sleep(0.05)
+        return queued, len(done), s.stats()
+
+    queued, filled, stats = asyncio.run(main())
+    assert queued == 2 and filled == 2
+    assert stats['background_queued'] == 0 and stats['free'] == 1
+
+
+def test_newer_deeper_misses_go_first():
+    async def main():
+        s = scheduler.AsyncScheduler(slots=1)
+        release = asyncio.Event()
+        order = []
+
+        def job(z):
+            async def run():
+                order.append(z)
+            return run
+
+        first = asyncio.ensure_future(s.run('first', 1, release.wait))
+        await asyncio.sleep(0)
+        waiting = [asyncio.ensure_future(s.run(('z', z), z, job(z))) for z in (2, 5, 3)]
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(first, *waiting)
+        return order
+
+    assert asyncio.run(main()) == [5, 3, 2]
+
+
+def test_resize_while_idle():
+    s = scheduler.Scheduler(8)
+    s.resize(3)
+    assert s.stats() == {'slots': 3, 'free': 3, 'queued': 0}
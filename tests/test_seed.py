@@ -0,0 +1,28 @@
+"""Seeding engine: argument checks and per-tile failures."""
+
+import pytest
+
+from src.backend import seed
+
+
+def test_undecodable_tile_is_counted_and_the_run_goes_on(monkeypatch):
+    def seed_tile(z, x, y, vibes, fmt, before_fetch):
+        if (z, x, y) == (1, 0, 1):
+            raise ValueError('cannot identify image file')   # what PIL raises for a bad tile
+        return vibes
+
+    monkeypatch.setattr(seed, 'seed_tile', seed_tile)
+    stats = seed.seed([seed.WORLD], 0, 2, ['noir'], workers=2, rate=0)
+    assert stats == seed.SeedStats(tiles=21, written=20, skipped=0, failed=1)
+
+
+@pytest.mark.parametrize('args', [
+    dict(min_zoom=0, max_zoom=seed.MAX_NATIVE_ZOOM + 1),
+    dict(min_zoom=3, max_zoom=2),
+    dict(min_zoom=0, max_zoom=2, vibes=['nope']),
+    dict(min_zoom=0, max_zoom=2, fmt='gif'),
+])
+def test_bad_arguments_stop_the_run_before_any_tile(monkeypatch, args):
+    monkeypatch.setattr(seed, 'seed_tile', pytest.fail)
+    with pytest.raises(ValueError):
+        seed.seed([seed.WORLD], **args)
@@ -0,0 +1,198 @@
+"""Single-flight: one render per key across threads, processes and coroutines."""
+
+import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from src.backend import singleflight
+
+
+class _Render:
+    """A slow render that logs each run to a file and leaves its result in a cache file."""
+
+    def __init__(self, root: Path, delay: float = 0.3) -> None:
+        self.cache = root / 'tile.png'
+        self.runs = root / 'runs.log'
+        self.delay = delay
+
+    def __call__(self) -> bytes:
+        with open(self.runs, 'a') as f:
+            f.write(f'{os.getpid()}\n')
+        time.sleep(self.delay)
+        tmp = self.cache.with_name(f'.{os.getpid()}.{threading.get_ident()}')
+        tmp.write_bytes(b'tile')
+        os.replace(tmp, self.cache)
+        return b'tile'
+
+    def recheck(self) -> bytes | None:
+        try:
+            return self.cache.read_bytes()
+        except FileNotFoundError:
+            return None
+
+    def count(self) -> int:
+        try:
+            return len(self.runs.read_text().splitlines())
+        except FileNotFoundError:
+            return 0
+
+
+def _threads(render: _Render, lock_dir: Path, n: int, key=('noir', 9, 1, 2)) -> list:
+    results = [None] * n
+    start = threading.Barrier(n)
+
+    def request(i: int) -> None:
+        start.wait()
+        results[i] = singleflight.run(key, render, render.recheck, lock_dir, timeout=10)
+
+    threads = [threading.Thread(target=request, args=(i,)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(15)
+    return results
+
+
+def _wait_until(check, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not check():
+        assert time.monotonic() < deadline, 'timed out'
+        time.sleep(0.01)
+
+
+def test_concurrent_threads_render_once(tmp_path):
+    render = _Render(tmp_path)
+    assert _threads(render, tmp_path / 'locks', 8) == [b'tile'] * 8
+    assert render.count() == 1
+
+
+def _worker(root: str, start, n: int) -> None:
+    start.wait()
+    results = _threads(_Render(Path(root)), Path(root) / 'locks', n)
+    os._exit(0 if results == [b'tile'] * n else 1)
+
+
+@pytest.mark.skipif(singleflight.fcntl is None, reason='needs POSIX file locks')
+def test_concurrent_processes_render_once(tmp_path):
+    ctx = multiprocessing.get_context('fork')
+    start = ctx.Barrier(3)
+    workers = [ctx.Process(target=_worker, args=(str(tmp_path), start, 4)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(20)
+    assert [worker.exitcode for worker in workers] == [0, 0, 0]
+    runs = _Render(tmp_path).runs.read_text().splitlines()
+    assert len(runs) == 1   # the other workers' leaders found the tile on recheck
+
+
+@pytest.mark.skipif(singleflight.fcntl is None, reason='needs POSIX file locks')
+def test_leader_rechecks_after_taking_the_lock(tmp_path):
+    key = ('noir', 9, 3, 4)
+    render = _Render(tmp_path)
+    other_worker = singleflight._open_stripe(key, tmp_path)
+    assert singleflight._try_lock(other_worker)
+    result = []
+    thread = threading.Thread(target=lambda: result.append(
+        singleflight.run(key, render, render.recheck, tmp_path, timeout=10)))
+    thread.start()
+    time.sleep(0.2)
+    render.cache.write_bytes(b'from the other worker')
+    singleflight.fcntl.flock(other_worker, singleflight.fcntl.LOCK_UN)
+    other_worker.close()
+    thread.join(5)
+
+    assert result == [b'from the other worker']
+    assert render.count() == 0
+
+
+@pytest.mark.skipif(singleflight.fcntl is None, reason='needs POSIX file locks')
+def test_lock_timeout_runs_unshared(tmp_path):
+    key = ('noir', 9, 5, 6)
+    render = _Render(tmp_path, delay=0)
+    other_worker = singleflight._open_stripe(key, tmp_path)
+    assert singleflight._try_lock(other_worker)
+    try:
+        start = time.monotonic()
+        assert singleflight.run(key, render, lambda: None, tmp_path, timeout=0.2) == b'tile'
+        assert 0.2 <= time.monotonic() - start < 1
+        assert render.count() == 1
+    finally:
+        other_worker.close()
+
+
+def test_follower_timeout_runs_unshared(tmp_path):
+    key = ('noir', 9, 7, 8)
+    release = threading.Event()
+    thread = threading.Thread(target=singleflight.run,
+                              args=(key, lambda: release.wait(5), lambda: None, None, 10))
+    thread.start()
+    _wait_until(lambda: singleflight.pending(key))
+    assert singleflight.run(key, lambda: 'unshared', lambda: None, None, timeout=0.1) == 'unshared'
+    release.set()
+    thread.join(5)
+    assert not singleflight.pending(key)
+
+
+def test_follower_takes_over_from_a_failed_leader():
+    key = ('noir', 9, 9, 9)
+    calls = []
+
+    def render():
+        calls.append(threading.current_thread().name)
+        time.sleep(0.2)
+        if len(calls) == 1:
+            raise RuntimeError('upstream down')
+        return b'tile'
+
+    errors, results = [], []
+
+    def leader():
+        try:
+            singleflight.run(key, render, lambda: None, None, timeout=5)
+        except RuntimeError as exc:
+            errors.append(exc)
+
+    first = threading.Thread(target=leader)
+    first.start()
+    _wait_until(lambda: calls)
+    followers = [threading.Thread(target=lambda: results.append(
+        singleflight.run(key, render, lambda: None, None, timeout=5))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    for thread in [first, *followers]:
+        thread.join(5)
+
+    assert len(errors) == 1
+    assert results == [b'tile'] * 3
+    assert len(calls) == 2   # the failed leader, then one follower for everyone
+
+
+def test_run_async_renders_once_and_reports_pending(tmp_path):
+    key = ('noir', 9, 11, 12)
+    runs = []
+
+    async def render():
+        runs.append(1)
+        await asyncio.sleep(0.2)
+        return b'tile'
+
+    async def recheck():
+        return None
+
+    async def main():
+        requests = [asyncio.ensure_future(singleflight.run_async(key, render, recheck, tmp_path, 10))
+                    for _ in range(8)]
+        await asyncio.sleep(0.05)
+        assert singleflight.pending(key)
+        results = await asyncio.gather(*requests)
+        assert not singleflight.pending(key)
+        return results
+
+    assert asyncio.run(main()) == [b'tile'] * 8
+    assert len(runs) == 1
@@ -0,0 +1,86 @@
+"""Raster route against a stub upstream: how long upstream misses and failures are remembered."""
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import pytest
+from flask import Flask
+
+from src.backend import hotcache, tiles, tilestore, upstream
+from src.backend.upstream import UpstreamClient
+
+
+class _Stub(BaseHTTPRequestHandler):
+    status = 200
+    hits = 0
+
+    def do_GET(self) -> None:
+        type(self).hits += 1
+        self.send_response(self.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    _Stub.status, _Stub.hits = 200, 0
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Stub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(tiles, '_UPSTREAM', f'http://127.0.0.1:{server.server_address[1]}/{{z}}/{{x}}/{{y}}.png')
+    monkeypatch.setattr(upstream, 'openfreemap', UpstreamClient(
+        'test', max_concurrency=4, retries=0, backoff=0.0, hedge_after=0.0,
+        breaker_threshold=0, breaker_reset=60.0))
+    monkeypatch.setattr(tiles, '_CACHE_DIR', tmp_path)
+    monkeypatch.setattr(tiles, '_store', tilestore.DirectoryStore(tmp_path))
+    monkeypatch.setattr(tiles, '_hot_cache', hotcache.LRUCache(1 << 20))
+    monkeypatch.setattr(tiles, '_negative', hotcache.NegativeCache())
+    app = Flask(__name__)
+    app.register_blueprint(tiles.tiles_bp)
+    yield app.test_client()
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Moves the negative cache's clock forward by `clock.skip` seconds."""
+    real = time.monotonic
+    fake = SimpleNamespace(skip=0.0)
+    monkeypatch.setattr(hotcache, 'time', SimpleNamespace(monotonic=lambda: real() + fake.skip))
+    return fake
+
+
+def test_upstream_404_is_missing_for_an_hour(client, clock):
+    _Stub.status = 404
+    resp = client.get('/api/tiles/raster/noir/3/1/1.png')
+    assert resp.status_code == 404
+    assert resp.cache_control.max_age == 3600
+    assert client.get('/api/tiles/raster/toner/3/1/1.png').status_code == 404   # any vibe
+    assert _Stub.hits == 1
+
+    clock.skip = 3590
+    assert client.get('/api/tiles/raster/noir/3/1/1.png').cache_control.max_age <= 10
+    assert _Stub.hits == 1
+    clock.skip = 3601
+    client.get('/api/tiles/raster/noir/3/1/1.png')
+    assert _Stub.hits == 2
+
+
+@pytest.mark.parametrize('status', [408, 429, 500, 503])
+def test_upstream_timeouts_limits_and_5xx_are_failing_for_15s(client, clock, status):
+    _Stub.status = status
+    resp = client.get('/api/tiles/raster/noir/3/1/1.png')
+    assert resp.status_code == 502
+    assert resp.headers['Retry-After'] == '15'
+    assert client.get('/api/tiles/raster/noir/3/1/1.png').status_code == 502
+    assert _Stub.hits == 1
+
+    clock.skip = 16
+    _Stub.status = 200
+    client.get('/api/tiles/raster/noir/3/1/1.png')
+    assert _Stub.hits == 2
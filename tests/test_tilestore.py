@@ -0,0 +1,121 @@
+"""Tile stores: deduplication and what eviction and pruning free."""
+
+import os
+import pathlib
+import sqlite3
+import time
+
+import pytest
+
+from src.backend import janitor, tilestore
+
+
+def _count(path, table):
+    with sqlite3.connect(path) as conn:
+        return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+
+@pytest.mark.parametrize('dedup_max', [0, 8192], ids=['plain', 'deduplicated'])
+def test_interrupted_write_leaves_no_partial_tile(tmp_path, monkeypatch, dedup_max):
+    store = tilestore.DirectoryStore(tmp_path, dedup_max=dedup_max)
+    store.put('upstream', 5, 1, 1, b'old tile')
+    seen = []
+    real_write = pathlib.Path.write_bytes
+
+    def write_half_then_fail(path, data):
+        real_write(path, data[:len(data) // 2])
+        seen.append((store.get('upstream', 5, 1, 1), store.get('upstream', 5, 1, 2)))   # mid-write
+        raise OSError(28, 'No space left on device')
+
+    monkeypatch.setattr(pathlib.Path, 'write_bytes', write_half_then_fail)
+    with pytest.raises(OSError):
+        store.put('upstream', 5, 1, 1, b'new tile ' * 10)
+    with pytest.raises(OSError):
+        store.put('upstream', 5, 1, 2, b'another new tile')
+
+    assert seen == [(b'old tile', None)] * 2
+    assert store.get('upstream', 5, 1, 1) == b'old tile'
+    assert not store.has('upstream', 5, 1, 2)
+    leftovers = [name for _, _, names in os.walk(tmp_path) for name in names if name.startswith('.')]
+    assert leftovers == ['.1.png.read'] * bool(dedup_max)   # just the old tile's stamp
+
+
+@pytest.fixture
+def sweep_setup(tmp_path, monkeypatch):
+    """A deduplicating directory store, and a janitor whose budget fits one copy's share of a tile."""
+    monkeypatch.setattr(janitor.Janitor, '_start', lambda self: None)   # no background thread
+    store = tilestore.DirectoryStore(tmp_path, dedup_max=8192)
+    ocean = b'ocean' * 100
+    return store, janitor.Janitor(store, max_bytes=len(ocean) // 2, pin_zoom=4, interval=0), ocean
+
+
+def test_sweep_keeps_the_linked_tile_that_was_read(sweep_setup):
+    store, jan, ocean = sweep_setup
+    store.put('raster/noir', 5, 1, 1, ocean)
+    store.put('raster/noir', 5, 1, 2, ocean)
+    assert store.path('raster/noir', 5, 1, 1).stat().st_nlink == 3   # both linked to one blob
+    store.touch('raster/noir', 'png', [(5, 1, 1, time.time() - 86400), (5, 1, 2, time.time() - 86400)])
+
+    jan.record('raster/noir', 5, 1, 2)
+    assert jan.sweep().evicted == 1
+    assert not store.has('raster/noir', 5, 1, 1)
+    assert store.get('raster/noir', 5, 1, 2) == ocean
+
+
+def test_sweep_keeps_a_new_link_to_an_old_blob(sweep_setup):
+    store, jan, ocean = sweep_setup
+    store.put('raster/noir', 5, 1, 1, ocean)
+    store.touch('raster/noir', 'png', [(5, 1, 1, time.time() - 86400)])
+    store.put('raster/noir', 5, 1, 2, ocean)   # just written; its blob was last read a day ago
+
+    assert jan.sweep().evicted == 1
+    assert not store.has('raster/noir', 5, 1, 1)
+    assert store.has('raster/noir', 5, 1, 2)
+
+
+def test_mbtiles_stores_identical_tiles_once(tmp_path):
+    store = tilestore.MBTilesStore(tmp_path)
+    ocean = b'ocean' * 100
+    store.put_many('raster/noir', [(5, 1, 1, ocean), (5, 1, 2, ocean), (5, 2, 1, b'coast')])
+
+    assert store.get('raster/noir', 5, 1, 2) == ocean
+    assert store.has('raster/noir', 5, 2, 1)
+    assert {t[:3] for t in store.iter_tiles('raster/noir')} == {(5, 1, 1), (5, 1, 2), (5, 2, 1)}
+    path = tmp_path / 'raster' / 'noir.mbtiles'
+    assert _count(path, 'map') == 3
+    assert _count(path, 'images') == 2
+
+    total, by_age = store.usage('raster/noir', 0, 600)
+    assert total == len(ocean) + len(b'coast')   # each ocean tile counts half its image
+    assert sum(by_age.values()) == total
+
+
+def test_mbtiles_prune_deletes_orphan_images(tmp_path):
+    store = tilestore.MBTilesStore(tmp_path)
+    store.put_many('upstream', [(5, 0, 0, b'old'), (5, 0, 1, b'shared'), (5, 0, 2, b'shared')])
+    store.put('upstream', 5, 0, 0, b'new')          # 'old' is left without a tile
+    store.touch('upstream', 'png', [(5, 0, 1, 0.0)])
+
+    assert store.evict('upstream', 5, 1.0) == (1, len(b'shared') // 2)
+    assert store.prune() == (1, len(b'old'))        # 'shared' is still used by (5, 0, 2)
+    assert store.get('upstream', 5, 0, 2) == b'shared'
+    assert store.get('upstream', 5, 0, 1) is None
+    assert _count(tmp_path / 'upstream.mbtiles', 'images') == 2
+
+
+def test_mbtiles_moves_a_plain_tiles_table_into_map_and_images(tmp_path):
+    path = tmp_path / 'upstream.mbtiles'
+    with sqlite3.connect(path) as conn:   # the layout before dedup and access tracking
+        conn.executescript(
+            'CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB);'
+            'CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row);'
+        )
+        conn.executemany('INSERT INTO tiles VALUES (?, ?, ?, ?)',
+                         [(1, 0, 0, b'same'), (1, 0, 1, b'same'), (1, 1, 1, b'other')])
+
+    store = tilestore.MBTilesStore(tmp_path)
+    assert store.get('upstream', 1, 0, 1) == b'same'    # TMS row 0 is y=1 at z1
+    assert store.get('upstream', 1, 1, 0) == b'other'
+    assert _count(path, 'map') == 3
+    assert _count(path, 'images') == 2
+    assert store.layers() == ['upstream']
@@ -0,0 +1,102 @@
+"""Compiled vibe pipelines against the step-by-step PIL chain they replaced."""
+
+import io
+from pathlib import Path
+
+import pytest
+from PIL import Image, ImageChops, ImageEnhance, ImageFilter, ImageOps
+
+from src.backend import transforms
+
+_FIXTURES = sorted((Path(__file__).resolve().parent.parent / 'benchmarks' / 'fixtures' / 'tiles').glob('*.png'))
+
+# Each channel within this many levels of the reference everywhere, and
+# this close on average. Posterize steps must not flip: 32 levels for mario.
+_MAX_DIFF = 2
+_MAX_MAE = 0.5
+
+
+def _tint(img, *factors):
+    return Image.merge('RGB', [ch.point([int(v * f) for v in range(256)]) for ch, f in zip(img.split(), factors)])
+
+
+def _remap(gray, *ranges):
+    return Image.merge('RGB', [gray.point([int(lo + span * v / 255) for v in range(256)]) for lo, span in ranges])
+
+
+def _sepia(img):
+    out = Image.new('RGB', img.size)
+    out.putdata([
+        (min(255, int(0.393 * r + 0.769 * g + 0.189 * b)),
+         min(255, int(0.349 * r + 0.686 * g + 0.168 * b)),
+         min(255, int(0.272 * r + 0.534 * g + 0.131 * b)))
+        for r, g, b in img.getdata()
+    ])
+    return out
+
+
+def _reference(vibe: str, img: Image.Image) -> Image.Image:
+    """The per-vibe chain as it was written before the steps were compiled."""
+    color = lambda im, f: ImageEnhance.Color(im).enhance(f)  # noqa: E731
+    contrast = lambda im, f: ImageEnhance.Contrast(im).enhance(f)  # noqa: E731
+    brightness = lambda im, f: ImageEnhance.Brightness(im).enhance(f)  # noqa: E731
+    sharpness = lambda im, f: ImageEnhance.Sharpness(im).enhance(f)  # noqa: E731
+    gray = lambda im: im.convert('L').convert('RGB')  # noqa: E731
+    if vibe == 'vintage':
+        return contrast(brightness(_sepia(img), 0.88), 0.82)
+    if vibe == 'toner':
+        return brightness(contrast(gray(img), 1.8), 1.1)
+    if vibe == 'blueprint':
+        return _remap(img.convert('L'), (10, 210), (31, 201), (92, 163))
+    if vibe == 'dark':
+        return brightness(_tint(ImageOps.invert(img), 0.55, 0.60, 0.72), 0.75)
+    if vibe == 'watercolor':
+        img = contrast(color(img, 1.35), 0.75).filter(ImageFilter.GaussianBlur(radius=1.2))
+        return color(img, 1.4)
+    if vibe == 'highcontrast':
+        return color(contrast(img, 2.2), 1.6)
+    if vibe == 'noir':
+        return contrast(brightness(_tint(color(img, 0.15), 0.55, 0.65, 0.72), 0.58), 1.15)
+    if vibe == 'mockva':
+        return ImageOps.posterize(_remap(img.convert('L'), (42, 198), (34, 198), (24, 192)), 3)
+    if vibe == 'mario':
+        return ImageOps.posterize(contrast(color(img, 2.5), 1.8), 3)
+    if vibe == 'simcity':
+        return contrast(color(ImageOps.posterize(img, 4), 0.85), 1.1)
+    if vibe == 'tomclancy':
+        return sharpness(contrast(_remap(img.convert('L'), (0, 30), (10, 190), (0, 30)), 2.0), 1.8)
+    if vibe == 'deco':
+        return sharpness(contrast(_tint(img, 1.05, 1.0, 0.78), 1.3), 1.4)
+    if vibe == 'metro':
+        return contrast(color(_tint(img, 1.04, 1.0, 0.82), 0.75), 0.85)
+    return img
+
+
+def _diff(a: Image.Image, b: Image.Image) -> tuple[int, float]:
+    """(largest, mean) absolute difference over all channels."""
+    d = ImageChops.difference(a, b)
+    hist = d.histogram()
+    n = 3 * a.width * a.height
+    return max(hi for _, hi in d.getextrema()), sum((i % 256) * c for i, c in enumerate(hist)) / n
+
+
+def _load(data: bytes) -> Image.Image:
+    return Image.open(io.BytesIO(data)).convert('RGB')
+
+
+@pytest.mark.parametrize('fixture', _FIXTURES, ids=lambda p: p.stem)
+@pytest.mark.parametrize('vibe', sorted(transforms._VIBE_STEPS))
+def test_pipeline_matches_reference_chain(vibe, fixture):
+    data = fixture.read_bytes()
+    img = _load(data)
+    largest, mean = _diff(_load(transforms._render(vibe, img, 'png')), _reference(vibe, img))
+    assert largest <= _MAX_DIFF and mean <= _MAX_MAE, (largest, mean)
+
+
+@pytest.mark.parametrize('vibe', sorted(transforms._VIBE_STEPS))
+def test_flat_tile_matches_pipeline(vibe):
+    data = next(p for p in _FIXTURES if p.stem == 'ocean').read_bytes()
+    flat = transforms.transform_flat([vibe], data)
+    assert flat is not None
+    largest, _ = _diff(_load(flat[vibe]), _load(transforms._render(vibe, _load(data), 'png')))
+    assert largest <= _MAX_DIFF
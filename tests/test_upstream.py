@@ -0,0 +1,155 @@
+"""UpstreamClient against a local stub HTTP server: retries, hedging, circuit breaker."""
+
+import asyncio
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+import requests
+
+from src.backend.upstream import CircuitOpenError, UpstreamClient
+
+
+class _Stub(BaseHTTPRequestHandler):
+    # Each path is a script of responses: '/flaky' answers 503 once, then 200.
+    script: dict[str, list] = {}
+    hits: dict[str, int] = {}
+
+    def do_GET(self) -> None:
+        n = self.hits[self.path] = self.hits.get(self.path, 0) + 1
+        steps = self.script.get(self.path, [200])
+        status = steps[min(n, len(steps)) - 1]
+        if isinstance(status, tuple):   # (delay, status)
+            time.sleep(status[0])
+            status = status[1]
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+@pytest.fixture
+def stub():
+    _Stub.script, _Stub.hits = {}, {}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Stub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}'
+    server.shutdown()
+    server.server_close()
+
+
+def _closed_port() -> str:
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Stub)
+    port = server.server_address[1]
+    server.server_close()
+    return f'http://127.0.0.1:{port}'
+
+
+def _client(**kwargs) -> UpstreamClient:
+    settings = dict(max_concurrency=4, retries=2, backoff=0.0, hedge_after=0.0,
+                    breaker_threshold=2, breaker_reset=60.0)
+    return UpstreamClient('test', **{**settings, **kwargs})
+
+
+def test_retries_transient_status(stub):
+    _Stub.script['/flaky'] = [503, 200]
+    client = _client()
+    assert client.get(f'{stub}/flaky', timeout=5).status_code == 200
+    assert _Stub.hits['/flaky'] == 2
+    assert client.stats()['retries'] == 1
+
+
+def test_returns_last_response_when_retries_run_out(stub):
+    _Stub.script['/down'] = [503]
+    client = _client(breaker_threshold=0)
+    assert client.get(f'{stub}/down', timeout=5).status_code == 503
+    assert _Stub.hits['/down'] == 3
+
+
+def test_hedge_wins_over_slow_primary(stub):
+    _Stub.script['/slow'] = [(2, 200), 200]
+    client = _client(hedge_after=0.1)
+    start = time.monotonic()
+    assert client.get(f'{stub}/slow', timeout=5).status_code == 200
+    assert time.monotonic() - start < 1.5
+    assert client.stats()['hedge_wins'] == 1
+
+
+def test_breaker_opens_and_probe_closes_it(stub):
+    client = _client(retries=0, breaker_reset=0.05)
+    dead = _closed_port()
+    for _ in range(2):
+        with pytest.raises(requests.ConnectionError):
+            client.get(f'{dead}/', timeout=1)
+    with pytest.raises(CircuitOpenError):
+        client.get(f'{stub}/', timeout=5)
+    assert not _Stub.hits   # failed fast, never sent
+
+    time.sleep(0.1)
+    assert client.get(f'{stub}/', timeout=5).status_code == 200
+    assert client.stats()['circuit'] == 'closed'
+
+
+def test_failed_probe_reopens(stub):
+    client = _client(retries=0, breaker_threshold=1, breaker_reset=0.05)
+    dead = _closed_port()
+    with pytest.raises(requests.ConnectionError):
+        client.get(f'{dead}/', timeout=1)
+    time.sleep(0.1)
+    with pytest.raises(requests.ConnectionError):
+        client.get(f'{dead}/', timeout=1)
+    assert client.stats()['circuit'] == 'open'
+
+
+def _open(client: UpstreamClient) -> None:
+    with pytest.raises(requests.ConnectionError):
+        client.get(f'{_closed_port()}/', timeout=1)
+    time.sleep(0.1)
+
+
+def test_probe_with_unexpected_error_does_not_wedge_breaker(stub):
+    client = _client(retries=0, breaker_threshold=1, breaker_reset=0.05)
+    _open(client)
+    with pytest.raises(requests.exceptions.InvalidURL):
+        client.get('http://[::1/', timeout=1)   # the probe, failing before any I/O
+    assert client.stats()['circuit'] == 'open'
+    assert client.get(f'{stub}/', timeout=5).status_code == 200
+    assert client.stats()['circuit'] == 'closed'
+
+
+def test_cancelled_async_probe_does_not_wedge_breaker(stub):
+    _Stub.script['/slow'] = [(1, 200), 200]
+    client = _client(retries=0, breaker_threshold=1, breaker_reset=0.05)
+    _open(client)
+
+    async def main():
+        probe = asyncio.ensure_future(client.aget(f'{stub}/slow', timeout=5))
+        await asyncio.sleep(0.1)
+        probe.cancel()   # e.g. the ASGI client disconnected
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        assert client.stats()['circuit'] == 'open'
+        resp = await client.aget(f'{stub}/', timeout=5)
+        await client.aclose()
+        return resp
+
+    assert asyncio.run(main()).status_code == 200
+    assert client.stats()['circuit'] == 'closed'
+
+
+def test_async_retries_and_breaker(stub):
+    _Stub.script['/flaky'] = [502, 200]
+    client = _client()
+
+    async def main():
+        try:
+            return await client.aget(f'{stub}/flaky', timeout=5)
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(main()).status_code == 200
+    assert client.stats()['retries'] == 1